@@ -0,0 +1,153 @@
+import os
+import time
+import numpy as np
+
+
+def load_encoder(model_name='BAAI/bge-m3', device=None, local_files_only=None, use_safetensors=None):
+    """Load the tokenizer and model used for chunk embeddings, in eval mode on `device`.
+
+    Args:
+        model_name (str): Hub name or local directory; a local directory is never looked up online.
+        local_files_only (bool): Only use the local Hugging Face cache (None: True for directories).
+        use_safetensors (bool): Require (True) or forbid (False) safetensors weights; None lets
+            transformers pick. Safetensors weights are memory-mapped instead of unpickled.
+    """
+    import torch
+    from transformers import AutoModel
+
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if local_files_only is None:
+        local_files_only = os.path.isdir(model_name)
+    tokenizer = load_tokenizer(model_name, local_files_only)
+    model = AutoModel.from_pretrained(model_name, local_files_only=local_files_only,
+                                      use_safetensors=use_safetensors, low_cpu_mem_usage=True)
+    model.eval()
+    return tokenizer, model.to(device)
+
+
+def load_tokenizer(model_name='BAAI/bge-m3', local_files_only=None):
+    """Load only the tokenizer, e.g. for an ONNX encoder backend."""
+    from transformers import AutoTokenizer
+
+    if local_files_only is None:
+        local_files_only = os.path.isdir(model_name)
+    return AutoTokenizer.from_pretrained(model_name, local_files_only=local_files_only)
+
+
+class BatchEmbedder:
+    """Embeds chunk strings in padded batches instead of one forward pass per chunk.
+
+    Chunks are tokenized once, sorted by token length so each batch pads to a
+    similar length, and grouped under both a batch size and a token budget
+    (batch rows * longest row). The output matches what process_pdf produced
+    for a single chunk: CLS pooling, scaled by 1/20 and padded/truncated to
+    `embedding_dim`.
+
+    `backend` optionally replaces the eager torch forward pass: a callable
+    taking padded int64 (input_ids, attention_mask) arrays and returning the
+    CLS rows as a float array (see encoder_backends.py). `model` may then be None.
+    """
+
+    def __init__(self, tokenizer, model, batch_size=16, max_batch_tokens=16384,
+                 max_length=None, embedding_dim=1024, scale=20.0, backend=None):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_length = max_length
+        self.embedding_dim = embedding_dim
+        self.scale = scale
+
+    def tokenize(self, texts):
+        """Tokenize without padding and return (encodings, token lengths)."""
+        encodings = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)
+        lengths = [len(ids) for ids in encodings['input_ids']]
+        return encodings, lengths
+
+    def make_batches(self, lengths):
+        """Group indices sorted by length under the batch size and token budget."""
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batches = []
+        current = []
+        for index in order:
+            # Lengths are ascending, so the new item is the longest in the batch
+            padded_tokens = (len(current) + 1) * lengths[index]
+            if current and (len(current) >= self.batch_size or padded_tokens > self.max_batch_tokens):
+                batches.append(current)
+                current = []
+            current.append(index)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _fit_dim(self, embeddings):
+        """Pad or truncate a (n, d) array to (n, embedding_dim)."""
+        if embeddings.shape[1] < self.embedding_dim:
+            return np.pad(embeddings, ((0, 0), (0, self.embedding_dim - embeddings.shape[1])), 'constant')
+        return embeddings[:, :self.embedding_dim]
+
+    def embed_encoded(self, encodings, batch):
+        """Run one padded batch through the model and return scaled CLS embeddings."""
+        features = {key: [encodings[key][i] for i in batch] for key in ('input_ids', 'attention_mask')}
+        if self.backend is not None:
+            encoded_input = self.tokenizer.pad(features, padding=True, return_tensors='np')
+            cls = self.backend(encoded_input['input_ids'].astype(np.int64),
+                               encoded_input['attention_mask'].astype(np.int64))
+            return self._fit_dim(np.asarray(cls, dtype=np.float32) / self.scale)
+
+        import torch
+
+        encoded_input = self.tokenizer.pad(features, padding=True, return_tensors='pt').to(self.model.device)
+        with torch.no_grad():
+            model_output = self.model(**encoded_input)
+            # Use CLS pooling (first token of every row)
+            sentence_embeddings = model_output[0][:, 0]
+        return self._fit_dim(sentence_embeddings.float().cpu().numpy() / self.scale)
+
+    @property
+    def dtype(self):
+        # Part of the query cache fingerprint, so each backend caches its own vectors
+        if self.backend is not None:
+            return self.backend.dtype
+        return self.model.dtype
+
+    def embed(self, texts):
+        """Embed a list of strings and return a float32 array aligned with the input order."""
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.embedding_dim), dtype=np.float32)
+        encodings, _ = self.tokenize(texts)
+        return self.embed_tokenized(encodings)
+
+    def embed_tokenized(self, encodings):
+        """Embed already tokenized (unpadded) input_ids / attention_mask lists."""
+        lengths = [len(ids) for ids in encodings['input_ids']]
+        result = np.zeros((len(lengths), self.embedding_dim), dtype=np.float32)
+        if not lengths:
+            return result
+
+        start_time = time.time()
+        batches = self.make_batches(lengths)
+        for batch in batches:
+            result[batch] = self.embed_encoded(encodings, batch)
+
+        print(f"Embedded {len(lengths)} chunks in {len(batches)} batches: {time.time() - start_time:.2f} seconds")
+        return result
+
+    def embed_groups(self, groups):
+        """Embed several lists of strings (e.g. one per file) in shared batches.
+
+        Returns one array per input group, so chunks from many small files
+        fill the same batches.
+        """
+        groups = [list(group) for group in groups]
+        flat = [text for group in groups for text in group]
+        embeddings = self.embed(flat)
+        results = []
+        offset = 0
+        for group in groups:
+            results.append(embeddings[offset:offset + len(group)])
+            offset += len(group)
+        return results
@@ -0,0 +1,76 @@
+"""
+Benchmark: encoder backends on CPU, with a parity check against the float model.
+
+    python bench_encoder_backends.py [symptom_folder] [n_chunks] [backend ...]
+
+Chunks come from the symptom files in `symptom_folder` (read_symptom_chunks),
+or from a fixed synthetic set when no folder is given, so runs are comparable.
+"""
+import os
+import sys
+import time
+import numpy as np
+
+from batch_embedder import BatchEmbedder, load_encoder
+from encoder_backends import backend_names, make_embedder, parity
+from symptom_parser import read_symptom_chunks
+
+sample_symptoms = ["joint pain", "fever", "fatigue", "rash", "headache", "nausea", "shortness of breath",
+                   "abdominal pain", "swelling of the knees", "muscle weakness", "blurred vision", "cough"]
+
+
+def load_chunks(folder, n_chunks):
+    """Up to n_chunks chunk strings from a symptom folder, or synthetic ones when folder is None."""
+    chunks = []
+    if folder:
+        for name in sorted(os.listdir(folder)):
+            chunks.extend(read_symptom_chunks(os.path.join(folder, name))[0])
+            if len(chunks) >= n_chunks:
+                break
+    else:
+        rng = np.random.default_rng(0)
+        for _ in range(n_chunks):
+            picked = rng.choice(sample_symptoms, size=rng.integers(1, 6), replace=False)
+            chunks.append("Symptoms: " + ", ".join(picked) + ". " + " ".join(picked) * int(rng.integers(1, 8)))
+    return chunks[:n_chunks]
+
+
+def measure(embedder, chunks, queries):
+    """(chunks per second over the whole set, median ms for a one-query batch)."""
+    embedder.embed(chunks[:4])  # warm up
+    start_time = time.perf_counter()
+    embedder.embed(chunks)
+    throughput = len(chunks) / (time.perf_counter() - start_time)
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        embedder.embed([query])
+        latencies.append(time.perf_counter() - start_time)
+    return throughput, float(np.median(latencies)) * 1000
+
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != '-' else None
+    n_chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    names = sys.argv[3:] or list(backend_names)
+    chunks = load_chunks(folder, n_chunks)
+    queries = sample_symptoms
+
+    tokenizer, model = load_encoder(device='cpu')
+    reference = BatchEmbedder(tokenizer, model)
+    print(f"{len(chunks)} chunks, {len(queries)} single queries, {os.cpu_count()} CPUs")
+    base_throughput = None
+    for name in names:
+        start_time = time.perf_counter()
+        embedder = make_embedder(name, tokenizer, model)
+        setup_time = time.perf_counter() - start_time
+        throughput, latency = measure(embedder, chunks, queries)
+        base_throughput = base_throughput or throughput
+        check = parity(reference, embedder, chunks)
+        print(f"  {name:10s} setup {setup_time:7.2f} s  {throughput:8.1f} chunks/s "
+              f"({throughput / base_throughput:4.1f}x)  query {latency:7.2f} ms  "
+              f"cosine min {check['min']:.4f} mean {check['mean']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark: GenerationEngine against a local stub chat-completions server.
+
+    python bench_generation_engine.py [n_items] [concurrency] [latency_ms] [error_rate]
+
+The stub answers every POST after `latency_ms` with a canned formatted
+symptom, and fails a fraction `error_rate` of the requests with 429 or 503 so
+the retries and the rate limiter are exercised. The engine is run twice over
+the same items: the second run must skip everything through the manifest.
+Nothing leaves the machine, so no API key is needed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from generation_engine import GenerationEngine
+
+stub_content = ("<start_symptom_name>Fever</start_symptom_name> <start_description>Raised body temperature"
+                "</start_description><start_synonyms>Pyrexia</start_synonyms><start_monologues>I feel hot"
+                "</start_monologues>")
+
+
+def start_stub_server(latency=0.05, error_rate=0.0, seed=0):
+    """Serve a stub /chat/completions on a free local port; returns (server, url)."""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(latency)
+            with lock:
+                server.requests += 1
+                fail = rng.random() < error_rate
+            if fail:
+                status = rng.choice([429, 503])
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '0.2')
+                self.end_headers()
+                return
+            reply = json.dumps({'model': body['model'],
+                                'choices': [{'message': {'role': 'assistant', 'content': stub_content}}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+
+def main():
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 200) / 1000
+    error_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.05
+    server, url = start_stub_server(latency, error_rate)
+    folder = tempfile.mkdtemp()
+    manifest_path = os.path.join(folder, 'manifest.jsonl')
+    items = [(f"disease {i}", [{"role": "user", "content": f"Symptoms of disease {i}"}]) for i in range(n_items)]
+
+    def work(key, messages):
+        with open(os.path.join(folder, f"{key}.txt"), 'w', encoding='utf-8') as f:
+            f.write(engine.complete(messages))
+
+    print(f"{n_items} items, {latency * 1000:.0f} ms per request, {error_rate:.0%} errors, "
+          f"sequential estimate {n_items * latency:.1f} seconds")
+    for rate in (concurrency / latency * 2, concurrency / latency / 2):
+        engine = GenerationEngine('stub', api_url=url, concurrency=concurrency, requests_per_second=rate,
+                                  backoff=0.1, manifest_path=manifest_path + f'.{rate:.0f}')
+        before = server.requests
+        result = engine.run(items, work)
+        print(f"  concurrency {concurrency}, {rate:6.1f} req/s limit: {result.done} done in {result.seconds:.2f} s "
+              f"({result.done / result.seconds:.1f} items/s), {server.requests - before} requests, "
+              f"{len(result.failed)} failed")
+        engine.close()
+        engine = GenerationEngine('stub', api_url=url, manifest_path=manifest_path + f'.{rate:.0f}')
+        resumed = engine.run(items, work)
+        print(f"  resumed run: {resumed.done} done, {resumed.skipped} skipped")
+        engine.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark: vectorized top-k search against the per-chunk loop query_cluster used.
+
+    python bench_vector_search.py [n_chunks] [k]
+"""
+import sys
+import time
+import numpy as np
+
+from embedding_store import chunk_dtype
+from vector_search import search_chunks
+
+embedding_dim = 1024
+
+
+def make_corpus(n_chunks, dim=embedding_dim, seed=0):
+    """Random unit-norm embeddings scaled like process_pdf output, plus their chunk table."""
+    rng = np.random.default_rng(seed)
+    matrix = rng.standard_normal((n_chunks, dim), dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) * 20.0
+    chunks = np.zeros(n_chunks, dtype=chunk_dtype)
+    chunks['doc_id'] = np.arange(n_chunks) // 15 + 1
+    chunks['chunk_index'] = np.arange(n_chunks) % 15
+    chunks['start_id'] = chunks['chunk_index'] * 500
+    chunks['end_id'] = chunks['start_id'] + 480
+    return matrix, chunks
+
+
+def loop_search(entries, query_embedding, k):
+    """The original query_cluster scoring: one np.dot per chunk dict, then a full sort."""
+    distances = []
+    for embedding in entries:
+        embedding_array = np.array(embedding["embeddings"])
+        similarity = np.dot(query_embedding, embedding_array)
+        distances.append((1 - similarity, embedding['doc_id'], embedding['chunk_index'],
+                          embedding['start_id'], embedding['end_id']))
+    distances.sort(key=lambda x: x[0])
+    return distances[:k]
+
+
+def best_time(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def main():
+    n_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    matrix, chunks = make_corpus(n_chunks)
+    queries = make_corpus(64, seed=1)[0]
+    query = queries[0]
+
+    entries = [{"embeddings": matrix[i], "doc_id": chunks[i]['doc_id'], "chunk_index": chunks[i]['chunk_index'],
+                "start_id": chunks[i]['start_id'], "end_id": chunks[i]['end_id']} for i in range(n_chunks)]
+
+    # Same top-k from both paths
+    expected = [(int(d), int(c)) for _, d, c, _, _ in loop_search(entries, query, k)]
+    hits = search_chunks(matrix, chunks, query, k)[0]
+    assert expected == list(zip(hits['doc_id'].tolist(), hits['chunk_index'].tolist())), "results differ"
+
+    loop_time = best_time(lambda: loop_search(entries, query, k), 3)
+    single_time = best_time(lambda: search_chunks(matrix, chunks, query, k), 20)
+    batch_time = best_time(lambda: search_chunks(matrix, chunks, queries, k), 5)
+    matrix16 = matrix.astype(np.float16)
+    half_time = best_time(lambda: search_chunks(matrix16, chunks, query, k), 20)
+
+    print(f"{n_chunks} chunks x {embedding_dim} dims, top-{k}")
+    print(f"  python loop:            {loop_time * 1000:10.2f} ms/query")
+    print(f"  vectorized float32:     {single_time * 1000:10.2f} ms/query ({loop_time / single_time:.0f}x)")
+    print(f"  float16 (cast per block):{half_time * 1000:10.2f} ms/query")
+    print(f"  batch of {len(queries)} queries:    {batch_time * 1000 / len(queries):10.2f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+"""
+Persistent BM25 index over symptom chunks, built at ingest time.
+
+Chunks are keyed by the same (doc_id, chunk_index) as their embeddings. The
+compacted base segment is a set of flat arrays that are memory-mapped on
+open; a query only reads the postings of its own terms.
+
+Layout of an index directory:
+
+    meta.json            chunk count, total length, k1 / b / epsilon, average idf,
+                         base generation and delta file name
+    base.G/              base segment of generation G:
+        chunks.npy         (doc_id, chunk_index, length) per chunk ordinal
+        key_order.npy      chunk ordinals sorted by (doc_id, chunk_index), for lookups
+        terms.bin          sorted UTF-8 terms, concatenated
+        term_offsets.npy   (n_terms + 1) byte offsets into terms.bin
+        post_offsets.npy   (n_terms + 1) offsets into the postings arrays
+        post_chunks.npy    chunk ordinals, grouped by term
+        post_tf.npy        term frequency of each posting
+        idf.npy            precomputed idf per term
+    delta.G.S.pkl        chunks added and deleted since generation G was compacted
+
+Compaction writes a new base directory and saving the delta writes a new
+delta file; either is switched to by replacing meta.json, so the base and
+delta a reader loads always belong together, and the old ones are removed
+afterwards. Indexes written before generations (no generation in meta.json)
+keep their base files in the index directory and the delta in delta.pkl.
+
+Scoring follows rank_bm25.BM25Okapi (negative idf floored at epsilon * average idf).
+The average idf is taken over the live index, delta included, so scores do
+not change when the delta is compacted.
+"""
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import shelve
+import shutil
+from collections import Counter, defaultdict
+import numpy as np
+
+from embedding_store import _write_json_atomic
+
+bm25_folder = 'bm25_index'
+
+base_files = ('chunks.npy', 'key_order.npy', 'terms.bin', 'term_offsets.npy', 'post_offsets.npy',
+              'post_chunks.npy', 'post_tf.npy', 'idf.npy')
+
+chunk_table_dtype = np.dtype([('doc_id', 'i4'), ('chunk_index', 'i4'), ('length', 'i4')])
+
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lowercased word tokens."""
+    return token_pattern.findall(text.lower())
+
+
+def _chunk_key(doc_id, chunk_index):
+    return (np.asarray(doc_id, dtype=np.int64) << 32) | np.asarray(chunk_index, dtype=np.int64)
+
+
+def _save_array(path, array):
+    with open(path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class BM25Index:
+    """BM25 index with a memory-mapped base segment and an in-memory delta.
+
+    Args:
+        index_dir (str): Directory of the index (created empty if missing).
+        k1, b, epsilon: BM25Okapi parameters, fixed when the index is created.
+    """
+
+    def __init__(self, index_dir=bm25_folder, k1=1.5, b=0.75, epsilon=0.25):
+        self.index_dir = index_dir
+        if not os.path.exists(self._path('meta.json')):
+            os.makedirs(index_dir, exist_ok=True)
+            self._write_base([], {}, {'k1': k1, 'b': b, 'epsilon': epsilon})
+        self.load()
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def _base_path(self, name, generation):
+        """Path of base file `name` of `generation` (None = the layout without generations)."""
+        if generation is None:
+            return self._path(name)
+        return os.path.join(self.index_dir, f'base.{generation}', name)
+
+    def _delta_name(self):
+        """File name of the delta meta.json points at, or None."""
+        if 'generation' in self.meta:
+            return self.meta.get('delta')
+        return 'delta.pkl' if os.path.exists(self._path('delta.pkl')) else None
+
+    def load(self, retries=3):
+        """(Re)open the base and delta meta.json points at."""
+        for attempt in range(retries):
+            try:
+                self._load()
+                return
+            except FileNotFoundError:
+                # A writer switched generations and removed the files between our reads
+                if attempt == retries - 1:
+                    raise
+
+    def _load(self):
+        with open(self._path('meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.k1, self.b, self.epsilon = self.meta['k1'], self.meta['b'], self.meta['epsilon']
+        generation = self.meta.get('generation')
+        path = lambda name: self._base_path(name, generation)
+        mmap = 'r' if self.meta['n_chunks'] else None
+        self.chunks = np.load(path('chunks.npy'), mmap_mode=mmap)
+        self.key_order = np.load(path('key_order.npy'), mmap_mode=mmap)
+        self.sorted_keys = _chunk_key(self.chunks['doc_id'], self.chunks['chunk_index'])[self.key_order]
+        self.terms = np.memmap(path('terms.bin'), dtype=np.uint8, mode='r') \
+            if os.path.getsize(path('terms.bin')) else np.zeros(0, dtype=np.uint8)
+        self.term_offsets = np.load(path('term_offsets.npy'))
+        self.post_offsets = np.load(path('post_offsets.npy'))
+        self.post_chunks = np.load(path('post_chunks.npy'), mmap_mode=mmap)
+        self.post_tf = np.load(path('post_tf.npy'), mmap_mode=mmap)
+        self.idf = np.load(path('idf.npy'))
+
+        # Delta since the last compaction: new chunks get ordinals after the base
+        self.delta_chunks = []                 # (doc_id, chunk_index, length)
+        self.delta_keys = {}                   # (doc_id, chunk_index) -> ordinal
+        self.delta_postings = defaultdict(list)  # term -> [(ordinal, tf)]
+        self.deleted = set()                   # deleted ordinals (base or delta)
+        delta_name = self._delta_name()
+        if delta_name is not None:
+            with open(self._path(delta_name), 'rb') as f:
+                delta = pickle.load(f)
+            self.delta_chunks = delta['chunks']
+            self.delta_postings = defaultdict(list, delta['postings'])
+            self.deleted = delta['deleted']
+            base = self.meta['n_chunks']
+            self.delta_keys = {(d, c): base + i for i, (d, c, _) in enumerate(self.delta_chunks)}
+        self._average_idf = None
+
+    # ---- lookups -------------------------------------------------------
+
+    def _find_term(self, term):
+        """Binary search the sorted term blob; returns the term id or -1."""
+        target = term.encode('utf-8')
+        offsets = self.term_offsets
+        low, high = 0, len(offsets) - 1
+        while low < high:
+            mid = (low + high) // 2
+            value = self.terms[offsets[mid]:offsets[mid + 1]].tobytes()
+            if value < target:
+                low = mid + 1
+            elif value > target:
+                high = mid
+            else:
+                return mid
+        return -1
+
+    def ordinal(self, doc_id, chunk_index):
+        """Chunk ordinal for (doc_id, chunk_index), or -1 if absent or deleted."""
+        ordinal = self.delta_keys.get((doc_id, chunk_index), -1)
+        if ordinal < 0:
+            key = _chunk_key(doc_id, chunk_index)
+            pos = np.searchsorted(self.sorted_keys, key)
+            if pos < len(self.sorted_keys) and self.sorted_keys[pos] == key:
+                ordinal = int(self.key_order[pos])
+        return -1 if ordinal in self.deleted else ordinal
+
+    def _lengths(self):
+        base = np.asarray(self.chunks['length'], dtype=np.float32)
+        if not self.delta_chunks:
+            return base
+        return np.concatenate([base, np.array([length for _, _, length in self.delta_chunks], dtype=np.float32)])
+
+    def _stats(self):
+        """(live chunk count, average length) including the delta and deletions."""
+        n = self.meta['n_chunks'] + len(self.delta_chunks) - len(self.deleted)
+        total = self.meta['total_length'] + sum(length for _, _, length in self.delta_chunks)
+        if self.deleted:
+            total -= self._lengths()[list(self.deleted)].sum()
+        return n, (total / n if n else 0.0)
+
+    @property
+    def average_idf(self):
+        """Mean idf over every term of the live chunks, as _write_base computes it on compaction."""
+        if self._average_idf is not None:
+            return self._average_idf
+        if not self.delta_chunks and not self.deleted:
+            self._average_idf = self.meta['average_idf']
+            return self._average_idf
+        n, _ = self._stats()
+        df = np.diff(self.post_offsets).astype(np.float64)
+        deleted = np.fromiter(self.deleted, dtype=np.int64) if self.deleted else None
+        if deleted is not None and len(self.post_chunks):
+            dead = np.concatenate([[0], np.cumsum(np.isin(self.post_chunks, deleted))])
+            df -= dead[self.post_offsets[1:]] - dead[self.post_offsets[:-1]]
+        new_terms = []
+        for term, entries in self.delta_postings.items():
+            live = sum(1 for ordinal, _ in entries if ordinal not in self.deleted)
+            term_id = self._find_term(term)
+            if term_id >= 0:
+                df[term_id] += live
+            elif live:
+                new_terms.append(live)
+        df = np.concatenate([df[df > 0], np.array(new_terms, dtype=np.float64)])
+        idf = np.log(n - df + 0.5) - np.log(df + 0.5)
+        self._average_idf = float(idf.mean()) if len(idf) else 0.0
+        return self._average_idf
+
+    def _idf(self, df, n):
+        idf = np.log(n - df + 0.5) - np.log(df + 0.5)
+        return idf if idf >= 0 else self.epsilon * self.average_idf
+
+    def postings(self, term):
+        """(ordinals, tfs) of one term across the base and the delta, deletions removed."""
+        term_id = self._find_term(term)
+        parts_chunks, parts_tf = [], []
+        if term_id >= 0:
+            start, stop = self.post_offsets[term_id], self.post_offsets[term_id + 1]
+            parts_chunks.append(np.asarray(self.post_chunks[start:stop]))
+            parts_tf.append(np.asarray(self.post_tf[start:stop], dtype=np.float32))
+        if term in self.delta_postings:
+            delta = np.array(self.delta_postings[term], dtype=np.int64).reshape(-1, 2)
+            parts_chunks.append(delta[:, 0].astype(np.int32))
+            parts_tf.append(delta[:, 1].astype(np.float32))
+        if not parts_chunks:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32), term_id
+        ordinals, tfs = np.concatenate(parts_chunks), np.concatenate(parts_tf)
+        if self.deleted:
+            keep = ~np.isin(ordinals, np.fromiter(self.deleted, dtype=np.int64))
+            ordinals, tfs = ordinals[keep], tfs[keep]
+        return ordinals, tfs, term_id
+
+    # ---- scoring -------------------------------------------------------
+
+    def score_ordinals(self, query):
+        """Return (ordinals, scores) of every chunk matching at least one query term."""
+        clean = not self.delta_chunks and not self.deleted
+        n, avgdl = self._stats()
+        if n == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        lengths = None
+        all_ordinals, all_scores = [], []
+        for term, query_tf in Counter(tokenize(query)).items():
+            ordinals, tfs, term_id = self.postings(term)
+            if not len(ordinals):
+                continue
+            if lengths is None:
+                lengths = np.asarray(self.chunks['length'], dtype=np.float32) if clean else self._lengths()
+            # Precomputed idf is exact while the base is the whole index
+            idf = self.idf[term_id] if clean else self._idf(len(ordinals), n)
+            dl = lengths[ordinals]
+            scores = idf * tfs * (self.k1 + 1) / (tfs + self.k1 * (1 - self.b + self.b * dl / avgdl))
+            all_ordinals.append(ordinals)
+            all_scores.append(query_tf * scores)  # BM25Okapi counts repeated query terms again
+        if not all_ordinals:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        ordinals, inverse = np.unique(np.concatenate(all_ordinals), return_inverse=True)
+        return ordinals, np.bincount(inverse, weights=np.concatenate(all_scores)).astype(np.float32)
+
+    def _describe(self, ordinals):
+        base = self.meta['n_chunks']
+        doc_ids = np.empty(len(ordinals), dtype=np.int64)
+        chunk_indices = np.empty(len(ordinals), dtype=np.int64)
+        in_base = ordinals < base
+        doc_ids[in_base] = self.chunks['doc_id'][ordinals[in_base]]
+        chunk_indices[in_base] = self.chunks['chunk_index'][ordinals[in_base]]
+        for i in np.nonzero(~in_base)[0]:
+            doc_ids[i], chunk_indices[i], _ = self.delta_chunks[ordinals[i] - base]
+        return doc_ids, chunk_indices
+
+    def search(self, query, k=10):
+        """Top-k chunks for `query` as a list of (doc_id, chunk_index, score), best first."""
+        ordinals, scores = self.score_ordinals(query)
+        if not len(ordinals):
+            return []
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        doc_ids, chunk_indices = self._describe(ordinals[top])
+        return list(zip(doc_ids.tolist(), chunk_indices.tolist(), scores[top].tolist()))
+
+    def score_chunks(self, query, doc_ids, chunk_indices):
+        """BM25 scores of `query` for the given chunks (0 for chunks without query terms)."""
+        ordinals, scores = self.score_ordinals(query)
+        wanted = np.array([self.ordinal(int(d), int(c)) for d, c in zip(doc_ids, chunk_indices)], dtype=np.int64)
+        result = np.zeros(len(wanted), dtype=np.float32)
+        pos = np.searchsorted(ordinals, wanted)
+        found = (wanted >= 0) & (pos < len(ordinals))
+        found[found] = ordinals[pos[found]] == wanted[found]
+        result[found] = scores[pos[found]]
+        return result
+
+    # ---- updates -------------------------------------------------------
+
+    def add_chunk(self, doc_id, chunk_index, text):
+        """Index one chunk; re-adding an existing (doc_id, chunk_index) replaces it."""
+        self.delete_chunk(doc_id, chunk_index)
+        tokens = tokenize(text)
+        ordinal = self.meta['n_chunks'] + len(self.delta_chunks)
+        self.delta_chunks.append((doc_id, chunk_index, len(tokens)))
+        self.delta_keys[(doc_id, chunk_index)] = ordinal
+        for term, tf in Counter(tokens).items():
+            self.delta_postings[term].append((ordinal, tf))
+        self._average_idf = None
+        return ordinal
+
+    def add_document(self, doc_id, chunk_texts):
+        for chunk_index, text in enumerate(chunk_texts):
+            self.add_chunk(doc_id, chunk_index, text)
+
+    def delete_chunk(self, doc_id, chunk_index):
+        ordinal = self.ordinal(doc_id, chunk_index)
+        if ordinal >= 0:
+            self.deleted.add(ordinal)
+            self.delta_keys.pop((doc_id, chunk_index), None)
+            self._average_idf = None
+        return ordinal >= 0
+
+    def delete_document(self, doc_id):
+        """Delete every chunk of `doc_id`; returns the number removed."""
+        removed = 0
+        while self.delete_chunk(doc_id, removed):
+            removed += 1
+        return removed
+
+    def save(self, compact_ratio=0.2):
+        """Persist the delta, compacting into a new base once it is large."""
+        changed = len(self.delta_chunks) + len(self.deleted)
+        if changed > compact_ratio * max(1, self.meta['n_chunks']) or 'generation' not in self.meta:
+            # Indexes without generations are moved to the new layout by compacting them
+            self.compact()
+            return
+        sequence = self.meta.get('delta_sequence', 0) + 1
+        delta_name = f"delta.{self.meta['generation']}.{sequence}.pkl"
+        with open(self._path(delta_name), 'wb') as f:
+            pickle.dump({'chunks': self.delta_chunks, 'postings': dict(self.delta_postings),
+                         'deleted': self.deleted}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.meta = dict(self.meta, delta=delta_name, delta_sequence=sequence)
+        _write_json_atomic(self._path('meta.json'), self.meta)
+        self._remove_stale_files()
+
+    def compact(self):
+        """Rewrite base + delta - deletions as a new base segment."""
+        start_time = time.time()
+        base = self.meta['n_chunks']
+        chunks = [tuple(row) for row in np.asarray(self.chunks).tolist()] + list(self.delta_chunks)
+        postings = defaultdict(list)
+        for term_id in range(len(self.term_offsets) - 1):
+            term = self.terms[self.term_offsets[term_id]:self.term_offsets[term_id + 1]].tobytes().decode('utf-8')
+            start, stop = self.post_offsets[term_id], self.post_offsets[term_id + 1]
+            postings[term].extend(zip(self.post_chunks[start:stop].tolist(), self.post_tf[start:stop].tolist()))
+        for term, entries in self.delta_postings.items():
+            postings[term].extend(entries)
+
+        # Renumber live chunks densely
+        remap = np.full(len(chunks), -1, dtype=np.int64)
+        live = [i for i in range(len(chunks)) if i not in self.deleted]
+        remap[live] = np.arange(len(live))
+        chunks = [chunks[i] for i in live]
+        postings = {term: [(int(remap[o]), tf) for o, tf in entries if remap[o] >= 0]
+                    for term, entries in postings.items()}
+        postings = {term: entries for term, entries in postings.items() if entries}
+
+        self._write_base(chunks, postings, self.meta, self.meta.get('generation', 0) + 1)
+        self.load()
+        self._remove_stale_files()
+        print(f"Compacted BM25 index: {base} + delta -> {len(chunks)} chunks: {time.time() - start_time:.2f} seconds")
+
+    def _remove_stale_files(self):
+        """Delete base generations and delta files meta.json no longer points at."""
+        current_base = f"base.{self.meta['generation']}"
+        for name in os.listdir(self.index_dir):
+            path = self._path(name)
+            try:
+                if re.fullmatch(r'base\.\d+', name) and name != current_base:
+                    shutil.rmtree(path)
+                elif re.fullmatch(r'delta(\.\d+\.\d+)?\.pkl(\.tmp)?', name) and name != self.meta.get('delta'):
+                    os.remove(path)
+                elif name in base_files or re.fullmatch(r'.+\.tmp\.npy|terms\.bin\.tmp', name):
+                    # Base files of the layout without generations
+                    os.remove(path)
+            except OSError:
+                # Still mapped by a reader (Windows); removed after the next switch
+                pass
+
+    def _write_base(self, chunks, postings, params, generation=1):
+        """Write base generation `generation` from [(doc_id, chunk_index, length)] and {term: [(ordinal, tf)]}.
+
+        The new base has no delta; it becomes the index's base when meta.json is replaced, last.
+        """
+        chunk_table = np.array(chunks, dtype=chunk_table_dtype) if chunks else np.zeros(0, dtype=chunk_table_dtype)
+        n = len(chunk_table)
+        total_length = int(chunk_table['length'].sum())
+
+        terms = sorted(postings, key=lambda term: term.encode('utf-8'))
+        encoded = [term.encode('utf-8') for term in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(e) for e in encoded])
+        post_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        post_offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        flat = [entry for term in terms for entry in sorted(postings[term])]
+        post_chunks = np.array([o for o, _ in flat], dtype=np.int32)
+        post_tf = np.minimum(np.array([tf for _, tf in flat], dtype=np.int64), 65535).astype(np.uint16)
+
+        df = np.diff(post_offsets).astype(np.float64)
+        idf = np.log(n - df + 0.5) - np.log(df + 0.5) if len(df) else np.zeros(0)
+        average_idf = float(idf.mean()) if len(idf) else 0.0
+        idf = np.where(idf < 0, params['epsilon'] * average_idf, idf).astype(np.float32)
+
+        key_order = np.argsort(_chunk_key(chunk_table['doc_id'], chunk_table['chunk_index']), kind='stable')
+
+        base_dir = os.path.dirname(self._base_path('chunks.npy', generation))
+        # Left over by a compaction that crashed before switching to it
+        shutil.rmtree(base_dir, ignore_errors=True)
+        os.makedirs(base_dir)
+        path = lambda name: self._base_path(name, generation)
+        _save_array(path('chunks.npy'), chunk_table)
+        _save_array(path('key_order.npy'), key_order.astype(np.int64))
+        _save_array(path('term_offsets.npy'), term_offsets)
+        _save_array(path('post_offsets.npy'), post_offsets)
+        _save_array(path('post_chunks.npy'), post_chunks)
+        _save_array(path('post_tf.npy'), post_tf)
+        _save_array(path('idf.npy'), idf)
+        with open(path('terms.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+            f.flush()
+            os.fsync(f.fileno())
+
+        meta = {'k1': params['k1'], 'b': params['b'], 'epsilon': params['epsilon'],
+                'n_chunks': n, 'total_length': total_length, 'average_idf': average_idf,
+                'generation': generation, 'delta': None}
+        _write_json_atomic(self._path('meta.json'), meta)
+
+
+def build_from_store(store, pdf_folder, index_dir=bm25_folder, value_to_key_file='value_to_key.db'):
+    """Index every document of an EmbeddingStore by re-parsing its source text file.
+
+    The indexed texts are the same chunk strings the ingest pipeline embeds.
+    """
+    from symptom_parser import read_symptom_chunks
+
+    start_time = time.time()
+    index = BM25Index(index_dir)
+    with shelve.open(value_to_key_file, flag='r') as value_db:
+        for doc_id in store.doc_ids().tolist():
+            pdf_file = value_db.get(str(doc_id))
+            if pdf_file is None:
+                print(f"No mapping for doc_id {doc_id}\nSkipping document")
+                continue
+            chunk_strings, _ = read_symptom_chunks(os.path.join(pdf_folder, pdf_file))
+            index.add_document(doc_id, chunk_strings)
+    index.compact()
+    print(f"Indexed {index.meta['n_chunks']} chunks: {time.time() - start_time:.2f} seconds")
+    return index
+
+
+if __name__ == '__main__':
+    from embedding_store import EmbeddingStore, store_folder
+
+    pdf_folder = "D:/pyfiles/HumanDiseaseOntology-main/HumanDiseaseOntology-main/disease_symptoms"
+    if len(sys.argv) > 1:
+        pdf_folder = sys.argv[1]
+    build_from_store(EmbeddingStore(store_folder), pdf_folder)
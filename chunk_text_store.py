@@ -0,0 +1,227 @@
+"""
+Append-only store of chunk texts, so query-time snippets need no file opens.
+
+Layout of a store directory:
+
+    meta.json    committed chunk/document counts and text size in bytes
+    text.bin     UTF-8 text of every chunk, concatenated
+    offsets.bin  int64 byte offset of each chunk in text.bin (a chunk ends where the next begins)
+    docs.bin     doc offset table: (doc_id, row_start, n_rows), as in the embedding store
+
+Chunks of a document are contiguous, so (doc_id, chunk_index) resolves to
+its bytes with two array lookups. Appends follow the EmbeddingStoreWriter
+protocol: they become visible when meta.json is replaced on commit().
+"""
+import os
+import sys
+import json
+import time
+import shelve
+import numpy as np
+
+from embedding_store import _write_json_atomic, doc_dtype
+
+text_folder = 'chunk_text_store'
+
+
+def _paths(store_dir):
+    return {
+        'meta': os.path.join(store_dir, 'meta.json'),
+        'text': os.path.join(store_dir, 'text.bin'),
+        'offsets': os.path.join(store_dir, 'offsets.bin'),
+        'docs': os.path.join(store_dir, 'docs.bin'),
+    }
+
+
+def load_meta(store_dir=text_folder):
+    """Return the committed metadata of a store, or None if it does not exist."""
+    meta_path = _paths(store_dir)['meta']
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+class ChunkTextWriter:
+    """Appends documents' chunk texts; nothing is visible to readers until commit()."""
+
+    def __init__(self, store_dir=text_folder):
+        self.store_dir = store_dir
+        self.paths = _paths(store_dir)
+        os.makedirs(store_dir, exist_ok=True)
+
+        meta = load_meta(store_dir)
+        if meta is None:
+            meta = {'chunks': 0, 'docs': 0, 'bytes': 0}
+            for key in ('text', 'offsets', 'docs'):
+                open(self.paths[key], 'wb').close()
+            _write_json_atomic(self.paths['meta'], meta)
+        self.meta = meta
+
+        # Drop anything appended after the last commit (interrupted writer)
+        self._truncate(self.meta)
+        self.chunks = self.meta['chunks']
+        self.docs = self.meta['docs']
+        self.bytes = self.meta['bytes']
+        self.files = {key: open(self.paths[key], 'ab') for key in ('text', 'offsets', 'docs')}
+
+    def _truncate(self, meta):
+        sizes = {
+            'text': meta['bytes'],
+            'offsets': meta['chunks'] * 8,
+            'docs': meta['docs'] * doc_dtype.itemsize,
+        }
+        for key, size in sizes.items():
+            with open(self.paths[key], 'r+b') as f:
+                f.truncate(size)
+
+    def append_document(self, doc_id, texts):
+        """Append one document's chunk texts (in chunk_index order); returns its first row."""
+        encoded = [text.encode('utf-8') for text in texts]
+        offsets = self.bytes + np.concatenate([[0], np.cumsum([len(e) for e in encoded[:-1]], dtype=np.int64)]) \
+            if encoded else np.zeros(0, dtype=np.int64)
+        doc = np.array([(doc_id, self.chunks, len(encoded))], dtype=doc_dtype)
+
+        self.files['text'].write(b''.join(encoded))
+        self.files['offsets'].write(offsets.astype(np.int64).tobytes())
+        self.files['docs'].write(doc.tobytes())
+
+        row_start = self.chunks
+        self.chunks += len(encoded)
+        self.docs += 1
+        self.bytes += sum(len(e) for e in encoded)
+        return row_start
+
+    def commit(self):
+        """Make every appended document durable and visible to readers."""
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self.meta = {'chunks': self.chunks, 'docs': self.docs, 'bytes': self.bytes}
+        _write_json_atomic(self.paths['meta'], self.meta)
+
+    def rollback(self):
+        """Discard everything appended since the last commit."""
+        for f in self.files.values():
+            f.close()
+        self._truncate(self.meta)
+        self.chunks, self.docs, self.bytes = self.meta['chunks'], self.meta['docs'], self.meta['bytes']
+        self.files = {key: open(self.paths[key], 'ab') for key in ('text', 'offsets', 'docs')}
+
+    def rollback_to(self, meta):
+        """Discard everything after an earlier committed `meta` (a copy of self.meta), committed or not."""
+        self.meta = dict(meta)
+        _write_json_atomic(self.paths['meta'], self.meta)
+        self.rollback()
+
+    def close(self):
+        self.commit()
+        for f in self.files.values():
+            f.close()
+
+
+class ChunkTextStore:
+    """Read-only, memory-mapped view of the committed chunk texts."""
+
+    def __init__(self, store_dir=text_folder):
+        self.store_dir = store_dir
+        self.paths = _paths(store_dir)
+        self.refresh()
+
+    def refresh(self):
+        """Re-read meta.json and remap the files to pick up new commits."""
+        meta = load_meta(self.store_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No chunk text store found in {self.store_dir}.")
+        self.meta = meta
+        chunks, docs = meta['chunks'], meta['docs']
+
+        self.text = np.memmap(self.paths['text'], dtype=np.uint8, mode='r', shape=(meta['bytes'],)) \
+            if meta['bytes'] else np.zeros(0, dtype=np.uint8)
+        # Chunk i spans offsets[i]:offsets[i + 1]; the last one ends at meta['bytes']
+        self.offsets = np.memmap(self.paths['offsets'], dtype=np.int64, mode='r', shape=(chunks,)) \
+            if chunks else np.zeros(0, dtype=np.int64)
+        if docs:
+            self.docs = np.memmap(self.paths['docs'], dtype=doc_dtype, mode='r', shape=(docs,))
+        else:
+            self.docs = np.zeros(0, dtype=doc_dtype)
+
+        # Dense doc_id -> entry in the doc table; a re-appended doc_id points at its latest entry
+        size = int(self.docs['doc_id'].max()) + 1 if docs else 0
+        self.doc_index = np.full(size, -1, dtype=np.int64)
+        self.doc_index[self.docs['doc_id']] = np.arange(docs)
+
+    def __len__(self):
+        return self.meta['chunks']
+
+    def has_document(self, doc_id):
+        return 0 <= doc_id < len(self.doc_index) and self.doc_index[doc_id] >= 0
+
+    def _row(self, doc_id, chunk_index):
+        if not self.has_document(doc_id):
+            raise KeyError(f"Document {doc_id} is not in the chunk text store.")
+        entry = self.docs[self.doc_index[doc_id]]
+        if not 0 <= chunk_index < entry['n_rows']:
+            raise IndexError(f"Chunk {chunk_index} out of range for document {doc_id}.")
+        return int(entry['row_start']) + chunk_index
+
+    def get_text(self, doc_id, chunk_index):
+        """Return the text of one (doc_id, chunk_index)."""
+        row = self._row(doc_id, chunk_index)
+        end = self.offsets[row + 1] if row + 1 < self.meta['chunks'] else self.meta['bytes']
+        return self.text[self.offsets[row]:end].tobytes().decode('utf-8')
+
+    def get_texts(self, doc_ids, chunk_indices):
+        """Texts of several chunks; None for chunks that are not stored."""
+        texts = []
+        for doc_id, chunk_index in zip(doc_ids, chunk_indices):
+            try:
+                texts.append(self.get_text(int(doc_id), int(chunk_index)))
+            except (KeyError, IndexError):
+                texts.append(None)
+        return texts
+
+    def get_document(self, doc_id):
+        """All chunk texts of one document, in chunk_index order."""
+        entry = self.docs[self.doc_index[doc_id]] if self.has_document(doc_id) else None
+        if entry is None:
+            raise KeyError(f"Document {doc_id} is not in the chunk text store.")
+        return [self.get_text(doc_id, i) for i in range(int(entry['n_rows']))]
+
+
+def build_from_store(store, pdf_folder, store_dir=text_folder, value_to_key_file='value_to_key.db', commit_every=500):
+    """Fill a chunk text store from the source files of an EmbeddingStore's documents.
+
+    Documents already in the text store are skipped, so the build can be resumed.
+    """
+    start_time = time.time()
+    writer = ChunkTextWriter(store_dir)
+    existing = ChunkTextStore(store_dir)
+    added = 0
+    with shelve.open(value_to_key_file, flag='r') as value_db:
+        for doc_id in store.doc_ids().tolist():
+            if existing.has_document(doc_id):
+                continue
+            pdf_file = value_db.get(str(doc_id))
+            if pdf_file is None:
+                print(f"No mapping for doc_id {doc_id}\nSkipping document")
+                continue
+            with open(os.path.join(pdf_folder, pdf_file), "r", encoding="utf-8") as file:
+                text = file.read()
+            chunks, _ = store.get_document(doc_id)
+            writer.append_document(doc_id, [text[c['start_id']:c['end_id']] for c in chunks])
+            added += 1
+            if added % commit_every == 0:
+                writer.commit()
+    writer.close()
+    print(f"Stored texts of {added} documents ({writer.chunks} chunks): {time.time() - start_time:.2f} seconds")
+    return added
+
+
+if __name__ == '__main__':
+    from embedding_store import EmbeddingStore, store_folder
+
+    pdf_folder = "D:/pyfiles/HumanDiseaseOntology-main/HumanDiseaseOntology-main/disease_symptoms"
+    if len(sys.argv) > 1:
+        pdf_folder = sys.argv[1]
+    build_from_store(EmbeddingStore(store_folder), pdf_folder)
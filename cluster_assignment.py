@@ -0,0 +1,452 @@
+"""
+Self-splitting cluster tree over the chunk embeddings in clusters/.
+
+Each node is one record in clusters/cluster_{id}.memmap (member slots,
+centroid, children), the layout create_single_cluster_entry always wrote.
+Leaves hold up to max_chunks_per_cluster (doc_id, chunk_index) members;
+internal nodes hold no members and list up to 10 child IDs in `children`
+(0 = none; float32 holds IDs exactly up to 2**24). Every node's centroid is
+the mean of all chunks below it, kept from running sums and counts in
+centroid_state.npz, so it routes both inserts and queries.
+
+Adding a document descends from the root one level at a time, sending each
+chunk to its nearest child (one distance matrix per visited node), then
+appends the chunks to their leaves. A leaf that would overflow is split
+with k-means into `branching` child leaves (again if a child is still too
+full), so no chunk is ever dropped and depth grows with log(corpus size).
+Queries keep the `beam_width` nearest nodes per level and return the
+members of the leaves they end on.
+
+An empty tree can also be bulk loaded with finished leaves (recluster.py
+rebuilds the whole tree offline that way); the leaves are grouped under
+parents of at most 10 children by k-means over their centroids.
+
+Inserting a document is idempotent, so an interrupted ingest can simply be
+applied again: the state lists the inserted doc IDs and is saved (atomically)
+last, slots past a leaf's filled count are overwritten by the retry, and a
+split parent's old slots are only cleared once the state no longer refers
+to them.
+"""
+import os
+import re
+import time
+import numpy as np
+
+cluster_folder = 'clusters'
+documents_folder = 'documents4'
+state_file = 'centroid_state.npz'
+
+cluster_file_pattern = re.compile(r'cluster_(\d+)\.memmap$')
+
+max_children = 10
+
+
+def cluster_dtype(max_chunks_per_cluster=1000, embedding_dim=1024):
+    return np.dtype([
+        ('id', 'i4'),
+        ('chunks', [('doc_id', 'i4'), ('chunk_index', 'i4')], max_chunks_per_cluster),
+        ('centroid', 'f4', (embedding_dim,)),
+        ('children', 'f4', (max_children,)),
+    ])
+
+
+def squared_distances(embeddings, centroids):
+    """(n, k) squared Euclidean distances, up to a per-row constant."""
+    return (centroids ** 2).sum(axis=1)[None, :] - 2.0 * (embeddings @ centroids.T)
+
+
+def kmeans(embeddings, k, iterations=10, seed=0):
+    """Labels of a k-means++ seeded Lloyd's k-means over the rows of `embeddings`."""
+    rng = np.random.default_rng(seed)
+    centers = [embeddings[rng.integers(len(embeddings))]]
+    closest = ((embeddings - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        if closest.sum() <= 0:
+            break
+        centers.append(embeddings[rng.choice(len(embeddings), p=closest / closest.sum())])
+        closest = np.minimum(closest, ((embeddings - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+    labels = squared_distances(embeddings, centers).argmin(axis=1)
+    for _ in range(iterations):
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, embeddings)
+        keep = counts > 0
+        centers = sums[keep] / counts[keep, None]
+        new_labels = squared_distances(embeddings, centers).argmin(axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return np.unique(labels, return_inverse=True)[1]
+
+
+def balanced_groups(embeddings, k, seed=0):
+    """Labels of k groups of at most ceil(n / k) rows each, around k-means centers.
+
+    (row, center) pairs are taken closest first, so each row joins the nearest
+    center that still has room.
+    """
+    labels = kmeans(embeddings, k, seed=seed)
+    centers = np.array([embeddings[labels == label].mean(axis=0) for label in range(labels.max() + 1)])
+    if len(centers) < k:
+        # Fewer distinct groups than asked for (e.g. identical rows): pad with random rows
+        rng = np.random.default_rng(seed)
+        centers = np.vstack([centers, embeddings[rng.choice(len(embeddings), k - len(centers), replace=False)]])
+    distances = squared_distances(embeddings, centers)
+    room = np.full(k, -(-len(embeddings) // k), dtype=np.int64)
+    labels = np.full(len(embeddings), -1, dtype=np.int64)
+    for row, center in zip(*np.unravel_index(np.argsort(distances, axis=None, kind='stable'), distances.shape)):
+        if labels[row] < 0 and room[center] > 0:
+            labels[row] = center
+            room[center] -= 1
+    return labels
+
+
+class ClusterTree:
+    """Hierarchical nearest-centroid index over chunk embeddings.
+
+    Args:
+        folder (str): Directory holding cluster_{id}.memmap files.
+        max_chunks_per_cluster (int): Member slots per leaf.
+        embedding_dim (int): Embedding size.
+        documents_dir (str): Document memmaps, read when a leaf is split or the state is rebuilt.
+        branching (int): Children created per split (at most 10).
+    """
+
+    def __init__(self, folder=cluster_folder, max_chunks_per_cluster=1000, embedding_dim=1024,
+                 documents_dir=documents_folder, branching=4):
+        self.folder = folder
+        self.max_chunks = max_chunks_per_cluster
+        self.embedding_dim = embedding_dim
+        self.documents_dir = documents_dir
+        self.branching = min(branching, max_children)
+        self.dtype = cluster_dtype(max_chunks_per_cluster, embedding_dim)
+        os.makedirs(folder, exist_ok=True)
+        state = np.load(self._path(state_file)) if os.path.exists(self._path(state_file)) else None
+        if state is not None and 'children' in state:
+            self.ids, self.used, self.counts, self.sums, self.children = (
+                state[k] for k in ('ids', 'used', 'counts', 'sums', 'children'))
+            self.root = int(state['root']) if state['root'] >= 0 else None
+            self.doc_ids = state['doc_ids'] if 'doc_ids' in state else np.zeros(0, dtype=np.int64)
+        else:
+            # Missing, or written by the flat assigner before clusters were split into a tree
+            self.rebuild_state()
+        self.positions = {cluster_id: i for i, cluster_id in enumerate(self.ids.tolist())}
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def cluster_file(self, cluster_id):
+        return self._path(f'cluster_{cluster_id}.memmap')
+
+    def _open(self, cluster_id, mode='r+'):
+        return np.memmap(self.cluster_file(cluster_id), dtype=self.dtype, mode=mode, shape=(1,))
+
+    def _member_embeddings(self, members):
+        """Embeddings of (doc_id, chunk_index) members, read once per document."""
+        doc_dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (self.embedding_dim,))]
+        embeddings = np.zeros((len(members), self.embedding_dim), dtype=np.float32)
+        for doc_id in np.unique(members['doc_id']):
+            rows = np.nonzero(members['doc_id'] == doc_id)[0]
+            document = np.memmap(os.path.join(self.documents_dir, f'{doc_id}.npy'), dtype=doc_dtype, mode='r')
+            embeddings[rows] = document['embedding'][members['chunk_index'][rows]]
+        return embeddings
+
+    def rebuild_state(self):
+        """Recompute slots, children and subtree sums from the cluster files and member documents."""
+        start_time = time.time()
+        ids = sorted(int(m.group(1)) for m in map(cluster_file_pattern.match, os.listdir(self.folder)) if m)
+        n = len(ids)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.positions = {cluster_id: i for i, cluster_id in enumerate(ids)}
+        self.used = np.zeros(n, dtype=np.int64)
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.sums = np.zeros((n, self.embedding_dim), dtype=np.float64)
+        self.children = np.zeros((n, max_children), dtype=np.int64)
+        doc_ids = [np.zeros(0, dtype=np.int64)]
+        for i, cluster_id in enumerate(ids):
+            record = self._open(cluster_id, 'r')
+            self.children[i] = record['children'][0].astype(np.int64)
+            if self.children[i].any():
+                # Internal node: slots left over from an interrupted split are stale copies
+                continue
+            members = np.array(record['chunks'][0])
+            filled = np.nonzero(members['doc_id'] != 0)[0]  # 0 means an unused slot
+            # New members are appended after the last filled slot
+            self.used[i] = filled[-1] + 1 if len(filled) else 0
+            members = members[filled]
+            self.counts[i] = len(members)
+            self.sums[i] = self._member_embeddings(members).sum(axis=0, dtype=np.float64)
+            doc_ids.append(members['doc_id'].astype(np.int64))
+        self.doc_ids = np.unique(np.concatenate(doc_ids))
+
+        # Roots are nodes nobody lists as a child; several (a flat layout) get a common parent
+        listed = set(self.children[self.children > 0].tolist())
+        roots = [cluster_id for cluster_id in ids if cluster_id not in listed]
+        if len(roots) > max_children:
+            raise ValueError(f"{len(roots)} unlinked clusters in {self.folder}; at most {max_children} can be joined")
+        self.root = roots[0] if len(roots) == 1 else None
+        if self.root is None and n:
+            position = self.create_cluster()
+            self.children[position, :len(roots)] = roots
+            self._write_children(position)
+            self.root = int(self.ids[position])
+        # Subtree totals, children before parents
+        for position in self._postorder():
+            for child in self.children[position][self.children[position] > 0].tolist():
+                self.counts[position] += self.counts[self.positions[child]]
+                self.sums[position] += self.sums[self.positions[child]]
+        self.save()
+        print(f"Rebuilt cluster tree state of {len(self.ids)} clusters: {time.time() - start_time:.2f} seconds")
+
+    def _postorder(self):
+        if self.root is None:
+            return []
+        order, stack = [], [self.positions[self.root]]
+        while stack:
+            position = stack.pop()
+            order.append(position)
+            stack.extend(self.positions[c] for c in self.children[position][self.children[position] > 0].tolist())
+        return order[::-1]
+
+    def save(self):
+        tmp_path = self._path(state_file + '.tmp.npz')
+        np.savez(tmp_path, ids=self.ids, used=self.used, counts=self.counts, sums=self.sums,
+                 children=self.children, root=-1 if self.root is None else self.root, doc_ids=self.doc_ids)
+        os.replace(tmp_path, self._path(state_file))
+
+    def has_document(self, doc_id):
+        position = np.searchsorted(self.doc_ids, doc_id)
+        return position < len(self.doc_ids) and self.doc_ids[position] == doc_id
+
+    def is_leaf(self, position):
+        return not self.children[position].any()
+
+    def child_positions(self, position):
+        return np.array([self.positions[c] for c in self.children[position][self.children[position] > 0].tolist()],
+                        dtype=np.int64)
+
+    def centroids(self, positions):
+        """float32 centroids of node positions; nodes without chunks keep their stored centroid."""
+        positions = np.asarray(positions, dtype=np.int64)
+        centroids = np.zeros((len(positions), self.embedding_dim), dtype=np.float32)
+        counts = self.counts[positions]
+        filled = counts > 0
+        centroids[filled] = self.sums[positions[filled]] / counts[filled, None]
+        for i in np.nonzero(~filled)[0]:
+            centroids[i] = self._open(self.ids[positions[i]], 'r')['centroid'][0]
+        return centroids
+
+    def create_cluster(self, centroid=None):
+        """Append an empty leaf file and return its position in self.ids."""
+        cluster_id = int(self.ids.max()) + 1 if len(self.ids) else 1
+        record = self._open(cluster_id, 'w+')
+        record['id'] = cluster_id
+        if centroid is not None:
+            record['centroid'][0] = centroid
+        record.flush()
+        self.ids = np.append(self.ids, cluster_id)
+        self.positions[cluster_id] = len(self.ids) - 1
+        self.used = np.append(self.used, 0)
+        self.counts = np.append(self.counts, 0)
+        self.sums = np.vstack([self.sums, np.zeros((1, self.embedding_dim))])
+        self.children = np.vstack([self.children, np.zeros((1, max_children), dtype=np.int64)])
+        return len(self.ids) - 1
+
+    def _write_children(self, position):
+        record = self._open(self.ids[position])
+        record['children'][0] = self.children[position].astype(np.float32)
+        record.flush()
+
+    def _write_leaf(self, position, members, embeddings, append=True):
+        """Store members in a leaf (after its filled slots, or replacing them) and refresh its centroid."""
+        record = self._open(self.ids[position])
+        start = self.used[position] if append else 0
+        if not append:
+            record['chunks'][0] = np.zeros(self.max_chunks, dtype=self.dtype['chunks'].base)
+        record['chunks'][0, start:start + len(members)] = members
+        self.used[position] = start + len(members)
+        if not append:
+            self.counts[position] = len(members)
+            self.sums[position] = embeddings.sum(axis=0, dtype=np.float64)
+        if self.counts[position]:
+            record['centroid'][0] = self.sums[position] / self.counts[position]
+        record.flush()
+
+    def _split(self, position, members, embeddings):
+        """Turn a leaf into the parent of `branching` leaves sharing `members` (recursing on full ones)."""
+        labels = kmeans(embeddings, min(self.branching, len(members)))
+        if labels.max() == 0:
+            # Identical vectors: split by position so each part is smaller than the whole
+            labels = np.arange(len(members)) * self.branching // len(members)
+        children = []
+        for label in range(labels.max() + 1):
+            rows = np.nonzero(labels == label)[0]
+            child = self.create_cluster()
+            children.append(int(self.ids[child]))
+            if len(rows) > self.max_chunks:
+                self.counts[child] = len(rows)
+                self.sums[child] = embeddings[rows].sum(axis=0, dtype=np.float64)
+                self._split(child, members[rows], embeddings[rows])
+            else:
+                self._write_leaf(child, members[rows], embeddings[rows], append=False)
+        # The node keeps its subtree totals; its slots move to the children and are
+        # cleared after the state is saved, so a retry can still read them
+        record = self._open(self.ids[position])
+        record['centroid'][0] = self.sums[position] / max(self.counts[position], 1)
+        record.flush()
+        self.used[position] = 0
+        self._split_nodes.append(position)
+        self.children[position, :len(children)] = children
+        self._write_children(position)
+
+    def add_document(self, doc_id, embeddings):
+        """Insert the chunks of one document (row i = chunk_index i).
+
+        Returns:
+            dict: {leaf cluster_id: number of chunks added}, before any split of that leaf;
+            empty when the document is already in the tree.
+        """
+        start_time = time.time()
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.embedding_dim)
+        if doc_id == 0:
+            # doc_id 0 marks an unused slot in the cluster files
+            print("Document ID 0 cannot be stored in a cluster; skipping")
+            return {}
+        if not len(embeddings) or self.has_document(doc_id):
+            return {}
+        self._split_nodes = []
+        if self.root is None:
+            position = self.create_cluster()
+            self.root = int(self.ids[position])
+
+        members = np.zeros(len(embeddings), dtype=self.dtype['chunks'].base)
+        members['doc_id'] = doc_id
+        members['chunk_index'] = np.arange(len(embeddings))
+        positions = np.full(len(embeddings), self.positions[self.root], dtype=np.int64)
+        # Descend level by level; every visited node absorbs the chunks into its totals
+        while True:
+            internal = [p for p in np.unique(positions).tolist() if not self.is_leaf(p)]
+            if not internal:
+                break
+            for position in internal:
+                rows = np.nonzero(positions == position)[0]
+                self.counts[position] += len(rows)
+                self.sums[position] += embeddings[rows].sum(axis=0, dtype=np.float64)
+                children = self.child_positions(position)
+                nearest = squared_distances(embeddings[rows], self.centroids(children)).argmin(axis=1)
+                positions[rows] = children[nearest]
+
+        added = {}
+        for position in np.unique(positions).tolist():
+            rows = np.nonzero(positions == position)[0]
+            added[int(self.ids[position])] = len(rows)
+            self.counts[position] += len(rows)
+            self.sums[position] += embeddings[rows].sum(axis=0, dtype=np.float64)
+            if self.used[position] + len(rows) <= self.max_chunks:
+                self._write_leaf(position, members[rows], embeddings[rows])
+            else:
+                record = np.array(self._open(self.ids[position], 'r')['chunks'][0, :self.used[position]])
+                old = record[record['doc_id'] != 0]
+                self._split(position, np.concatenate([old, members[rows]]),
+                            np.vstack([self._member_embeddings(old), embeddings[rows]]))
+        self.doc_ids = np.insert(self.doc_ids, np.searchsorted(self.doc_ids, doc_id), doc_id)
+        self.save()
+        for position in self._split_nodes:
+            record = self._open(self.ids[position])
+            record['chunks'][0] = np.zeros(self.max_chunks, dtype=self.dtype['chunks'].base)
+            record.flush()
+        print(f"Assigned {len(embeddings)} chunks of document {doc_id} to {len(added)} clusters: "
+              f"{time.time() - start_time:.4f} seconds")
+        return added
+
+    def bulk_load(self, leaves, leaf_sums):
+        """Fill an empty tree with finished leaves and link them under new parents.
+
+        Args:
+            leaves (list): One array of (doc_id, chunk_index) members per leaf, each
+                at most max_chunks_per_cluster long.
+            leaf_sums (np.ndarray): (len(leaves), embedding_dim) sum of each leaf's member embeddings.
+        """
+        start_time = time.time()
+        if len(self.ids):
+            raise ValueError(f"{self.folder} already holds {len(self.ids)} clusters")
+        counts = [len(members) for members in leaves]
+        sums = [np.asarray(total, dtype=np.float64) for total in leaf_sums]
+        parents = {}
+
+        def link(positions):
+            # Groups of more than max_children are split into equal-sized groups of nearby centroids first
+            if len(positions) == 1:
+                return positions[0]
+            if len(positions) > max_children:
+                centroids = np.array([sums[p] / max(counts[p], 1) for p in positions], dtype=np.float32)
+                labels = balanced_groups(centroids, min(max_children, max(self.branching,
+                                                                          -(-len(positions) // max_children))))
+                positions = [link([positions[i] for i in np.nonzero(labels == label)[0]])
+                             for label in np.unique(labels).tolist()]
+            parent = len(counts)
+            counts.append(sum(counts[p] for p in positions))
+            sums.append(np.sum([sums[p] for p in positions], axis=0))
+            parents[parent] = positions
+            return parent
+
+        root = link(list(range(len(leaves)))) if leaves else None
+        n = len(counts)
+        self.ids = np.arange(1, n + 1, dtype=np.int64)
+        self.positions = {cluster_id: i for i, cluster_id in enumerate(self.ids.tolist())}
+        self.used = np.array(counts[:len(leaves)] + [0] * (n - len(leaves)), dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.sums = np.array(sums, dtype=np.float64).reshape(n, self.embedding_dim)
+        self.children = np.zeros((n, max_children), dtype=np.int64)
+        for parent, positions in parents.items():
+            self.children[parent, :len(positions)] = self.ids[positions]
+        for position in range(n):
+            record = self._open(self.ids[position], 'w+')
+            record['id'] = self.ids[position]
+            if position < len(leaves):
+                record['chunks'][0, :len(leaves[position])] = leaves[position]
+            record['centroid'][0] = self.sums[position] / max(self.counts[position], 1)
+            record['children'][0] = self.children[position].astype(np.float32)
+            record.flush()
+        self.root = int(self.ids[root]) if root is not None else None
+        self.doc_ids = (np.unique(np.concatenate([members['doc_id'] for members in leaves]).astype(np.int64))
+                        if leaves else np.zeros(0, dtype=np.int64))
+        self.save()
+        print(f"Bulk loaded {len(leaves)} leaves under {n - len(leaves)} parents: "
+              f"{time.time() - start_time:.2f} seconds")
+
+    def depth(self):
+        """Number of levels from the root to the deepest leaf."""
+        if self.root is None:
+            return 0
+        depth, level = 0, [self.positions[self.root]]
+        while level:
+            depth += 1
+            level = [c for p in level for c in self.child_positions(p).tolist()]
+        return depth
+
+    def search_leaves(self, query_embedding, beam_width=4):
+        """Cluster IDs of the leaves a beam search for `query_embedding` ends on."""
+        if self.root is None:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
+        frontier = np.array([self.positions[self.root]], dtype=np.int64)
+        while not all(self.is_leaf(p) for p in frontier.tolist()):
+            expanded = np.concatenate([self.child_positions(p) if not self.is_leaf(p) else [p]
+                                       for p in frontier.tolist()]).astype(np.int64)
+            distances = squared_distances(query, self.centroids(expanded))[0]
+            frontier = expanded[np.argsort(distances, kind='stable')[:beam_width]]
+        return [int(self.ids[p]) for p in frontier.tolist()]
+
+    def members(self, cluster_ids):
+        """Filled (doc_id, chunk_index) slots of several leaves, concatenated."""
+        parts = []
+        for cluster_id in cluster_ids:
+            chunks = np.array(self._open(cluster_id, 'r')['chunks'][0, :self.used[self.positions[cluster_id]]])
+            parts.append(chunks[chunks['doc_id'] != 0])
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=self.dtype['chunks'].base)
+
+    def search_members(self, query_embedding, beam_width=4):
+        """Candidate members for a query: the members of the leaves the beam search reaches."""
+        return self.members(self.search_leaves(query_embedding, beam_width))
@@ -0,0 +1,184 @@
+"""
+Multi-symptom diagnosis over the compiled symptom dictionary.
+
+Every disease is treated as a document whose terms are its symptoms, and a
+query is a list of patient symptoms. Each symptom with synonyms forms one
+concept whose postings are the union of their disease lists, and a synonym
+queried on its own resolves to the concept of the symptom that lists it, so
+"joint pain" and "arthralgia" count once. A disease matching a concept gets
+that concept's BM25 weight (binary term frequency, length-normalized by the
+disease's symptom count). Concept postings and their weights are built once
+with array operations when the engine is created.
+
+Top-k uses max-score pruning: concepts are processed by decreasing upper
+bound, and once the k-th best score beats the bound of the remaining
+concepts, new diseases can no longer enter the top k. From then on the
+remaining postings are only intersected with the current candidates.
+"""
+import os
+import threading
+from typing import NamedTuple
+import numpy as np
+
+from symptom_dictionary import SymptomDictionary, dictionary_folder
+from fuzzy_symptom_index import FuzzySymptomIndex, fuzzy_folder
+
+
+class Diagnosis(NamedTuple):
+    """One ranked disease; `matched` lists the query symptoms it has."""
+    disease_id: int
+    disease_name: str
+    score: float
+    matched: list
+
+
+class DiagnosisEngine:
+    """Ranks diseases for a list of symptoms.
+
+    Args:
+        dictionary (SymptomDictionary): Compiled dictionary; loaded from dict_dir when None.
+        k1, b: BM25 parameters (b scales the disease symptom-count normalization).
+        fuzzy (FuzzySymptomIndex): Resolves misspelled symptom names; exact names only when None.
+    """
+
+    def __init__(self, dictionary=None, dict_dir=dictionary_folder, k1=1.2, b=0.75, fuzzy=None):
+        self.dictionary = dictionary or SymptomDictionary(dict_dir)
+        self.fuzzy = fuzzy
+        self.k1 = k1
+        self.b = b
+        offsets = np.asarray(self.dictionary.disease_symptoms[0])
+        lengths = np.diff(offsets).astype(np.float32)
+        self.n_diseases = int(np.count_nonzero(lengths))
+        average = lengths[lengths > 0].mean() if self.n_diseases else 1.0
+        # BM25 weight of a matched symptom with tf = 1, without the idf factor
+        self.norm = ((k1 + 1) / (1 + k1 * (1 - b + b * lengths / average))).astype(np.float32)
+        self._build_concepts()
+
+    def _build_concepts(self):
+        """Concept CSR (symptom -> diseases of it and its synonyms) with per-posting weights."""
+        disease_offsets, disease_ids = (np.asarray(a) for a in self.dictionary.symptom_diseases)
+        synonym_offsets, synonym_ids = (np.asarray(a) for a in self.dictionary.synonym_links)
+        n_symptoms = len(disease_offsets) - 1
+        n_diseases = len(self.norm)
+        symptoms = np.arange(n_symptoms, dtype=np.int64)
+        counts = np.diff(disease_offsets)
+
+        # A symptom without synonyms of its own maps to the first symptom listing it as a synonym
+        link_rows = np.repeat(symptoms, np.diff(synonym_offsets))
+        self.canonical = symptoms.copy()
+        own = np.diff(synonym_offsets) > 0
+        order = np.lexsort((link_rows, synonym_ids))
+        first = order[np.r_[True, synonym_ids[order][1:] != synonym_ids[order][:-1]]] if len(order) else order
+        first = first[~own[synonym_ids[first]]]
+        self.canonical[synonym_ids[first]] = link_rows[first]
+
+        # Diseases of each synonym, attributed to the listing symptom
+        link_counts = counts[synonym_ids]
+        rows = np.repeat(link_rows, link_counts)
+        starts = np.repeat(disease_offsets[synonym_ids], link_counts)
+        within = np.arange(link_counts.sum()) - np.repeat(np.cumsum(link_counts) - link_counts, link_counts)
+        rows = np.concatenate([np.repeat(symptoms, counts), rows])
+        diseases = np.concatenate([disease_ids, disease_ids[starts + within]]).astype(np.int64)
+        keys = np.unique(rows * n_diseases + diseases)
+        rows, self.concept_ids = keys // n_diseases, keys % n_diseases
+
+        self.concept_offsets = np.zeros(n_symptoms + 1, dtype=np.int64)
+        self.concept_offsets[1:] = np.cumsum(np.bincount(rows, minlength=n_symptoms))
+        df = np.diff(self.concept_offsets)
+        self.concept_weights = (self.idf(df)[rows] * self.norm[self.concept_ids]).astype(np.float32)
+        # Largest posting weight per concept, the bound used for pruning
+        self.upper_bounds = np.zeros(n_symptoms, dtype=np.float32)
+        np.maximum.at(self.upper_bounds, rows, self.concept_weights)
+
+    def resolve(self, symptom):
+        """Concept ID of a symptom name (case-insensitive, fuzzy if enabled) or symptom ID, or -1."""
+        if isinstance(symptom, (int, np.integer)):
+            symptom_id = int(symptom)
+        elif self.fuzzy is not None:
+            symptom_id = self.fuzzy.resolve(symptom)
+        else:
+            symptom_id = self.dictionary.symptom_id(symptom.strip().lower())
+        if not 0 <= symptom_id < len(self.canonical):
+            return -1
+        return int(self.canonical[symptom_id])
+
+    def concept_postings(self, concept_id):
+        """(sorted disease IDs, weights) of a concept."""
+        start, stop = self.concept_offsets[concept_id], self.concept_offsets[concept_id + 1]
+        return self.concept_ids[start:stop], self.concept_weights[start:stop]
+
+    def idf(self, df):
+        return np.log1p((self.n_diseases - df + 0.5) / (df + 0.5))
+
+    def diagnose(self, symptoms, k=10):
+        """Top-k diseases for a list of symptom names (or IDs), best first.
+
+        Unknown symptoms are ignored; see resolve() to check them up front.
+        """
+        concepts = []
+        seen = set()
+        for symptom in symptoms:
+            concept_id = self.resolve(symptom)
+            if concept_id < 0 or concept_id in seen:
+                continue
+            seen.add(concept_id)
+            postings, weights = self.concept_postings(concept_id)
+            if len(postings):
+                concepts.append((float(self.upper_bounds[concept_id]), symptom, postings, weights))
+        if not concepts:
+            return []
+
+        concepts.sort(key=lambda c: -c[0])
+        remaining = np.cumsum([c[0] for c in concepts][::-1])[::-1]
+        candidates = np.zeros(0, dtype=np.int64)
+        scores = np.zeros(0, dtype=np.float32)
+        for j, (_, _, postings, weights) in enumerate(concepts):
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k] if len(scores) >= k else -np.inf
+            if threshold >= remaining[j]:
+                # Diseases not yet seen cannot reach the top k: score the candidates only
+                pos = np.searchsorted(postings, candidates)
+                pos[pos == len(postings)] = 0
+                hit = postings[pos] == candidates
+                scores[hit] += weights[pos[hit]]
+                # Drop candidates that cannot reach the k-th score any more
+                rest = remaining[j + 1] if j + 1 < len(remaining) else 0.0
+                keep = scores + rest >= threshold
+                candidates, scores = candidates[keep], scores[keep]
+            else:
+                merged = np.union1d(candidates, postings)
+                merged_scores = np.zeros(len(merged), dtype=np.float32)
+                merged_scores[np.searchsorted(merged, candidates)] = scores
+                merged_scores[np.searchsorted(merged, postings)] += weights
+                candidates, scores = merged, merged_scores
+
+        top = np.argsort(-scores, kind='stable')[:k]
+        top_ids = candidates[top]
+        membership = [np.isin(top_ids, postings, assume_unique=True) for _, _, postings, _ in concepts]
+        results = []
+        for i, disease_id in enumerate(top_ids.tolist()):
+            matched = [c[1] for c, member in zip(concepts, membership) if member[i]]
+            results.append(Diagnosis(disease_id, self.dictionary.disease_name(disease_id), float(scores[top[i]]), matched))
+        return results
+
+    def diagnose_many(self, queries, k=10):
+        return [self.diagnose(symptoms, k) for symptoms in queries]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_diagnosis_engine():
+    """The process-wide DiagnosisEngine, created on first use.
+
+    Misspelled symptoms are resolved when fuzzy_symptom_index.py has been run.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            dictionary = SymptomDictionary(dictionary_folder)
+            fuzzy = None
+            if os.path.exists(os.path.join(fuzzy_folder, 'meta.json')):
+                fuzzy = FuzzySymptomIndex(fuzzy_folder, dictionary)
+            _engine = DiagnosisEngine(dictionary, fuzzy=fuzzy)
+        return _engine
@@ -1,29 +1,37 @@
-import fitz  # PyMuPDF
 import numpy as np
 import os
-import torch
 import pickle
 import json
 import time
-from sklearn.cluster import KMeans
 import re
-from rank_bm25 import BM25Okapi
+import threading
+from typing import NamedTuple
+
+from model_provider import get_model_provider
+from symptom_parser import parse_symptoms_as_strings_with_indices, read_symptom_chunks
+from embedding_store import EmbeddingStore, chunk_dtype, store_folder
+from vector_search import search_chunks, search_store
+from ivf_index import IVFIndex, ivf_folder
+from hnsw_index import HNSWIndex, hnsw_folder
+from quantized_store import QuantizedStore, quantized_folder
+from bm25_index import BM25Index, bm25_folder
+from hybrid_fusion import chunk_keys, split_keys, fuse
+from chunk_text_store import ChunkTextStore, text_folder
+from mapping_service import get_mapping_service
+from cluster_assignment import ClusterTree, cluster_folder, state_file
+from diagnosis_engine import get_diagnosis_engine
+from fuzzy_symptom_index import find_symptoms
+from symptom_normalizer import SymptomNormalizer, normalizer_folder
+from query_embedding_cache import QueryEmbeddingCache, model_fingerprint, query_cache_file
 
-from transformers import AutoTokenizer, AutoModel, AutoModelForSequenceClassification
-
-# Load model from HuggingFace Hub
-tokenizer = AutoTokenizer.from_pretrained('BAAI/bge-m3')
-model = AutoModel.from_pretrained('BAAI/bge-m3')
-model.eval()
 max_seq_length = 8192
 
-# Move model to GPU if available
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-#device = torch.device("cpu")
-model = model.to(device)
-
+# Batched embedding engine shared by process_pdf / process_pdfs. bge-m3 is loaded
+# on the first embedding (GPU if available); call embedder.warmup() to load it up front.
+embedder = get_model_provider()
 
-#print(device)
+# Query embeddings, cached in memory and in query_embeddings.sqlite (opened on the first query) across restarts
+query_cache = QueryEmbeddingCache(embedder, model_fingerprint(embedder.model_name, embedder), db_path=query_cache_file)
 
 # Initialize document ID counter
 doc_id_counter = 0
@@ -32,6 +40,8 @@ doc_id_counter = 0
 doc_id_file_path = 'last_doc_id.pkl'
 
 def extract_text_and_images_from_pdf(file_path):
+    import fitz  # PyMuPDF
+
     doc = fitz.open(file_path)
     text = ''
 
@@ -196,341 +206,336 @@ def create_cluster(memmap, max_chunks_per_cluster, cluster_index):
     memmap['children'] = np.zeros(10)
 
 def create_single_cluster_entry(document_data, current_doc_id, max_chunks_per_cluster=1000, n_clusters=10):
-    """Assign chunks to nearest existing cluster centroids."""
-    
-    # Define the structure for the cluster data to be saved in the memory-mapped file
-    dtype = [
-        ('id', 'i4'),
-        ('chunks', [('doc_id', 'i4'), ('chunk_index', 'i4')], max_chunks_per_cluster),
-        ('centroid', 'f4', (1024,)),
-        ('children', 'f4', (10,)),
-    ]
-    
-    #First we search through nearest cluster
-    #If no cluster exists we create 1 cluster
-    # Function to create a new cluster
-
-    # Load existing clusters (if any)
-    existing_clusters = None
-    cluster_file = f'./clusters/cluster_1.memmap'
-    # Ensure the parent directory exists
-    directory = os.path.dirname(cluster_file)  # Extract directory path
-    print(directory)
-    if not os.path.exists(directory):
-        os.makedirs(directory)  # Create the parent directory if it doesn't exist
-    if not os.path.exists(cluster_file):    
-        memmap = np.memmap(cluster_file, dtype=dtype, mode='w+', shape=(1,))
-        
-    if os.path.exists(cluster_file):
-        existing_clusters = np.memmap(cluster_file, dtype=dtype, mode='r+')
-    
-    # If no clusters exist, create the first cluster
-    if not existing_clusters:
-        # Create a new memory-mapped file with space for 1 cluster
-        memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        
-        # Create the first cluster
-        create_cluster(memmap, max_chunks_per_cluster, 1)
+    """Assign chunks to nearest existing cluster centroids.
 
-        # Flush changes to ensure they're saved
-        existing_clusters.flush()
-        print("First cluster created and initialized.")
-    else:
-        print("Clusters already exist.")
-        
-    
-    # Add chunk indices to the current list
-    chunk_indices = [(current_doc_id, index) for index in range(len(document_data))]
-
-    # Process chunks to retrieve embeddings
-    manager = MemmapManager()
-    results = manager.process_chunks(chunk_indices)
-    embeddings = [data['embedding'] for _, _, data in results]
-    
-    #Now we have embeddings
-    cluster_memmap = None
-    #print(np.memmap(cluster_file, dtype=dtype, mode='r+'))
-    # Assign each chunk to the nearest existing cluster centroid
-    updated_cluster_embeddings = {}
-    chunk_embeddings = {}
-    for index, embedding in enumerate(embeddings):
-        distances = []
-        for cluster in existing_clusters:
-            centroid = cluster['centroid'][0]
-            distance = np.linalg.norm(embedding - centroid)
-            distances.append(distance)
-        closest_cluster_index = np.argmin(distances)
-        
-        # Get the closest cluster file and add chunk there
-        cluster_file = f'clusters/cluster_{closest_cluster_index + 1}.memmap'
-        cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        if not closest_cluster_index in updated_cluster_embeddings:
-            updated_cluster_embeddings[closest_cluster_index] = []
-        #We just store the embeddings of those chunks in that cluster
-        #We store doc ids existing in that chunk
-        if not closest_cluster_index in chunk_embeddings:
-            chunk_embeddings[closest_cluster_index] = {}
-        
-        # Find the first available slot in 'chunks' field
-        for i in range(max_chunks_per_cluster):
-            chunk_embeddings[closest_cluster_index][cluster_memmap['chunks'][0][i]['doc_id']] = None
-        
-        for i in range(max_chunks_per_cluster):
-            if cluster_memmap['chunks'][0][i]['doc_id'] == 0:  # Assuming 0 means uninitialized
-                cluster_memmap['chunks'][0][i] = chunk_indices[index]
-                break
-        chunk_embeddings[closest_cluster_index][current_doc_id] = None
-    
-    for closest_cluster_index in chunk_embeddings:   
-        doc_dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (1024,))]
-        document_memmaps = {}
-        cluster_file = f'clusters/cluster_{closest_cluster_index + 1}.memmap'
-        cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        del chunk_embeddings[closest_cluster_index][0]
-        #Iterate through the chunk embeddings, get memmap of the cluster
-        for doc_id in chunk_embeddings[closest_cluster_index]:
-            mem = f'./documents4/{doc_id}.npy'
-            #print(doc_id)
-            document_memmaps[doc_id] = np.memmap(mem, dtype=doc_dtype, mode='r+')
-            
-        for i in cluster_memmap['chunks'][0]:
-            if i['doc_id'] != 0:
-                #print(i['doc_id'], i['chunk_index'])
-                q = document_memmaps[i['doc_id']][i['chunk_index']]["embedding"]
-                updated_cluster_embeddings[closest_cluster_index].append(q)
-                #print(q)
-                #print(q)
-    
-    for i in updated_cluster_embeddings:
-        #print(updated_cluster_embeddings[i])
-        #print(i)
-        centroid = np.mean(np.array(updated_cluster_embeddings[i]), axis=0)
-        #print(centroid)
-        #We need a folder for each client data which includes transaction history.
-        existing_clusters["centroid"][0] = centroid
-        #We store clusters that need to be indexed in a pickle
-        """
-        with open(doc_id_file_path, 'wb') as f:
-            pickle.dump(doc_id_counter, f)
-        
-        with open(doc_id_file_path, 'rb') as f:
-            doc_id_counter = pickle.load(f)
-        """
-        
-        #Update the centroid of that cluster
-        #First we take all embeddings in that cluster and then we compute
-        
-        #By that we need to get all documents in that cluster
-        #We load embeddings in chunk_embeddings only specific ones
-        
-        #And compute for centroids
-        
-    #Now we need to update the centroids of the clusters modified
-    #We log the ids of the cluster for recomputation
-    #Then we do the computations of the things
-    #We need to make sure that the centroid updates else it will have issues.
-    #To do this we have to make it fault tolerant, we simply store which transaction is incomplete in some file. We only need to store the latest one per client.
-    
-    #If suddenly interrupted, like we didnt updated centroids damn. We need to like
-    #print(cluster_memmap)
+    Chunks descend the cluster tree to their nearest leaf with one distance
+    matrix per visited node, centroids are updated from running sums, and a
+    leaf that fills up is split with k-means (see cluster_assignment.py).
+    """
+    embeddings = np.array([chunk['embedding'] for chunk in document_data], dtype=np.float32)
+    with _search_objects_lock:
+        # Queries wait for the insert instead of reading a half-updated tree
+        tree = get_cluster_tree(max_chunks_per_cluster) or ClusterTree(cluster_folder, max_chunks_per_cluster)
+        tree.add_document(current_doc_id, embeddings)
+        _remember(f'cluster_tree_{max_chunks_per_cluster}', cluster_folder, tree, files=(state_file,))
     return "Chunks assigned to the nearest clusters successfully."
-def query_cluster(cluster_path=None, query = None):
-    max_chunks_per_cluster=1000
-    embedding_dim = 1024
-    # Define the structure for the cluster data to be saved in the memory-mapped file
+def load_cluster_members(cluster_file, max_chunks_per_cluster=1000):
+    """Return the occupied (doc_id, chunk_index) slots of a cluster file."""
     dtype = [
         ('id', 'i4'),
         ('chunks', [('doc_id', 'i4'), ('chunk_index', 'i4')], max_chunks_per_cluster),
         ('centroid', 'f4', (1024,)),
         ('children', 'f4', (10,)),
     ]
-    
-    #First we search through nearest cluster
-    #If no cluster exists we create 1 cluster
-    # Function to create a new cluster
-
-    # Load existing clusters (if any)
-    existing_clusters = None
-    cluster_file = f'./clusters/cluster_1.memmap'
-    if os.path.exists(cluster_file):
-        existing_clusters = np.memmap(cluster_file, dtype=dtype, mode='r+')
-    #Now we have embeddings
-    cluster_memmap = None
-    #print(np.memmap(cluster_file, dtype=dtype, mode='r+'))
-    # Assign each chunk to the nearest existing cluster centroid
-    updated_cluster_embeddings = {}
-    chunk_embeddings = {}
-    closest_cluster_index = 0
-    # Get the closest cluster file and add chunk there
-    cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-    if not closest_cluster_index in updated_cluster_embeddings:
-        updated_cluster_embeddings[closest_cluster_index] = []
-    #We just store the embeddings of those chunks in that cluster
-    #We store doc ids existing in that chunk
-    if not closest_cluster_index in chunk_embeddings:
-        chunk_embeddings[closest_cluster_index] = {}
-    
-    # Find the first available slot in 'chunks' field
-    for i in range(max_chunks_per_cluster):
-        chunk_embeddings[closest_cluster_index][cluster_memmap['chunks'][0][i]['doc_id']] = None
-    
-    
-    #chunk_embeddings[closest_cluster_index][current_doc_id] = None
-    
-    for closest_cluster_index in chunk_embeddings:   
-        doc_dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (1024,))]
-        document_memmaps = {}
-        cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        del chunk_embeddings[closest_cluster_index][0]
-        #Iterate through the chunk embeddings, get memmap of the cluster
-        for doc_id in chunk_embeddings[closest_cluster_index]:
-            mem = f'./documents4/{doc_id}.npy'
-            #print(doc_id)
-            document_memmaps[doc_id] = np.memmap(mem, dtype=doc_dtype, mode='r+')
-            
-        for i in cluster_memmap['chunks'][0]:
-            if i['doc_id'] != 0:
-                #print(i['doc_id'], i['chunk_index'])
-                chunk_data = document_memmaps[i['doc_id']][i['chunk_index']]
-                q = {
-                    "embeddings" : chunk_data["embedding"],
-                    "start_id" : chunk_data["start_id"],
-                    "end_id" : chunk_data["end_id"],
-                    "doc_id" : i['doc_id'],
-                    "chunk_index" : i['chunk_index'],
-                }
-                updated_cluster_embeddings[closest_cluster_index].append(q)
-                #print(q)
-                #print(q)
-        
-        # Tokenize sentences and move to model's device
-        encoded_input = tokenizer(query, padding=True, truncation=True, return_tensors='pt').to(model.device)
-
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = model(**encoded_input)#['sentence_embedding']
-            #print(model_output['sentence_embedding'].shape)
-            # Use CLS pooling (assuming CLS token is the first token)
-            sentence_embeddings = model_output[0][:,0]  # Shape should be (1, embedding_dim)
-            
-            # Check the shape and move to CPU for numpy conversion
-            if sentence_embeddings.shape[0] == 1:
-                sentence_embeddings = sentence_embeddings.squeeze(0)  # Remove batch dimension if needed
-
-            print(f"Embeddings shape: {sentence_embeddings.shape}")
-            
-            # Move to CPU and scale the embedding
-            sentence_embeddings_scaled = sentence_embeddings.cpu().numpy() / 20.0
-            
-            # Ensure embedding is of size `embedding_dim` (pad or truncate if necessary)
-            if sentence_embeddings_scaled.shape[0] != embedding_dim:
-                # Handle size mismatch: pad if smaller
-                if sentence_embeddings_scaled.shape[0] < embedding_dim:
-                    padded_embedding = np.pad(sentence_embeddings_scaled, (0, embedding_dim - sentence_embeddings_scaled.shape[0]), 'constant')
-                else:
-                    # Truncate if larger
-                    padded_embedding = sentence_embeddings_scaled[:embedding_dim]
+    cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r')
+    members = np.array(cluster_memmap['chunks'][0])
+    return members[members['doc_id'] != 0]  # 0 means an unused slot
+
+def gather_member_embeddings(members, embedding_dim=1024):
+    """Copy the embeddings of cluster members into one contiguous matrix.
+
+    Each document file is opened once and its chunks are read with a single
+    fancy index. Returns (matrix, chunks) with chunks in the embedding store's
+    chunk_dtype layout.
+    """
+    doc_dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (embedding_dim,))]
+    matrix = np.zeros((len(members), embedding_dim), dtype=np.float32)
+    chunks = np.zeros(len(members), dtype=chunk_dtype)
+    chunks['doc_id'] = members['doc_id']
+    chunks['chunk_index'] = members['chunk_index']
+    for doc_id in np.unique(members['doc_id']):
+        positions = np.nonzero(members['doc_id'] == doc_id)[0]
+        document = np.memmap(f'./documents4/{doc_id}.npy', dtype=doc_dtype, mode='r')
+        entries = document[members['chunk_index'][positions]]
+        matrix[positions] = entries['embedding']
+        chunks['start_id'][positions] = entries['start_id']
+        chunks['end_id'][positions] = entries['end_id']
+    return matrix, chunks
+
+def embed_query(query):
+    """Embed one query string the same way chunks are embedded (normalized and cached)."""
+    return query_cache.get(query)
+
+# Search-side stores and indexes, opened once per process and reopened when their meta.json is replaced
+_search_objects = {}
+_search_objects_lock = threading.RLock()
+
+def _file_stamp(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+def _cached(name, folder, create, refresh=None, files=('meta.json',)):
+    """The cached object `name` over `folder`, or None when folder/meta.json does not exist.
+
+    `create()` builds it on first use; when any of `files` has been replaced
+    since, `refresh(obj)` updates it in place (or `create()` builds it again).
+    """
+    stamp = tuple(_file_stamp(os.path.join(folder, file_name)) for file_name in files)
+    if stamp[0] is None:
+        return None
+    with _search_objects_lock:
+        entry = _search_objects.get(name)
+        if entry is None:
+            entry = _search_objects[name] = [stamp, create()]
+        elif entry[0] != stamp:
+            if refresh is not None:
+                refresh(entry[1])
             else:
-                padded_embedding = sentence_embeddings_scaled
+                entry[1] = create()
+            entry[0] = stamp
+        return entry[1]
+
+def _remember(name, folder, obj, files=('meta.json',)):
+    """Cache `obj` as `name` after this process rewrote its files, so the next _cached call keeps it."""
+    with _search_objects_lock:
+        _search_objects[name] = [tuple(_file_stamp(os.path.join(folder, file_name)) for file_name in files), obj]
+
+def get_embedding_store(required=True):
+    """The consolidated EmbeddingStore; None when it has not been built and not `required`."""
+    store = _cached('store', store_folder, lambda: EmbeddingStore(store_folder), EmbeddingStore.refresh)
+    if store is None and required:
+        raise FileNotFoundError(f"No embedding store found in {store_folder}.")
+    return store
+
+def get_bm25_index():
+    """The BM25 index, reloaded only when meta.json switches its base or delta; None when it has not been built."""
+    return _cached('bm25', bm25_folder, lambda: BM25Index(bm25_folder), BM25Index.load)
+
+def get_hnsw_index():
+    """The HNSW graph, opened read-only once (FileNotFoundError when it has not been built)."""
+    # Refresh the store first, so it holds every row the published graph links to
+    store = get_embedding_store()
+    index = _cached('hnsw', hnsw_folder, lambda: HNSWIndex(store, hnsw_folder, mode='r'))
+    if index is None:
+        raise FileNotFoundError(f"No HNSW index found in {hnsw_folder}.")
+    return index
+
+def get_ivf_index():
+    """The IVF index, reloaded only when its meta.json is replaced (FileNotFoundError when it has not been built)."""
+    index = _cached('ivf', ivf_folder, lambda: IVFIndex(ivf_folder), IVFIndex.load)
+    if index is None:
+        raise FileNotFoundError(f"No IVF index found in {ivf_folder}.")
+    return index
+
+def get_cluster_tree(max_chunks_per_cluster=1000):
+    """The cluster tree, loaded once and again only when another process saves it; None when it has not been built."""
+    return _cached(f'cluster_tree_{max_chunks_per_cluster}', cluster_folder,
+                   lambda: ClusterTree(cluster_folder, max_chunks_per_cluster), files=(state_file,))
+
+def get_quantized_store(kind):
+    """The "int8" or "pq" QuantizedStore, with its codes read into RAM once."""
+    folder = f"{quantized_folder}_{kind}"
+    quantized = _cached(f'quantized_{kind}', folder, lambda: QuantizedStore(folder, in_memory=True),
+                        QuantizedStore.load)
+    if quantized is None:
+        raise FileNotFoundError(f"No quantized store found in {folder}.")
+    return quantized
+
+def dense_search(query_embedding, k=None, backend="flat", nprobe=8, ef_search=None, rerank=100, cluster_file=None,
+                 beam_width=4):
+    """Top-k dense hits (hit_dtype records, best first) from the selected backend.
+
+    The ANN backends ("ivf", "hnsw", "int8", "pq") default to 100 hits when k is None.
+    "tree" (and "flat" without an embedding store) scores the members of the
+    cluster-tree leaves a beam search of `beam_width` reaches, unless
+    `cluster_file` names a single cluster.
+    """
+    if backend == "ivf":
+        hits = get_ivf_index().search(get_embedding_store(), query_embedding, k or 100, nprobe)[0]
+    elif backend in ("int8", "pq"):
+        hits = get_quantized_store(backend).search(get_embedding_store(), query_embedding, k or 100, rerank)[0]
+    elif backend == "hnsw":
+        hits = get_hnsw_index().search(query_embedding, k or 100, ef_search)[0]
+    elif backend != "tree" and get_embedding_store(required=False) is not None:
+        return search_store(get_embedding_store(), query_embedding, k)[0]
+    else:
+        tree = get_cluster_tree() if cluster_file is None else None
+        if tree is not None:
+            with _search_objects_lock:
+                members = tree.search_members(query_embedding, beam_width)
+        else:
+            members = load_cluster_members(cluster_file or './clusters/cluster_1.memmap')
+        matrix, chunks = gather_member_embeddings(members)
+        return search_chunks(matrix, chunks, query_embedding, k)[0]
+    return hits[hits['row'] >= 0]
+
+def query_cluster(cluster_path=None, query = None, k=None, backend="flat", nprobe=8, ef_search=None, rerank=100):
+    """Rank chunks by dense similarity to `query`, then re-score them with BM25.
+
+    Searches the consolidated embedding store when one exists, otherwise the
+    members of `cluster_path` (clusters/cluster_1.memmap by default). `k`
+    limits the dense candidates passed to BM25; None keeps every chunk.
+    `backend="ivf"` probes the `nprobe` nearest lists of the IVF index
+    instead of scanning every chunk, and `backend="hnsw"` walks the HNSW
+    graph with `ef_search` candidates. `backend="int8"` / `"pq"` scan the
+    compressed codes and re-rank the best `rerank` chunks exactly.
+    BM25 scores come from the persistent index in bm25_index/ when it exists;
+    otherwise BM25Okapi is built over the candidates' texts, read from the
+    chunk text store in chunk_text_store/ when it has them.
+    Returns the BM25-scored chunks, best first.
+    """
+    query_embedding = embed_query(query)
+    print(f"Embeddings shape: {query_embedding.shape}")
 
-        query_embedding = padded_embedding
-        # List to store distances along with doc_id and chunk_index
-        distances = []
-        
-        # Iterate over the updated_cluster_embeddings
-        for embedding in updated_cluster_embeddings[0]:
-            # Extract the embedding array
-            embedding_array = np.array(embedding["embeddings"])
-            
-            # Normalize both embeddings to calculate cosine similarity
-            query_norm = query_embedding #np.linalg.norm(query_embedding)
-            embedding_norm = embedding_array #np.linalg.norm(embedding_array)
-            
-            similarity = np.dot(query_embedding, embedding_array)
-            
-            # Convert similarity to a distance (1 - similarity)
-            distance = 1 - similarity
-            distance *= -1
-            # Extract additional metadata
-            doc_id = embedding['doc_id']
-            chunk_index = embedding['chunk_index']
-            start_index = embedding['start_id']
-            end_index = embedding['end_id']
-            
-            # Append distance and identifiers to the list
-            distances.append((distance, doc_id, chunk_index, start_index, end_index))
-        
-        # Sort by distance (smaller values indicate higher similarity)
-        distances.sort(key=lambda x: x[0])
-        
-        # Output sorted distances and retrieve text
-        path = "D:/pyfiles/HumanDiseaseOntology-main/HumanDiseaseOntology-main/disease_symptoms/"
-        
-        # Initialize a list to accumulate text chunks with metadata
-        accumulated_texts = []
-        
-        doc_texts = {}
-        # Iterate over the distances, extracting the relevant portions of text and storing metadata
-        for distance, doc_id, chunk_index, start_index, end_index in distances:
-            print(f"doc_id: {doc_id}, chunk_index: {chunk_index}, distance (1-similarity): {distance}")
-            
+    # Score every chunk with one matrix-vector product and keep the top k
+    start_time = time.time()
+    hits = dense_search(query_embedding, k, backend, nprobe, ef_search, rerank, cluster_path)
+    print(f"Time taken for dense search over {len(hits)} chunks: {time.time() - start_time:.4f} seconds")
+
+    bm25_index = get_bm25_index()
+    if bm25_index is not None:
+        start_time = time.time()
+        scores = bm25_index.score_chunks(query, hits['doc_id'], hits['chunk_index'])
+        print(f"Time taken for BM25 scoring: {time.time() - start_time:.4f} seconds")
+        scored_chunks = [{"doc_id": int(hit['doc_id']), "chunk_index": int(hit['chunk_index']), "score": float(score)}
+                         for hit, score in zip(hits, scores)]
+        scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+        print_scored_chunks(scored_chunks)
+        return scored_chunks
+
+    # Output sorted distances and retrieve text
+    path = "D:/pyfiles/HumanDiseaseOntology-main/HumanDiseaseOntology-main/disease_symptoms/"
+    text_store = load_text_store()
+
+    # Initialize a list to accumulate text chunks with metadata
+    accumulated_texts = []
+
+    doc_texts = {}
+    # Iterate over the hits (most similar first), extracting the relevant portions of text and storing metadata
+    for hit in hits:
+        doc_id = int(hit['doc_id'])
+        chunk_index = int(hit['chunk_index'])
+        print(f"doc_id: {doc_id}, chunk_index: {chunk_index}, distance (1-similarity): {1 - hit['score']}")
+
+        if text_store is not None and text_store.has_document(doc_id):
+            relevant_text = text_store.get_text(doc_id, chunk_index)
+        else:
             # Load the document (assuming you have a function for this)
             doc = load_doc_mapping_by_value(doc_id)
-            
+
             if doc not in doc_texts:
                 # Extract the text and images from the PDF
                 text = extract_text_and_images_from_pdf(path + doc)
                 doc_texts[doc] = text
             # Extract the relevant portion of the text
-            relevant_text = doc_texts[doc][start_index:end_index]
-            
-            #print(relevant_text)
-            # Accumulate the relevant text with doc_id and chunk_index
-            accumulated_texts.append({
-                "doc_id": doc_id,
-                "chunk_index": chunk_index,
-                "text": relevant_text
-            })
-
-        # After accumulating, tokenize the texts
-        tokenized_texts = [chunk['text'].split() for chunk in accumulated_texts]
-
-        # Initialize BM25 with all the tokenized chunks as documents
-        bm25 = BM25Okapi(tokenized_texts)
-
-        # Define your search query
-        tokenized_query = query.split()
-
-        # Get BM25 scores for the query against all the accumulated texts
-        scores = bm25.get_scores(tokenized_query)
-
-        # Combine BM25 scores with metadata (doc_id, chunk_index)
-        scored_chunks = []
-        for idx, score in enumerate(scores):
-            scored_chunks.append({
-                "doc_id": accumulated_texts[idx]["doc_id"],
-                "chunk_index": accumulated_texts[idx]["chunk_index"],
-                "score": score
-            })
-
-        # Sort the results by BM25 score (higher score means more relevant)
-        scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+            relevant_text = doc_texts[doc][hit['start_id']:hit['end_id']]
+
+        # Accumulate the relevant text with doc_id and chunk_index
+        accumulated_texts.append({
+            "doc_id": doc_id,
+            "chunk_index": chunk_index,
+            "text": relevant_text
+        })
+
+    # After accumulating, tokenize the texts
+    tokenized_texts = [chunk['text'].split() for chunk in accumulated_texts]
+
+    # Initialize BM25 with all the tokenized chunks as documents
+    from rank_bm25 import BM25Okapi
+    bm25 = BM25Okapi(tokenized_texts)
+
+    # Define your search query
+    tokenized_query = query.split()
+
+    # Get BM25 scores for the query against all the accumulated texts
+    scores = bm25.get_scores(tokenized_query)
+
+    # Combine BM25 scores with metadata (doc_id, chunk_index)
+    scored_chunks = []
+    for idx, score in enumerate(scores):
+        scored_chunks.append({
+            "doc_id": accumulated_texts[idx]["doc_id"],
+            "chunk_index": accumulated_texts[idx]["chunk_index"],
+            "score": score
+        })
+
+    # Sort the results by BM25 score (higher score means more relevant)
+    scored_chunks.sort(key=lambda x: x['score'], reverse=True)
+    print_scored_chunks(scored_chunks)
+    return scored_chunks
+
+def load_text_store():
+    """The chunk text store, opened once and remapped on new commits; None when it has not been built."""
+    return _cached('texts', text_folder, lambda: ChunkTextStore(text_folder), ChunkTextStore.refresh)
+
+def print_scored_chunks(scored_chunks):
+    """Print the BM25-scored chunks above 1 with their document and disease."""
+    for chunk in scored_chunks:
+        if chunk['score'] > 1:
+            print(f"doc_id: {chunk['doc_id']}, chunk_index: {chunk['chunk_index']}, BM25 score: {chunk['score']}")
+            doc = load_doc_mapping_by_value(chunk['doc_id'])
+            print(doc)
+            print(doc.replace(".txt", ""))
+            print(get_disease_number(doc.replace(".txt", "")))
+
+class SearchResult(NamedTuple):
+    """One fused search hit.
+
+    dense_score / bm25_score are NaN when the chunk was not a candidate of that
+    list; text is None when the chunk text store does not have the chunk.
+    """
+    doc_id: int
+    chunk_index: int
+    score: float
+    dense_score: float
+    bm25_score: float
+    document: str
+    disease_name: str
+    disease_number: int
+    text: str
+
+def search(query, k=10, alpha=0.5, fusion="rrf", n_candidates=100, backend="flat", nprobe=8, ef_search=None, rerank=100):
+    """Hybrid dense + BM25 search.
+
+    The dense top `n_candidates` and the BM25 top `n_candidates` are retrieved
+    independently and fused, so the fusion work is bounded by n_candidates.
+
+    Args:
+        query (str): Free-text symptom query.
+        k (int): Number of results.
+        alpha (float): Weight of the dense ranking; BM25 gets 1 - alpha.
+        fusion (str): "rrf" (reciprocal rank) or "linear" (min-max normalized scores).
+        n_candidates (int): Candidates taken from each ranking.
+        backend, nprobe, ef_search, rerank: Dense backend options, as in query_cluster.
+
+    Returns:
+        list[SearchResult]: Best first.
+    """
+    start_time = time.time()
+    hits = dense_search(embed_query(query), n_candidates, backend, nprobe, ef_search, rerank)
+    dense_keys = chunk_keys(hits['doc_id'], hits['chunk_index'])
+    dense_time = time.time() - start_time
+
+    start_time = time.time()
+    lexical = []
+    bm25_index = get_bm25_index()
+    if bm25_index is not None:
+        lexical = bm25_index.search(query, n_candidates)
+    else:
+        print(f"No BM25 index in {bm25_folder}, ranking by dense similarity only")
+    lexical_keys = chunk_keys([d for d, _, _ in lexical], [c for _, c, _ in lexical])
+    lexical_time = time.time() - start_time
+
+    keys, fused, dense, bm25 = fuse(dense_keys, hits['score'], lexical_keys,
+                                    np.array([s for _, _, s in lexical], dtype=np.float32), alpha, fusion)
+    print(f"Time taken for dense search: {dense_time:.4f} seconds, BM25: {lexical_time:.4f} seconds")
+
+    doc_ids, chunk_indices = split_keys(keys[:k])
+    text_store = load_text_store()
+    texts = text_store.get_texts(doc_ids, chunk_indices) if text_store is not None else [None] * len(doc_ids)
+    documents = get_mapping_service().doc_files(doc_ids.tolist())
+    results = []
+    for i, (doc_id, chunk_index) in enumerate(zip(doc_ids.tolist(), chunk_indices.tolist())):
+        document = documents[i]
+        disease_name = document.replace(".txt", "") if document else None
+        results.append(SearchResult(doc_id, chunk_index, float(fused[i]), float(dense[i]), float(bm25[i]),
+                                    document, disease_name,
+                                    get_disease_number(disease_name) if disease_name else None, texts[i]))
+    return results
 
-        # Print the sorted results
-        for chunk in scored_chunks:
-            if chunk['score'] > 1:
-                print(f"doc_id: {chunk['doc_id']}, chunk_index: {chunk['chunk_index']}, BM25 score: {chunk['score']}")
-                print(load_doc_mapping_by_value(chunk['doc_id']))
-                doc = load_doc_mapping_by_value(chunk['doc_id'])
-                print(doc.replace(".txt", ""))
-                print(get_disease_number(doc.replace(".txt", "")))
-        # Load the document (assuming you have a function for this)
-        
-        """
-        for i in accumulated_texts:
-            if i['doc_id'] == scored_chunks[0]['doc_id'] and i['chunk_index'] == scored_chunks[0]['chunk_index']:
-                print(i['text'])
-        """
 def load_and_cluster_embeddings_by_id(doc_id):
     """Load document chunks by document ID and create clusters from their indices."""
     document_data = load_document_chunks(doc_id)
@@ -551,127 +556,43 @@ def print_clusters(clusters):
         print(f"Cluster ID: {cluster['id']}, Number of Chunks: {len(cluster['chunks'])}")
         for chunk in cluster['chunks']:
             print(f"\tDoc ID: {chunk[0]}, Chunk Index: {chunk[1]}")
-def parse_symptoms_as_strings_with_indices(response: str) -> list:
-    """
-    Parses symptoms from a response, including their start and end character indices in the string.
-    
-    Args:
-        response (str): The input string containing symptom data formatted with tags.
+def build_document_data(chunk_indices, embeddings):
+    """Pair each (start, end) index with its embedding in the save_document_to_binary layout."""
+    document_data = {"chunks": []}
+    for (start_idx, end_idx), embedding in zip(chunk_indices, embeddings):
+        document_data["chunks"].append({
+            "start_id": start_idx,
+            "end_id": end_idx,
+            "embedding": embedding,
+        })
+    return document_data
 
-    Returns:
-        list: A list of dictionaries, each containing:
-              - start_index: The starting character index of the symptom in the string.
-              - end_index: The ending character index of the symptom in the string.
-              - symptom: The formatted string containing symptom details.
-    """
-    # Define a regular expression pattern to extract symptom details
-    symptom_pattern = re.compile(
-        r"<start_symptom_name>(.*?)</start_symptom_name>\s*"
-        r"<start_description>(.*?)</start_description>\s*"
-        r"<start_synonyms>(.*?)</start_synonyms>\s*"
-        r"<start_monologues>(.*?)</start_monologues>",
-        re.DOTALL
-    )
-    
-    # Find all matches in the input response with their indices
-    matches = symptom_pattern.finditer(response)
-    
-    symptoms = []
-    
-    chunks = []
-    chunk_indices = []
-    
-    for match in matches:
-        start_index = match.start()
-        end_index = match.end()
-        symptom_details = {
-            "start_index": start_index,
-            "end_index": end_index,
-            "symptom": f"<symptom>Name: {match.group(1).strip()}, "
-                       f"Description: {match.group(2).strip()}, "
-                       f"Synonyms: {match.group(3).strip()}, "
-                       f"Monologues: {match.group(4).strip()}</symptom>"
-        }
-        chunk_indices.append((start_index, end_index))
-        chunks.append(symptom_details["symptom"])
-        symptoms.append(symptom_details)
-    
-    return chunks, chunk_indices
 def process_pdf(pdf_file):
-    # Ensure the directory for storing documents exists
-    os.makedirs('documents4', exist_ok=True)
-
-    # Extract text and images from the PDF
-    #text, images = extract_text_and_images_from_pdf(pdf_file)
-    text = None
-    
-    with open(pdf_file, "r", encoding="utf-8") as file:
-        text = file.read()
+    return process_pdfs([pdf_file])
 
-    chunk_strings, chunk_indices = parse_symptoms_as_strings_with_indices(text)
-    # Tokenize the entire document
-    tokens = tokenizer.tokenize(text)
-    token_offsets = tokenizer(text, return_offsets_mapping=True)['offset_mapping']
+def process_pdfs(pdf_files):
+    """Embed the chunks of several files in shared batches and save each file as its own document.
 
-    # Define maximum token length and overlap size
-    max_length = 4000  # Adjust as needed
-    overlap_size = 20
+    Returns a list of (pdf_file, doc_id) for the documents that were saved.
+    """
+    # Ensure the directory for storing documents exists
+    os.makedirs('documents4', exist_ok=True)
 
-    # Chunk the tokens
-    #chunk_strings, chunk_indices = chunk_tokens(tokens, max_length, overlap_size)
+    parsed = [read_symptom_chunks(pdf_file) for pdf_file in pdf_files]
 
-    # Prepare for storing embeddings
-    embedding_dim = 1024  # Update this according to model's output dimensions
-    document_data = {"chunks": []}
+    # One engine call for every chunk of every file, sorted and batched by token length
+    start_time = time.time()
+    embeddings = embedder.embed_groups([chunk_strings for chunk_strings, _ in parsed])
+    print(f"Time taken to embed {len(pdf_files)} files: {time.time() - start_time:.2f} seconds")
 
-    # Process each chunk to generate embeddings
-    for i, (start_idx, end_idx) in enumerate(chunk_indices):
-        start_time = time.time()
-        print(f"Chunk {i + 1}: Start char index: {start_idx}, End char index: {end_idx}")
-        #print(chunk_strings[i])
-        
-        # Tokenize sentences and move to model's device
-        encoded_input = tokenizer(chunk_strings[i], padding=True, truncation=True, return_tensors='pt').to(model.device)
-
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = model(**encoded_input)#['sentence_embedding']
-            #print(model_output['sentence_embedding'].shape)
-            # Use CLS pooling (assuming CLS token is the first token)
-            sentence_embeddings = model_output[0][:,0]  # Shape should be (1, embedding_dim)
-            
-            # Check the shape and move to CPU for numpy conversion
-            if sentence_embeddings.shape[0] == 1:
-                sentence_embeddings = sentence_embeddings.squeeze(0)  # Remove batch dimension if needed
-
-            print(f"Embeddings shape: {sentence_embeddings.shape}")
-            
-            # Move to CPU and scale the embedding
-            sentence_embeddings_scaled = sentence_embeddings.cpu().numpy() / 20.0
-            
-            # Ensure embedding is of size `embedding_dim` (pad or truncate if necessary)
-            if sentence_embeddings_scaled.shape[0] != embedding_dim:
-                # Handle size mismatch: pad if smaller
-                if sentence_embeddings_scaled.shape[0] < embedding_dim:
-                    padded_embedding = np.pad(sentence_embeddings_scaled, (0, embedding_dim - sentence_embeddings_scaled.shape[0]), 'constant')
-                else:
-                    # Truncate if larger
-                    padded_embedding = sentence_embeddings_scaled[:embedding_dim]
-            else:
-                padded_embedding = sentence_embeddings_scaled
-
-            # Store chunk data
-            document_data["chunks"].append({
-                "start_id": start_idx,
-                "end_id": end_idx,
-                "embedding": padded_embedding,
-            })
-            
-        print(f"Time taken to embed last chunk: {time.time() - start_time:.2f} seconds")
     # Save the document embeddings to binary
     global doc_id_counter
-    save_document_to_binary(doc_id=doc_id_counter, document_data=document_data)
-    doc_id_counter += 1  # Increment the document ID counter
+    saved = []
+    for pdf_file, (chunk_strings, chunk_indices), doc_embeddings in zip(pdf_files, parsed, embeddings):
+        save_document_to_binary(doc_id=doc_id_counter, document_data=build_document_data(chunk_indices, doc_embeddings))
+        saved.append((pdf_file, doc_id_counter))
+        doc_id_counter += 1  # Increment the document ID counter
+    return saved
     
 def save_last_document_id():
     with open(doc_id_file_path, 'wb') as f:
@@ -697,66 +618,56 @@ value_to_key_file = 'value_to_key.db'  # doc_id -> pdf_file
 
 # Function to retrieve symptom number by name
 def get_symptom_number(symptom_name):
-    with shelve.open("symptom_to_number") as symptom_to_number_db:
-        return symptom_to_number_db.get(symptom_name, None)
+    return get_mapping_service().symptom_number(symptom_name)
 
 # Function to retrieve symptom name by number
 def get_symptom_name_by_number(symptom_number):
-    with shelve.open("number_to_symptom") as number_to_symptom_db:
-        return number_to_symptom_db.get(symptom_number, None)
+    return get_mapping_service().symptom_name(symptom_number)
 
 # Function to retrieve synonyms by symptom number
 def get_synonyms_by_number(symptom_number):
-    with shelve.open("number_to_synonyms") as number_to_synonyms_db:
-        return number_to_synonyms_db.get(symptom_number, [])
+    return get_mapping_service().synonyms(symptom_number)
 
 # Function to retrieve disease number by name
 def get_disease_number(disease_name):
-    with shelve.open("disease_to_number") as disease_to_number_db:
-        return disease_to_number_db.get(disease_name, None)
+    return get_mapping_service().disease_number(disease_name)
 
 # Function to retrieve disease name by number
 def get_disease_name_by_number(disease_number):
-    with shelve.open("number_to_disease") as number_to_disease_db:
-        return number_to_disease_db.get(disease_number, None)
+    return get_mapping_service().disease_name(disease_number)
 
 # Function to retrieve symptom-to-disease mappings
 def get_diseases_by_symptom(symptom_name):
-    with shelve.open("symptom_to_number") as symptom_to_number_db, \
-         shelve.open("symptom_to_disease") as symptom_to_disease_db, \
-         shelve.open("number_to_disease") as number_to_disease_db:
-        symptom_number = symptom_to_number_db.get(symptom_name, None)
-        if symptom_number:
-            disease_numbers = symptom_to_disease_db.get(symptom_number, [])
-            return [number_to_disease_db.get(disease_number, None) for disease_number in disease_numbers]
-        return []
+    return get_mapping_service().diseases_by_symptom(symptom_name)
+
+# Function to rank diseases for several symptoms (synonyms resolved, BM25 weighted)
+def diagnose_symptoms(symptom_names, k=10):
+    return get_diagnosis_engine().diagnose(symptom_names, k)
+
+# Symptom-name vectors, loaded on the first normalize_symptoms call
+symptom_normalizer = None
+
+# Function to map free-text phrases ("my knees ache") to their nearest symptom IDs
+def normalize_symptoms(free_text_list, k=3, min_score=None):
+    global symptom_normalizer
+    if symptom_normalizer is None:
+        symptom_normalizer = SymptomNormalizer(normalizer_folder, query_cache)
+    return symptom_normalizer.normalize(free_text_list, k, min_score)
 
 def load_doc_mapping_by_key(pdf_file):
     """Load a single document mapping using the pdf_file (key)."""
-    try:
-        with shelve.open(key_to_value_file, flag='r') as db:
-            # Return the doc_id for the given pdf_file, or None if not found
-            return db.get(str(pdf_file), None)
-    except (FileNotFoundError, KeyError) as e:
-        # If the file doesn't exist or the key is not found, handle it gracefully
-        print(f"Error loading mapping for '{pdf_file}' by key: {e}")
-        return None
+    return get_mapping_service().doc_id(pdf_file)
 
 def load_doc_mapping_by_value(doc_id):
     """Load a single document mapping using the doc_id (value)."""
-    try:
-        with shelve.open(value_to_key_file, flag='r') as db:
-            # Return the pdf_file for the given doc_id, or None if not found
-            return db.get(str(doc_id), None)
-    except (FileNotFoundError, KeyError) as e:
-        # If the file doesn't exist or the key is not found, handle it gracefully
-        print(f"Error loading mapping for doc_id '{doc_id}' by value: {e}")
-        return None
+    return get_mapping_service().doc_file(doc_id)
 
 def save_doc_mapping(pdf_file, doc_id):
     doc_id -= 1
     """Save a single document mapping in both key-to-value and value-to-key databases."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Key to value (pdf_file -> doc_id)
         with shelve.open(key_to_value_file, flag='c') as key_db:
             key_db[pdf_file] = doc_id  # Save or update the mapping
@@ -775,6 +686,8 @@ def save_doc_mapping(pdf_file, doc_id):
 def delete_doc_mapping_by_key(pdf_file):
     """Delete a specific document mapping using the pdf_file (key)."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Key to value (pdf_file -> doc_id)
         with shelve.open(key_to_value_file, flag='c') as key_db:
             if pdf_file in key_db:
@@ -802,6 +715,8 @@ def delete_doc_mapping_by_key(pdf_file):
 def delete_doc_mapping_by_value(doc_id):
     """Delete a specific document mapping using the doc_id (value)."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Value to key (doc_id -> pdf_file)
         with shelve.open(value_to_key_file, flag='c') as value_db:
             if doc_id in value_db:
@@ -842,21 +757,11 @@ def ensure_db_exists():
 
 def check_key_exists(pdf_file):
     """Check if a pdf_file exists in the key-to-value mapping (key file)."""
-    try:
-        with shelve.open(key_to_value_file, flag='r') as db:
-            return pdf_file in db  # Return True if the key exists, else False
-    except (FileNotFoundError, KeyError) as e:
-        print(f"Error checking existence of '{pdf_file}': {e}")
-        return False
+    return get_mapping_service().contains(key_to_value_file, pdf_file)
 
 def check_value_exists(doc_id):
     """Check if a doc_id exists in the value-to-key mapping (value file)."""
-    try:
-        with shelve.open(value_to_key_file, flag='r') as db:
-            return str(doc_id) in db  # Return True if the value exists, else False
-    except (FileNotFoundError, KeyError) as e:
-        print(f"Error checking existence of doc_id '{doc_id}': {e}")
-        return False
+    return get_mapping_service().contains(value_to_key_file, doc_id)
     
 def main():
     start_time = time.time()
@@ -1,27 +1,21 @@
-import fitz  # PyMuPDF
 import numpy as np
 import os
-import torch
 import pickle
 import json
 import time
-from sklearn.cluster import KMeans
 import re
+import threading
 
-from transformers import AutoTokenizer, AutoModel, AutoModelForSequenceClassification
+from model_provider import get_model_provider
+from symptom_parser import parse_symptoms_as_strings_with_indices, read_symptom_chunks
+from mapping_service import get_mapping_service
+from cluster_assignment import ClusterTree, cluster_folder
 
-# Load model from HuggingFace Hub
-tokenizer = AutoTokenizer.from_pretrained('BAAI/bge-m3')
-model = AutoModel.from_pretrained('BAAI/bge-m3')
-model.eval()
 max_seq_length = 8192
 
-# Move model to GPU if available
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-#device = torch.device("cpu")
-model = model.to(device)
-
-print(device)
+# Batched embedding engine shared by process_pdf / process_pdfs. bge-m3 is loaded
+# on the first embedding (GPU if available); call embedder.warmup() to load it up front.
+embedder = get_model_provider()
 
 # Initialize document ID counter
 doc_id_counter = 1
@@ -30,6 +24,8 @@ doc_id_counter = 1
 doc_id_file_path = 'last_doc_id.pkl'
 
 def extract_text_and_images_from_pdf(file_path):
+    import fitz  # PyMuPDF
+
     doc = fitz.open(file_path)
     text = ''
     images = []
@@ -199,147 +195,33 @@ def create_cluster(memmap, max_chunks_per_cluster, cluster_index):
     memmap['chunks'] = np.zeros((max_chunks_per_cluster,), dtype=[('doc_id', 'i4'), ('chunk_index', 'i4')])
     memmap['children'] = np.zeros(10)
 
-def create_single_cluster_entry(document_data, current_doc_id, max_chunks_per_cluster=1000, n_clusters=10):
-    """Assign chunks to nearest existing cluster centroids."""
-    
-    # Define the structure for the cluster data to be saved in the memory-mapped file
-    dtype = [
-        ('id', 'i4'),
-        ('chunks', [('doc_id', 'i4'), ('chunk_index', 'i4')], max_chunks_per_cluster),
-        ('centroid', 'f4', (1024,)),
-        ('children', 'f4', (10,)),
-    ]
-    
-    #First we search through nearest cluster
-    #If no cluster exists we create 1 cluster
-    # Function to create a new cluster
+# One cluster tree per process: its state is loaded once and kept in memory between documents
+_cluster_tree = None
+_cluster_tree_lock = threading.RLock()
 
-    # Load existing clusters (if any)
-    existing_clusters = None
-    cluster_file = f'./clusters/cluster_1.memmap'
-    # Ensure the parent directory exists
-    directory = os.path.dirname(cluster_file)  # Extract directory path
-    print(directory)
-    if not os.path.exists(directory):
-        os.makedirs(directory)  # Create the parent directory if it doesn't exist
-    if not os.path.exists(cluster_file):    
-        memmap = np.memmap(cluster_file, dtype=dtype, mode='w+', shape=(1,))
-        
-    if os.path.exists(cluster_file):
-        existing_clusters = np.memmap(cluster_file, dtype=dtype, mode='r+')
-    
-    # If no clusters exist, create the first cluster
-    if not existing_clusters:
-        # Create a new memory-mapped file with space for 1 cluster
-        memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        
-        # Create the first cluster
-        create_cluster(memmap, max_chunks_per_cluster, 1)
+def get_cluster_tree(max_chunks_per_cluster=1000):
+    """The process-wide ClusterTree over cluster_folder, loaded on first use."""
+    global _cluster_tree
+    with _cluster_tree_lock:
+        if _cluster_tree is None:
+            _cluster_tree = ClusterTree(cluster_folder, max_chunks_per_cluster)
+        return _cluster_tree
 
-        # Flush changes to ensure they're saved
-        existing_clusters.flush()
-        print("First cluster created and initialized.")
-    else:
-        print("Clusters already exist.")
-        
-    
-    # Add chunk indices to the current list
-    chunk_indices = [(current_doc_id, index) for index in range(len(document_data))]
+def create_single_cluster_entry(document_data, current_doc_id, max_chunks_per_cluster=1000, n_clusters=10):
+    """Assign chunks to nearest existing cluster centroids.
 
-    # Process chunks to retrieve embeddings
-    manager = MemmapManager()
-    results = manager.process_chunks(chunk_indices)
-    embeddings = [data['embedding'] for _, _, data in results]
-    
-    #Now we have embeddings
-    cluster_memmap = None
-    #print(np.memmap(cluster_file, dtype=dtype, mode='r+'))
-    # Assign each chunk to the nearest existing cluster centroid
-    updated_cluster_embeddings = {}
-    chunk_embeddings = {}
-    for index, embedding in enumerate(embeddings):
-        distances = []
-        for cluster in existing_clusters:
-            centroid = cluster['centroid'][0]
-            distance = np.linalg.norm(embedding - centroid)
-            distances.append(distance)
-        closest_cluster_index = np.argmin(distances)
-        
-        # Get the closest cluster file and add chunk there
-        cluster_file = f'clusters/cluster_{closest_cluster_index + 1}.memmap'
-        cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        if not closest_cluster_index in updated_cluster_embeddings:
-            updated_cluster_embeddings[closest_cluster_index] = []
-        #We just store the embeddings of those chunks in that cluster
-        #We store doc ids existing in that chunk
-        if not closest_cluster_index in chunk_embeddings:
-            chunk_embeddings[closest_cluster_index] = {}
-        
-        # Find the first available slot in 'chunks' field
-        for i in range(max_chunks_per_cluster):
-            chunk_embeddings[closest_cluster_index][cluster_memmap['chunks'][0][i]['doc_id']] = None
-        
-        for i in range(max_chunks_per_cluster):
-            if cluster_memmap['chunks'][0][i]['doc_id'] == 0:  # Assuming 0 means uninitialized
-                cluster_memmap['chunks'][0][i] = chunk_indices[index]
-                break
-        chunk_embeddings[closest_cluster_index][current_doc_id] = None
-    
-    for closest_cluster_index in chunk_embeddings:   
-        doc_dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (1024,))]
-        document_memmaps = {}
-        cluster_file = f'clusters/cluster_{closest_cluster_index + 1}.memmap'
-        cluster_memmap = np.memmap(cluster_file, dtype=dtype, mode='r+')
-        del chunk_embeddings[closest_cluster_index][0]
-        #Iterate through the chunk embeddings, get memmap of the cluster
-        for doc_id in chunk_embeddings[closest_cluster_index]:
-            mem = f'./documents4/{doc_id}.npy'
-            #print(doc_id)
-            document_memmaps[doc_id] = np.memmap(mem, dtype=doc_dtype, mode='r+')
-            
-        for i in cluster_memmap['chunks'][0]:
-            if i['doc_id'] != 0:
-                #print(i['doc_id'], i['chunk_index'])
-                q = document_memmaps[i['doc_id']][i['chunk_index']]["embedding"]
-                updated_cluster_embeddings[closest_cluster_index].append(q)
-                #print(q)
-                #print(q)
-    
-    for i in updated_cluster_embeddings:
-        #print(updated_cluster_embeddings[i])
-        #print(i)
-        centroid = np.mean(np.array(updated_cluster_embeddings[i]), axis=0)
-        #print(centroid)
-        #We need a folder for each client data which includes transaction history.
-        existing_clusters["centroid"][0] = centroid
-        #We store clusters that need to be indexed in a pickle
-        """
-        with open(doc_id_file_path, 'wb') as f:
-            pickle.dump(doc_id_counter, f)
-        
-        with open(doc_id_file_path, 'rb') as f:
-            doc_id_counter = pickle.load(f)
-        """
-        
-        #Update the centroid of that cluster
-        #First we take all embeddings in that cluster and then we compute
-        
-        #By that we need to get all documents in that cluster
-        #We load embeddings in chunk_embeddings only specific ones
-        
-        #And compute for centroids
-        
-    #Now we need to update the centroids of the clusters modified
-    #We log the ids of the cluster for recomputation
-    #Then we do the computations of the things
-    #We need to make sure that the centroid updates else it will have issues.
-    #To do this we have to make it fault tolerant, we simply store which transaction is incomplete in some file. We only need to store the latest one per client.
-    
-    #If suddenly interrupted, like we didnt updated centroids damn. We need to like
-    #print(cluster_memmap)
+    Chunks descend the cluster tree to their nearest leaf with one distance
+    matrix per visited node, centroids are updated from running sums, and a
+    leaf that fills up is split with k-means (see cluster_assignment.py).
+    """
+    embeddings = np.array([chunk['embedding'] for chunk in document_data], dtype=np.float32)
+    with _cluster_tree_lock:
+        get_cluster_tree(max_chunks_per_cluster).add_document(current_doc_id, embeddings)
     return "Chunks assigned to the nearest clusters successfully."
 
 def query_cluster(cluster_path=None, query = None):
+    import torch
+
     # Define the structure for the cluster data to be saved in the memory-mapped file
     dtype = [
         ('id', 'i4'),
@@ -400,6 +282,7 @@ def query_cluster(cluster_path=None, query = None):
                 #print(q)
         
         # Tokenize sentences and move to model's device
+        tokenizer, model = embedder.tokenizer, embedder.model
         encoded_input = tokenizer(query, padding=True, truncation=True, return_tensors='pt').to(model.device)
 
         # Compute token embeddings
@@ -473,127 +356,43 @@ def print_clusters(clusters):
         print(f"Cluster ID: {cluster['id']}, Number of Chunks: {len(cluster['chunks'])}")
         for chunk in cluster['chunks']:
             print(f"\tDoc ID: {chunk[0]}, Chunk Index: {chunk[1]}")
-def parse_symptoms_as_strings_with_indices(response: str) -> list:
-    """
-    Parses symptoms from a response, including their start and end character indices in the string.
-    
-    Args:
-        response (str): The input string containing symptom data formatted with tags.
-
-    Returns:
-        list: A list of dictionaries, each containing:
-              - start_index: The starting character index of the symptom in the string.
-              - end_index: The ending character index of the symptom in the string.
-              - symptom: The formatted string containing symptom details.
-    """
-    # Define a regular expression pattern to extract symptom details
-    symptom_pattern = re.compile(
-        r"<start_symptom_name>(.*?)</start_symptom_name>\s*"
-        r"<start_description>(.*?)</start_description>\s*"
-        r"<start_synonyms>(.*?)</start_synonyms>\s*"
-        r"<start_monologues>(.*?)</start_monologues>",
-        re.DOTALL
-    )
-    
-    # Find all matches in the input response with their indices
-    matches = symptom_pattern.finditer(response)
-    
-    symptoms = []
-    
-    chunks = []
-    chunk_indices = []
-    
-    for match in matches:
-        start_index = match.start()
-        end_index = match.end()
-        symptom_details = {
-            "start_index": start_index,
-            "end_index": end_index,
-            "symptom": f"<symptom>Name: {match.group(1).strip()}, "
-                       f"Description: {match.group(2).strip()}, "
-                       f"Synonyms: {match.group(3).strip()}, "
-                       f"Monologues: {match.group(4).strip()}</symptom>"
-        }
-        chunk_indices.append((start_index, end_index))
-        chunks.append(symptom_details["symptom"])
-        symptoms.append(symptom_details)
-    
-    return chunks, chunk_indices
-def process_pdf(pdf_file):
-    # Ensure the directory for storing documents exists
-    os.makedirs('documents4', exist_ok=True)
-
-    # Extract text and images from the PDF
-    #text, images = extract_text_and_images_from_pdf(pdf_file)
-    text = None
-    
-    with open(pdf_file, "r", encoding="utf-8") as file:
-        text = file.read()
+def build_document_data(chunk_indices, embeddings):
+    """Pair each (start, end) index with its embedding in the save_document_to_binary layout."""
+    document_data = {"chunks": []}
+    for (start_idx, end_idx), embedding in zip(chunk_indices, embeddings):
+        document_data["chunks"].append({
+            "start_id": start_idx,
+            "end_id": end_idx,
+            "embedding": embedding,
+        })
+    return document_data
 
-    chunk_strings, chunk_indices = parse_symptoms_as_strings_with_indices(text)
-    # Tokenize the entire document
-    tokens = tokenizer.tokenize(text)
-    token_offsets = tokenizer(text, return_offsets_mapping=True)['offset_mapping']
+def process_pdf(pdf_file):
+    return process_pdfs([pdf_file])
 
-    # Define maximum token length and overlap size
-    max_length = 4000  # Adjust as needed
-    overlap_size = 20
+def process_pdfs(pdf_files):
+    """Embed the chunks of several files in shared batches and save each file as its own document.
 
-    # Chunk the tokens
-    #chunk_strings, chunk_indices = chunk_tokens(tokens, max_length, overlap_size)
+    Returns a list of (pdf_file, doc_id) for the documents that were saved.
+    """
+    # Ensure the directory for storing documents exists
+    os.makedirs('documents4', exist_ok=True)
 
-    # Prepare for storing embeddings
-    embedding_dim = 1024  # Update this according to model's output dimensions
-    document_data = {"chunks": []}
+    parsed = [read_symptom_chunks(pdf_file) for pdf_file in pdf_files]
 
-    # Process each chunk to generate embeddings
-    for i, (start_idx, end_idx) in enumerate(chunk_indices):
-        start_time = time.time()
-        print(f"Chunk {i + 1}: Start char index: {start_idx}, End char index: {end_idx}")
-        #print(chunk_strings[i])
-        
-        # Tokenize sentences and move to model's device
-        encoded_input = tokenizer(chunk_strings[i], padding=True, truncation=True, return_tensors='pt').to(model.device)
-
-        # Compute token embeddings
-        with torch.no_grad():
-            model_output = model(**encoded_input)#['sentence_embedding']
-            #print(model_output['sentence_embedding'].shape)
-            # Use CLS pooling (assuming CLS token is the first token)
-            sentence_embeddings = model_output[0][:, 0]  # Shape should be (1, embedding_dim)
-            
-            # Check the shape and move to CPU for numpy conversion
-            if sentence_embeddings.shape[0] == 1:
-                sentence_embeddings = sentence_embeddings.squeeze(0)  # Remove batch dimension if needed
+    # One engine call for every chunk of every file, sorted and batched by token length
+    start_time = time.time()
+    embeddings = embedder.embed_groups([chunk_strings for chunk_strings, _ in parsed])
+    print(f"Time taken to embed {len(pdf_files)} files: {time.time() - start_time:.2f} seconds")
 
-            print(f"Embeddings shape: {sentence_embeddings.shape}")
-            
-            # Move to CPU and scale the embedding
-            sentence_embeddings_scaled = sentence_embeddings.cpu().numpy() / 20.0
-            
-            # Ensure embedding is of size `embedding_dim` (pad or truncate if necessary)
-            if sentence_embeddings_scaled.shape[0] != embedding_dim:
-                # Handle size mismatch: pad if smaller
-                if sentence_embeddings_scaled.shape[0] < embedding_dim:
-                    padded_embedding = np.pad(sentence_embeddings_scaled, (0, embedding_dim - sentence_embeddings_scaled.shape[0]), 'constant')
-                else:
-                    # Truncate if larger
-                    padded_embedding = sentence_embeddings_scaled[:embedding_dim]
-            else:
-                padded_embedding = sentence_embeddings_scaled
-    
-            # Store chunk data
-            document_data["chunks"].append({
-                "start_id": start_idx,
-                "end_id": end_idx,
-                "embedding": padded_embedding,
-            })
-            
-        print(f"Time taken to embed last chunk: {time.time() - start_time:.2f} seconds")
     # Save the document embeddings to binary
     global doc_id_counter
-    save_document_to_binary(doc_id=doc_id_counter, document_data=document_data)
-    doc_id_counter += 1  # Increment the document ID counter
+    saved = []
+    for pdf_file, (chunk_strings, chunk_indices), doc_embeddings in zip(pdf_files, parsed, embeddings):
+        save_document_to_binary(doc_id=doc_id_counter, document_data=build_document_data(chunk_indices, doc_embeddings))
+        saved.append((pdf_file, doc_id_counter))
+        doc_id_counter += 1  # Increment the document ID counter
+    return saved
     
 def save_last_document_id():
     with open(doc_id_file_path, 'wb') as f:
@@ -618,30 +417,18 @@ value_to_key_file = 'value_to_key.db'  # doc_id -> pdf_file
 
 def load_doc_mapping_by_key(pdf_file):
     """Load a single document mapping using the pdf_file (key)."""
-    try:
-        with shelve.open(key_to_value_file, flag='r') as db:
-            # Return the doc_id for the given pdf_file, or None if not found
-            return db.get(str(pdf_file), None)
-    except (FileNotFoundError, KeyError) as e:
-        # If the file doesn't exist or the key is not found, handle it gracefully
-        print(f"Error loading mapping for '{pdf_file}' by key: {e}")
-        return None
+    return get_mapping_service().doc_id(pdf_file)
 
 def load_doc_mapping_by_value(doc_id):
     """Load a single document mapping using the doc_id (value)."""
-    try:
-        with shelve.open(value_to_key_file, flag='r') as db:
-            # Return the pdf_file for the given doc_id, or None if not found
-            return db.get(str(doc_id), None)
-    except (FileNotFoundError, KeyError) as e:
-        # If the file doesn't exist or the key is not found, handle it gracefully
-        print(f"Error loading mapping for doc_id '{doc_id}' by value: {e}")
-        return None
+    return get_mapping_service().doc_file(doc_id)
         
 def save_doc_mapping(pdf_file, doc_id):
     doc_id -= 1
     """Save a single document mapping in both key-to-value and value-to-key databases."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Key to value (pdf_file -> doc_id)
         with shelve.open(key_to_value_file, flag='c') as key_db:
             key_db[pdf_file] = doc_id  # Save or update the mapping
@@ -660,6 +447,8 @@ def save_doc_mapping(pdf_file, doc_id):
 def delete_doc_mapping_by_key(pdf_file):
     """Delete a specific document mapping using the pdf_file (key)."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Key to value (pdf_file -> doc_id)
         with shelve.open(key_to_value_file, flag='c') as key_db:
             if pdf_file in key_db:
@@ -687,6 +476,8 @@ def delete_doc_mapping_by_key(pdf_file):
 def delete_doc_mapping_by_value(doc_id):
     """Delete a specific document mapping using the doc_id (value)."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Value to key (doc_id -> pdf_file)
         with shelve.open(value_to_key_file, flag='c') as value_db:
             if doc_id in value_db:
@@ -727,21 +518,11 @@ def ensure_db_exists():
 
 def check_key_exists(pdf_file):
     """Check if a pdf_file exists in the key-to-value mapping (key file)."""
-    try:
-        with shelve.open(key_to_value_file, flag='r') as db:
-            return pdf_file in db  # Return True if the key exists, else False
-    except (FileNotFoundError, KeyError) as e:
-        print(f"Error checking existence of '{pdf_file}': {e}")
-        return False
+    return get_mapping_service().contains(key_to_value_file, pdf_file)
 
 def check_value_exists(doc_id):
     """Check if a doc_id exists in the value-to-key mapping (value file)."""
-    try:
-        with shelve.open(value_to_key_file, flag='r') as db:
-            return str(doc_id) in db  # Return True if the value exists, else False
-    except (FileNotFoundError, KeyError) as e:
-        print(f"Error checking existence of doc_id '{doc_id}': {e}")
-        return False
+    return get_mapping_service().contains(value_to_key_file, doc_id)
     
 def main():
     start_time = time.time()
@@ -758,28 +539,39 @@ def main():
     pdf_folder = "D:/pyfiles/HumanDiseaseOntology-main/HumanDiseaseOntology-main/disease_symptoms"
     skip_until = 0
     skip = 1
+    # Number of files whose chunks are embedded together in shared batches
+    files_per_batch = 8
+
+    pending = []
     for pdf_file in os.listdir(pdf_folder):
         if pdf_file.endswith(".txt"):
-            try:
-                pdf_path = os.path.join(pdf_folder, pdf_file)
-                print(f"Processing PDF: {pdf_path}")
-
-                # Process the current PDF file
-                start_time = time.time()
-                if not check_key_exists(pdf_file):
-                    process_pdf(pdf_path)  # Process and embed PDF content
-                    # Save mapping for the processed file immediately
-                    save_doc_mapping(pdf_file, doc_id_counter)
-                    
-                    # Increment the document ID after processing
-                    #doc_id_counter += 1
-                    save_last_document_id()
-                    print(f"Time taken to process PDF: {time.time() - start_time:.2f} seconds")
-                else:
-                    print(f"Skipping: {pdf_file}, with value, {load_doc_mapping_by_key(pdf_file)}")
-                
-            except Exception as e:
-                print(f"Error: {e}\nSkipping document")
+            if not check_key_exists(pdf_file):
+                pending.append(pdf_file)
+            else:
+                print(f"Skipping: {pdf_file}, with value, {load_doc_mapping_by_key(pdf_file)}")
+
+    for batch_start in range(0, len(pending), files_per_batch):
+        batch_files = pending[batch_start:batch_start + files_per_batch]
+        batch_paths = [os.path.join(pdf_folder, pdf_file) for pdf_file in batch_files]
+        print(f"Processing PDFs: {batch_paths}")
+
+        batch_time = time.time()
+        try:
+            saved = process_pdfs(batch_paths)  # Process and embed PDF content
+        except Exception as e:
+            print(f"Error: {e}\nRetrying batch one document at a time")
+            saved = []
+            for pdf_path in batch_paths:
+                try:
+                    saved.extend(process_pdf(pdf_path))
+                except Exception as e:
+                    print(f"Error: {e}\nSkipping document")
+
+        for pdf_path, doc_id in saved:
+            # Save mapping for the processed file (save_doc_mapping expects the next counter value)
+            save_doc_mapping(os.path.basename(pdf_path), doc_id + 1)
+        save_last_document_id()
+        print(f"Time taken to process {len(saved)} PDFs: {time.time() - batch_time:.2f} seconds")
 
     print(f"Document mappings saved. Total time taken: {time.time() - start_time:.2f} seconds")
     
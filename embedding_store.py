@@ -0,0 +1,280 @@
+"""
+Consolidated, append-only embedding store replacing one documents4/{doc_id}.npy per document.
+
+Layout of a store directory:
+
+    meta.json       committed row/document counts, embedding dim and dtype
+    embeddings.bin  one contiguous (rows, dim) float32 or float16 matrix
+    chunks.bin      parallel (doc_id, chunk_index, start_id, end_id) records, one per row
+    docs.bin        doc offset table: (doc_id, row_start, n_rows), one per appended document
+
+Appends go to the end of the three data files and only become visible when
+meta.json is atomically replaced on commit(), so readers never see a partial
+document and a crashed writer is rolled back to the last commit when reopened.
+"""
+import os
+import sys
+import json
+import time
+import numpy as np
+
+store_folder = 'embedding_store'
+embedding_dim = 1024
+
+chunk_dtype = np.dtype([('doc_id', 'i4'), ('chunk_index', 'i4'), ('start_id', 'i4'), ('end_id', 'i4')])
+doc_dtype = np.dtype([('doc_id', 'i4'), ('row_start', 'i8'), ('n_rows', 'i4')])
+
+# Layout of the legacy per-document files written by save_document_to_binary
+legacy_dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (embedding_dim,))]
+
+
+def _paths(store_dir):
+    return {
+        'meta': os.path.join(store_dir, 'meta.json'),
+        'embeddings': os.path.join(store_dir, 'embeddings.bin'),
+        'chunks': os.path.join(store_dir, 'chunks.bin'),
+        'docs': os.path.join(store_dir, 'docs.bin'),
+    }
+
+
+def load_meta(store_dir=store_folder):
+    """Return the committed metadata of a store, or None if it does not exist."""
+    meta_path = _paths(store_dir)['meta']
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r') as f:
+        return json.load(f)
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class EmbeddingStoreWriter:
+    """Appends documents to a store; nothing is visible to readers until commit()."""
+
+    def __init__(self, store_dir=store_folder, dim=embedding_dim, dtype='float32'):
+        self.store_dir = store_dir
+        self.paths = _paths(store_dir)
+        os.makedirs(store_dir, exist_ok=True)
+
+        meta = load_meta(store_dir)
+        if meta is None:
+            meta = {'dim': dim, 'dtype': np.dtype(dtype).name, 'rows': 0, 'docs': 0}
+            for key in ('embeddings', 'chunks', 'docs'):
+                open(self.paths[key], 'wb').close()
+            _write_json_atomic(self.paths['meta'], meta)
+        self.meta = meta
+        self.dim = meta['dim']
+        self.dtype = np.dtype(meta['dtype'])
+
+        # Drop anything appended after the last commit (interrupted writer)
+        self._truncate(self.meta['rows'], self.meta['docs'])
+        self.rows = self.meta['rows']
+        self.docs = self.meta['docs']
+        self.files = {key: open(self.paths[key], 'ab') for key in ('embeddings', 'chunks', 'docs')}
+
+    def _truncate(self, rows, docs):
+        sizes = {
+            'embeddings': rows * self.dim * self.dtype.itemsize,
+            'chunks': rows * chunk_dtype.itemsize,
+            'docs': docs * doc_dtype.itemsize,
+        }
+        for key, size in sizes.items():
+            with open(self.paths[key], 'r+b') as f:
+                f.truncate(size)
+
+    def append_document(self, doc_id, chunk_indices, embeddings):
+        """Append one document's chunks; returns the first row it occupies."""
+        embeddings = np.asarray(embeddings, dtype=self.dtype).reshape(-1, self.dim)
+        indices = np.asarray(chunk_indices, dtype=np.int32).reshape(-1, 2)
+        if len(indices) != len(embeddings):
+            raise ValueError("Each chunk needs exactly one embedding.")
+
+        chunks = np.zeros(len(indices), dtype=chunk_dtype)
+        chunks['doc_id'] = doc_id
+        chunks['chunk_index'] = np.arange(len(indices))
+        chunks['start_id'] = indices[:, 0]
+        chunks['end_id'] = indices[:, 1]
+        doc = np.array([(doc_id, self.rows, len(indices))], dtype=doc_dtype)
+
+        self.files['embeddings'].write(np.ascontiguousarray(embeddings).tobytes())
+        self.files['chunks'].write(chunks.tobytes())
+        self.files['docs'].write(doc.tobytes())
+
+        row_start = self.rows
+        self.rows += len(indices)
+        self.docs += 1
+        return row_start
+
+    def commit(self):
+        """Make every appended document durable and visible to readers."""
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self.meta = dict(self.meta, rows=self.rows, docs=self.docs)
+        _write_json_atomic(self.paths['meta'], self.meta)
+
+    def rollback(self):
+        """Discard everything appended since the last commit."""
+        for f in self.files.values():
+            f.close()
+        self._truncate(self.meta['rows'], self.meta['docs'])
+        self.rows = self.meta['rows']
+        self.docs = self.meta['docs']
+        self.files = {key: open(self.paths[key], 'ab') for key in ('embeddings', 'chunks', 'docs')}
+
+    def rollback_to(self, meta):
+        """Discard everything after an earlier committed `meta` (a copy of self.meta), committed or not."""
+        self.meta = dict(meta)
+        _write_json_atomic(self.paths['meta'], self.meta)
+        self.rollback()
+
+    def close(self):
+        self.commit()
+        for f in self.files.values():
+            f.close()
+
+
+class EmbeddingStore:
+    """Read-only view of the committed part of a store, backed by memory maps.
+
+    `embeddings` and `chunks` are row-aligned and every accessor returns views
+    into the maps rather than copies.
+    """
+
+    def __init__(self, store_dir=store_folder):
+        self.store_dir = store_dir
+        self.paths = _paths(store_dir)
+        self.refresh()
+
+    def refresh(self):
+        """Re-read meta.json and remap the files to pick up new commits."""
+        meta = load_meta(self.store_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No embedding store found in {self.store_dir}.")
+        self.meta = meta
+        self.dim = meta['dim']
+        self.dtype = np.dtype(meta['dtype'])
+        rows = meta['rows']
+        docs = meta['docs']
+
+        if rows:
+            self.embeddings = np.memmap(self.paths['embeddings'], dtype=self.dtype, mode='r', shape=(rows, self.dim))
+            self.chunks = np.memmap(self.paths['chunks'], dtype=chunk_dtype, mode='r', shape=(rows,))
+        else:
+            self.embeddings = np.zeros((0, self.dim), dtype=self.dtype)
+            self.chunks = np.zeros(0, dtype=chunk_dtype)
+        if docs:
+            self.docs = np.memmap(self.paths['docs'], dtype=doc_dtype, mode='r', shape=(docs,))
+        else:
+            self.docs = np.zeros(0, dtype=doc_dtype)
+
+        # Dense doc_id -> entry in the doc table; a re-appended doc_id points at its latest entry
+        size = int(self.docs['doc_id'].max()) + 1 if docs else 0
+        self.doc_index = np.full(size, -1, dtype=np.int64)
+        self.doc_index[self.docs['doc_id']] = np.arange(docs)
+
+        # Rows of superseded document versions; None when every row is live
+        self.live = None
+        if docs and np.count_nonzero(self.doc_index >= 0) != docs:
+            self.live = np.zeros(rows, dtype=bool)
+            for entry in self.docs[self.doc_index[self.doc_index >= 0]]:
+                self.live[entry['row_start']:entry['row_start'] + entry['n_rows']] = True
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def doc_ids(self):
+        """All doc IDs present in the store."""
+        return np.nonzero(self.doc_index >= 0)[0]
+
+    def has_document(self, doc_id):
+        return 0 <= doc_id < len(self.doc_index) and self.doc_index[doc_id] >= 0
+
+    def doc_rows(self, doc_id):
+        """Return the row slice holding `doc_id`'s chunks."""
+        if not self.has_document(doc_id):
+            raise KeyError(f"Document {doc_id} is not in the embedding store.")
+        entry = self.docs[self.doc_index[doc_id]]
+        row_start = int(entry['row_start'])
+        return slice(row_start, row_start + int(entry['n_rows']))
+
+    def get_document(self, doc_id):
+        """Return (chunks, embeddings) views for one document."""
+        rows = self.doc_rows(doc_id)
+        return self.chunks[rows], self.embeddings[rows]
+
+    def get_embedding(self, doc_id, chunk_index):
+        """Return the embedding view for one (doc_id, chunk_index)."""
+        rows = self.doc_rows(doc_id)
+        if not 0 <= chunk_index < rows.stop - rows.start:
+            raise IndexError(f"Chunk {chunk_index} out of range for document {doc_id}.")
+        return self.embeddings[rows.start + chunk_index]
+
+    def rows_for(self, doc_ids, chunk_indices):
+        """Vectorized (doc_id, chunk_index) -> row lookup.
+
+        Raises:
+            KeyError: If a doc_id is not in the store.
+            IndexError: If a chunk_index is out of range for its document.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        chunk_indices = np.asarray(chunk_indices, dtype=np.int64)
+        positions = np.full(doc_ids.shape, -1, dtype=np.int64)
+        known = (doc_ids >= 0) & (doc_ids < len(self.doc_index))
+        positions[known] = self.doc_index[doc_ids[known]]
+        if (positions < 0).any():
+            missing = np.unique(doc_ids[positions < 0])
+            raise KeyError(f"Documents {missing[:10].tolist()} are not in the embedding store.")
+        entries = self.docs[positions]
+        if ((chunk_indices < 0) | (chunk_indices >= entries['n_rows'])).any():
+            raise IndexError("Chunk index out of range for its document.")
+        return entries['row_start'] + chunk_indices
+
+
+def migrate_documents4(src_folder='documents4', store_dir=store_folder, dtype='float32', commit_every=500):
+    """Copy every documents4/{doc_id}.npy file into a consolidated store.
+
+    Documents already in the store are skipped, so an interrupted migration can
+    simply be run again.
+    """
+    start_time = time.time()
+    writer = EmbeddingStoreWriter(store_dir, dtype=dtype)
+    existing = EmbeddingStore(store_dir)
+
+    doc_ids = sorted(int(name[:-4]) for name in os.listdir(src_folder)
+                     if name.endswith('.npy') and name[:-4].isdigit())
+    migrated = 0
+    for doc_id in doc_ids:
+        if existing.has_document(doc_id):
+            continue
+        try:
+            document = np.memmap(os.path.join(src_folder, f"{doc_id}.npy"), dtype=legacy_dtype, mode='r')
+        except ValueError as e:
+            print(f"Error loading document {doc_id}: {e}\nSkipping document")
+            continue
+        chunk_indices = np.stack([document['start_id'], document['end_id']], axis=1)
+        writer.append_document(doc_id, chunk_indices, document['embedding'])
+        del document
+        migrated += 1
+        if migrated % commit_every == 0:
+            writer.commit()
+            print(f"Migrated {migrated} documents")
+
+    writer.close()
+    print(f"Migrated {migrated} documents ({writer.rows} chunks in store). "
+          f"Total time taken: {time.time() - start_time:.2f} seconds")
+    return migrated
+
+
+if __name__ == '__main__':
+    src_folder = sys.argv[1] if len(sys.argv) > 1 else 'documents4'
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else store_folder
+    dtype = sys.argv[3] if len(sys.argv) > 3 else 'float32'
+    migrate_documents4(src_folder, store_dir, dtype)
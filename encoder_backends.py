@@ -0,0 +1,161 @@
+"""
+CPU inference backends for the bge-m3 encoder behind BatchEmbedder.
+
+    torch       eager PyTorch, the reference (BatchEmbedder's default path)
+    int8        torch dynamic int8 quantization of every nn.Linear
+    onnx        ONNX Runtime session over an exported graph that returns the CLS rows
+    onnx-int8   the same graph with its MatMul weights quantized to int8 by ONNX Runtime
+
+A backend is a callable (input_ids, attention_mask) -> CLS array with a
+`name` and a `dtype` (which keeps query-cache entries apart), so
+BatchEmbedder keeps the tokenizing, length batching and scaling. The
+quantized backends change the vectors slightly; parity() reports the cosine
+similarity to the float model over a list of texts so a backend can be
+checked before its vectors are mixed with an existing store.
+
+Exported graphs live in onnx_folder; bge-m3 is larger than protobuf's 2 GB
+limit, so the weights are written as external data next to model.onnx.
+"""
+import os
+import time
+import numpy as np
+
+from batch_embedder import BatchEmbedder
+
+backend_names = ('torch', 'int8', 'onnx', 'onnx-int8')
+
+onnx_folder = 'encoder_onnx'
+
+
+class TorchBackend:
+    """Eager PyTorch forward pass, CLS pooling."""
+
+    name = 'torch'
+
+    def __init__(self, model):
+        self.model = model
+        self.dtype = str(model.dtype)
+
+    def __call__(self, input_ids, attention_mask):
+        import torch
+
+        with torch.no_grad():
+            output = self.model(input_ids=torch.from_numpy(input_ids).to(self.model.device),
+                                attention_mask=torch.from_numpy(attention_mask).to(self.model.device))
+            return output[0][:, 0].float().cpu().numpy()
+
+
+class Int8Backend(TorchBackend):
+    """Dynamic int8 quantization of the Linear layers (weights int8, activations quantized per batch)."""
+
+    name = 'int8'
+
+    def __init__(self, model):
+        import torch
+
+        model = torch.ao.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(model)
+        self.dtype = 'qint8-dynamic'
+
+
+class OnnxBackend:
+    """ONNX Runtime session over a graph written by export_onnx().
+
+    Args:
+        path (str): model.onnx path.
+        threads (int): Intra-op threads; ONNX Runtime picks when None.
+    """
+
+    name = 'onnx'
+
+    def __init__(self, path, threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.dtype = 'onnx-int8' if path.endswith('.int8.onnx') else 'onnx-fp32'
+
+    def __call__(self, input_ids, attention_mask):
+        return self.session.run(['cls'], {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+
+
+def export_onnx(model, folder=onnx_folder, opset=17):
+    """Export `model` to folder/model.onnx with dynamic batch and sequence axes; returns the path."""
+    import torch
+
+    class ClsEncoder(torch.nn.Module):
+        # Only the CLS rows leave the graph, not the whole last hidden state
+        def __init__(self, encoder):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, input_ids, attention_mask):
+            return self.encoder(input_ids=input_ids, attention_mask=attention_mask)[0][:, 0]
+
+    start_time = time.time()
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'model.onnx')
+    dummy = torch.ones((2, 16), dtype=torch.int64)
+    axes = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(ClsEncoder(model.cpu().eval()), (dummy, dummy), path, opset_version=opset,
+                          input_names=['input_ids', 'attention_mask'], output_names=['cls'],
+                          dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'cls': {0: 'batch'}})
+    print(f"Exported {path}: {time.time() - start_time:.2f} seconds")
+    return path
+
+
+def quantize_onnx(path):
+    """Write an int8-weight copy of an exported graph next to it and return its path."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    start_time = time.time()
+    int8_path = path[:-len('.onnx')] + '.int8.onnx'
+    quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8, use_external_data_format=True)
+    print(f"Quantized {int8_path}: {time.time() - start_time:.2f} seconds")
+    return int8_path
+
+
+def make_backend(name, model=None, folder=onnx_folder, threads=None):
+    """Backend `name` (see backend_names); ONNX graphs are exported from `model` on first use."""
+    if name == 'torch':
+        return TorchBackend(model)
+    if name == 'int8':
+        return Int8Backend(model)
+    if name in ('onnx', 'onnx-int8'):
+        path = os.path.join(folder, 'model.onnx')
+        int8_path = os.path.join(folder, 'model.int8.onnx')
+        target = path if name == 'onnx' else int8_path
+        if not os.path.exists(target):
+            if not os.path.exists(path):
+                if model is None:
+                    raise ValueError(f"{path} does not exist; pass the torch model to export it")
+                export_onnx(model, folder)
+            if name == 'onnx-int8':
+                quantize_onnx(path)
+        return OnnxBackend(target, threads)
+    raise ValueError(f"Unknown encoder backend {name!r}, expected one of {backend_names}")
+
+
+def make_embedder(name, tokenizer, model=None, folder=onnx_folder, threads=None, **kwargs):
+    """BatchEmbedder running on backend `name`; kwargs go to BatchEmbedder."""
+    if name == 'torch':
+        return BatchEmbedder(tokenizer, model, **kwargs)
+    return BatchEmbedder(tokenizer, None, backend=make_backend(name, model, folder, threads), **kwargs)
+
+
+def parity(reference, candidate, texts):
+    """Cosine similarity between two embedders' vectors for the same texts.
+
+    Returns:
+        dict: min / mean / p01 (1st percentile) cosine over `texts`.
+    """
+    a = reference.embed(texts)
+    b = candidate.embed(texts)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    norms[norms == 0] = 1.0
+    cosine = np.sum(a * b, axis=1) / norms
+    return {'min': float(cosine.min()), 'mean': float(cosine.mean()), 'p01': float(np.percentile(cosine, 1))}
@@ -0,0 +1,207 @@
+"""
+Approximate symptom-name lookup over every symptom and synonym string.
+
+Names are normalized (lowercase, punctuation dropped, single spaces) and
+split into padded character trigrams. Trigram postings list the symptom IDs
+containing them, so a query only touches the postings of its own trigrams:
+candidates are counted with one bincount, ranked by trigram Dice similarity,
+and the best few are verified with a bounded edit distance (Levenshtein plus
+adjacent transpositions, so "jiont" is one edit from "joint").
+
+Layout of an index directory (trigrams packed as three 21-bit code points):
+
+    meta.json        symptom count
+    keys.npy         sorted packed trigrams
+    offsets.npy      (n_keys + 1) offsets into ids.npy
+    ids.npy          symptom IDs per trigram
+    gram_counts.npy  distinct trigrams per symptom ID (0 = no name)
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+from typing import NamedTuple
+import numpy as np
+
+from symptom_dictionary import SymptomDictionary, dictionary_folder
+
+fuzzy_folder = 'fuzzy_symptom_index'
+
+word_pattern = re.compile(r"\w+")
+
+
+class FuzzyMatch(NamedTuple):
+    symptom_id: int
+    name: str
+    distance: int
+    similarity: float
+
+
+def normalize_name(name):
+    """Lowercase, keep word characters only, single spaces."""
+    return ' '.join(word_pattern.findall(name.lower()))
+
+
+def trigrams(name):
+    """Distinct packed trigrams of a normalized name, padded as '  name '."""
+    padded = f"  {name} "
+    codes = [ord(c) for c in padded]
+    return {(codes[i] << 42) | (codes[i + 1] << 21) | codes[i + 2] for i in range(len(codes) - 2)}
+
+
+def bounded_edit_distance(a, b, max_distance):
+    """Optimal string alignment distance of a and b, or max_distance + 1 once it must exceed it."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    before = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if cost and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                value = min(value, before[j - 2] + 1)
+            current.append(value)
+        # A transposition can still lower the next row by one
+        if min(current) > max_distance + 1:
+            return max_distance + 1
+        before, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class FuzzySymptomIndex:
+    """Trigram index for approximate symptom-name resolution.
+
+    Args:
+        index_dir (str): Directory written by build().
+        dictionary (SymptomDictionary): Dictionary the IDs refer to; loaded from dict_dir when None.
+    """
+
+    def __init__(self, index_dir=fuzzy_folder, dictionary=None, dict_dir=dictionary_folder):
+        self.index_dir = index_dir
+        self.dictionary = dictionary or SymptomDictionary(dict_dir)
+        with open(self._path('meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.keys = np.load(self._path('keys.npy'), mmap_mode='r').view(np.ndarray)
+        self.offsets = np.load(self._path('offsets.npy'), mmap_mode='r').view(np.ndarray)
+        self.ids = np.load(self._path('ids.npy'), mmap_mode='r').view(np.ndarray)
+        self.gram_counts = np.load(self._path('gram_counts.npy')).astype(np.float32)
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    @classmethod
+    def build(cls, dictionary, index_dir=fuzzy_folder):
+        """Index every symptom name of a SymptomDictionary."""
+        start_time = time.time()
+        n_symptoms = len(dictionary.symptoms)
+        gram_counts = np.zeros(n_symptoms, dtype=np.int32)
+        grams, owners = [], []
+        for symptom_id in range(n_symptoms):
+            name = dictionary.symptom_name(symptom_id)
+            if not name:
+                continue
+            name_grams = trigrams(normalize_name(name))
+            gram_counts[symptom_id] = len(name_grams)
+            grams.extend(name_grams)
+            owners.extend([symptom_id] * len(name_grams))
+        grams = np.array(grams, dtype=np.int64)
+        owners = np.array(owners, dtype=np.int32)
+        order = np.lexsort((owners, grams))
+        grams, owners = grams[order], owners[order]
+        keys, starts = np.unique(grams, return_index=True)
+        offsets = np.append(starts, len(grams)).astype(np.int64)
+
+        tmp_dir = index_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'keys.npy'), keys)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, 'ids.npy'), owners)
+        np.save(os.path.join(tmp_dir, 'gram_counts.npy'), gram_counts)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'symptoms': int(np.count_nonzero(gram_counts)), 'trigrams': len(keys)}, f)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.rename(tmp_dir, index_dir)
+        print(f"Indexed {np.count_nonzero(gram_counts)} symptom names, {len(keys)} trigrams: "
+              f"{time.time() - start_time:.2f} seconds")
+        return cls(index_dir, dictionary)
+
+    def candidates(self, name, min_similarity=0.2, limit=100):
+        """(symptom_ids, Dice similarities) of the best trigram matches, best first."""
+        query = np.array(sorted(trigrams(normalize_name(name))), dtype=np.int64)
+        pos = np.searchsorted(self.keys, query)
+        pos[pos == len(self.keys)] = 0
+        pos = pos[self.keys[pos] == query]
+        if not len(pos):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        postings = np.concatenate([self.ids[self.offsets[p]:self.offsets[p + 1]] for p in pos])
+        common = np.bincount(postings, minlength=len(self.gram_counts)).astype(np.float32)
+        found = np.nonzero(common)[0]
+        similarity = 2.0 * common[found] / (len(query) + self.gram_counts[found])
+        keep = similarity >= min_similarity
+        found, similarity = found[keep], similarity[keep]
+        if len(found) > limit:
+            top = np.argpartition(-similarity, limit - 1)[:limit]
+            found, similarity = found[top], similarity[top]
+        order = np.argsort(-similarity, kind='stable')
+        return found[order], similarity[order]
+
+    def search(self, name, k=5, max_distance=3, min_similarity=0.2, limit=100):
+        """Ranked FuzzyMatch list for one name.
+
+        Candidates come from trigram similarity (at most `limit`), are verified
+        with an edit distance of at most `max_distance` (None skips the
+        check) and are ranked by distance, then similarity.
+        """
+        query = normalize_name(name)
+        ids, similarities = self.candidates(name, min_similarity, limit)
+        matches = []
+        for symptom_id, similarity in zip(ids.tolist(), similarities.tolist()):
+            candidate = self.dictionary.symptom_name(symptom_id)
+            if max_distance is None:
+                distance = -1
+            else:
+                distance = bounded_edit_distance(query, normalize_name(candidate), max_distance)
+                if distance > max_distance:
+                    continue
+            matches.append(FuzzyMatch(symptom_id, candidate, distance, similarity))
+        matches.sort(key=lambda m: (m.distance, -m.similarity))
+        return matches[:k]
+
+    def search_many(self, names, k=5, max_distance=3, min_similarity=0.2, limit=100):
+        return [self.search(name, k, max_distance, min_similarity, limit) for name in names]
+
+    def resolve(self, name, max_distance=3, min_similarity=0.2):
+        """Symptom ID for a name: the exact entry if there is one, else the best fuzzy match, else -1."""
+        symptom_id = self.dictionary.symptom_id(name.strip().lower())
+        if symptom_id >= 0:
+            return symptom_id
+        matches = self.search(name, 1, max_distance, min_similarity)
+        return matches[0].symptom_id if matches else -1
+
+
+def find_symptoms(symptom_name, k=5):
+    """Closest symptom names to a possibly misspelled one, as FuzzyMatch records.
+
+    Served by the diagnosis engine's index; before fuzzy_symptom_index.py has
+    been run only the exact (case-insensitive) name is found.
+    """
+    # diagnosis_engine imports this module
+    from diagnosis_engine import get_diagnosis_engine
+
+    engine = get_diagnosis_engine()
+    if engine.fuzzy is None:
+        symptom_id = engine.dictionary.symptom_id(symptom_name.strip().lower())
+        return [FuzzyMatch(symptom_id, engine.dictionary.symptom_name(symptom_id), 0, 1.0)] if symptom_id >= 0 else []
+    return engine.fuzzy.search(symptom_name, k)
+
+
+if __name__ == '__main__':
+    dictionary = SymptomDictionary(dictionary_folder)
+    index = FuzzySymptomIndex.build(dictionary, fuzzy_folder)
+    for name in sys.argv[1:]:
+        print(name, index.search(name))
@@ -1,8 +1,8 @@
 import re
 import pprint
 import os
-import requests
-import time
+
+from generation_engine import GenerationEngine
 
 # Replace with your TogetherAI API Key
 # Set your Together API key
@@ -136,52 +136,51 @@ def parse_obo_to_dict(entries: str) -> list:
     return terms
 
 # Function to generate medical data using TogetherAI for each category and save it in a text file
-def generate_medical_data_with_togetherAI(categories, disease_name, output_file="medical_data.txt"):
+def generate_medical_data_with_togetherAI(categories, disease_name, output_file="medical_data.txt", engine=None):
+    """
+    Generates every category for one disease and writes them to `output_file`.
+
+    The file is written to a temporary name and renamed at the end, so it only
+    exists once every category was generated; a failed category raises (after
+    the engine's retries) instead of leaving "Error generating data." behind.
+
+    Args:
+        categories (dict): Category name -> description added to the prompt.
+        disease_name (str): The disease to describe.
+        output_file (str): Destination text file.
+        engine (GenerationEngine): Engine to send the requests through; the module's engine if None.
+
+    Returns:
+        dict: Category name -> generated content.
+    """
+    engine = engine or get_engine()
     results = {}
-    with open(output_file, "w", encoding="utf-8") as file:
-        for category, description in categories.items():
-            prompt = f"Generate a detailed description for the '{category}' category related to the disease '{disease_name}'. {description}"
-            
-            message_array = [
-                {"role": "system", "content": "You are a medical expert tasked with generating medically accurate and detailed information for diseases in various categories."},
-                {"role": "user", "content": prompt}
-            ]
-            
-            headers = {
-                "Authorization": f"Bearer {TOGETHER_API_KEY}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                'https://api.together.xyz/v1/chat/completions',
-                headers=headers,
-                json={
-                    "model": "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
-                    "messages": message_array
-                }
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                content = data['choices'][0]['message']['content'].strip()
-                print(f"{category}:\n{content}\n")
-                results[category] = content
-                
-                # Write content to text file
-                file.write(f"### {category} ###\n")
-                file.write(content + "\n\n")
-            else:
-                error_message = f"Error for {category}: {response.text}"
-                print(error_message)
-                results[category] = "Error generating data."
-                
-                # Write error to text file
-                file.write(f"### {category} ###\n")
-                file.write("Error generating data.\n\n")
+    for category, description in categories.items():
+        prompt = f"Generate a detailed description for the '{category}' category related to the disease '{disease_name}'. {description}"
+        
+        message_array = [
+            {"role": "system", "content": "You are a medical expert tasked with generating medically accurate and detailed information for diseases in various categories."},
+            {"role": "user", "content": prompt}
+        ]
+        results[category] = engine.complete(message_array)
     
-    print(f"Medical data saved to {output_file}")
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        for category, content in results.items():
+            file.write(f"### {category} ###\n")
+            file.write(content + "\n\n")
+    os.replace(tmp_file, output_file)
     return results
 
+_engine = None
+
+def get_engine():
+    """The engine used for generation, created on first use."""
+    global _engine
+    if _engine is None:
+        _engine = GenerationEngine(os.environ.get("TOGETHER_API_KEY", TOGETHER_API_KEY))
+    return _engine
+
 # Medical data structure with categories
 medical_data_structure = {
     "Medical Data and Diagnostics": "Includes tests and evaluations relevant to the disease.",
@@ -233,15 +232,14 @@ def parse_obo_to_dict_from_file(file_path: str) -> list:
         #print(entries)
     return parse_obo_to_dict(entries)  # Use the existing parse_obo_to_dict function
 
-# Example of using the function with a file path
 obo_file_path = './src/ontology/doid.obo'  # Replace with your file path
-parsed_terms = parse_obo_to_dict_from_file(obo_file_path)
 
-# Add medical data structure to each term
-for term in parsed_terms:
-    term["categories"] = medical_data_structure
-
-print(parsed_terms)
+def load_terms(file_path=obo_file_path):
+    """Parse the ontology and attach the medical data structure to each term."""
+    parsed_terms = parse_obo_to_dict_from_file(file_path)
+    for term in parsed_terms:
+        term["categories"] = medical_data_structure
+    return parsed_terms
 
 
 # Generate detailed data for each term and print the results
@@ -249,12 +247,9 @@ pp = pprint.PrettyPrinter(indent=2)
 # List of unwanted terms to skip
 UNWANTED_TERMS = {"allergic", "allergy", "gene", "unknown", "generic"}
 
-curr_terms = 0
-max_terms = len(parsed_terms)
-def download_things():
-    global parsed_terms, curr_terms
-    curr_terms = 0
-    for term in parsed_terms:
+def wanted_terms(terms):
+    """Yield (disease_name, term) for the NCIthesaurus terms that should get a symptoms file."""
+    for term in terms:
         # Get the disease name and sanitize it
         disease_name = term.get("name", "Unknown Disease").replace("/", "_")
         definition = term.get("def", "Unknown Definition")
@@ -272,32 +267,44 @@ def download_things():
         
         if subset != "NCIthesaurus":
             continue
-            
-        file_path = f"./disease_symptoms/{disease_name}.txt"
-        if os.path.exists(file_path):
-            print("File exists.", file_path)
-        else:
-            print("File does not exist.")
-            if disease_name != "Unknown Disease":
-                print(f"Generating data for: {disease_name}")
-                detailed_data = generate_medical_data_with_togetherAI(term["categories"], disease_name, output_file=f"./disease_symptoms/{disease_name}.txt")
-                if detailed_data["Formatted Symptoms"]:
-                    print("Parsing")
-                    with open(file_path, "r", encoding="utf-8") as file:
-                        file_content = file.read()
-                        #print(file)
-                        temp = parse_symptoms_as_strings_with_indices(file_content)
-                        for i in temp:
-                            print(i, "\n")
-                term["detailed_data"] = detailed_data
-        curr_terms += 1
+        
+        if disease_name == "Unknown Disease":
+            continue
+        
+        yield disease_name, term
+
+def download_things(output_folder="./disease_symptoms", engine=None, obo_path=obo_file_path):
+    """
+    Generates a symptoms file for every wanted term of the ontology at `obo_path`, concurrently.
+
+    Finished diseases are recorded in the engine's manifest, so running this
+    again resumes with the ones that are missing or failed. Files written
+    before the manifest existed are recorded the first time they are seen.
+
+    Returns:
+        GenerationResult: Counts of generated and skipped diseases and the failed ones.
+    """
+    engine = engine or get_engine()
+    parsed_terms = load_terms(obo_path)
+    os.makedirs(output_folder, exist_ok=True)
+
+    def items():
+        for disease_name, term in wanted_terms(parsed_terms):
+            file_path = os.path.join(output_folder, f"{disease_name}.txt")
+            if disease_name not in engine.manifest and os.path.exists(file_path):
+                engine.manifest.add(disease_name, existing=True)
+            yield disease_name, (term, file_path)
+
+    def work(disease_name, payload):
+        term, file_path = payload
+        detailed_data = generate_medical_data_with_togetherAI(term["categories"], disease_name, output_file=file_path, engine=engine)
+        symptoms = parse_symptoms_as_strings_with_indices(detailed_data.get("Formatted Symptoms", ""))
+        print(f"Generated {disease_name}: {len(symptoms)} symptoms")
+
+    return engine.run(items(), work)
 
-while curr_terms < max_terms:
-    curr_terms = 0
-    try:
-        download_things()
-    except:
-        pass
-    print("Retrying", curr_terms)
-    time.sleep(2)
+if __name__ == "__main__":
+    result = download_things()
+    if result.failed:
+        print(f"{len(result.failed)} diseases failed; run again to retry them")
     
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""
+Concurrent chat-completion engine for building the generated disease corpus.
+
+generatefromobo2.py used to call the API for one disease at a time and, after
+any exception, started over from the first ontology term. A GenerationEngine
+instead runs the items on a thread pool:
+
+    * at most `concurrency` requests are in flight,
+    * a token bucket spaces requests to `requests_per_second` (with bursts of
+      up to `burst`); a 429 pauses the whole bucket for its Retry-After,
+    * each request is retried with exponential backoff and jitter on
+      connection errors, timeouts, 429 and 5xx responses,
+    * every finished item is appended to a manifest (one JSON line per item),
+      so a restart skips completed items without touching their files and
+      resumes with the ones that were in flight or had failed.
+
+The endpoint is any OpenAI-compatible /chat/completions URL; the
+GENERATION_API_URL and GENERATION_MODEL environment variables override the
+Together AI defaults, e.g. to point at a local stub server
+(bench_generation_engine.py).
+"""
+import os
+import json
+import time
+import random
+import threading
+from typing import NamedTuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+default_api_url = os.environ.get('GENERATION_API_URL', 'https://api.together.xyz/v1/chat/completions')
+default_model = os.environ.get('GENERATION_MODEL', 'meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo')
+
+manifest_file = 'generation_manifest.jsonl'
+
+retry_statuses = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class GenerationError(Exception):
+    """A request that failed for good (non-retryable status or retries exhausted)."""
+
+
+class GenerationResult(NamedTuple):
+    done: int
+    skipped: int
+    failed: list  # keys of the items that failed; they are tried again on the next run
+    seconds: float
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        """Hand out no tokens for `seconds` (the server asked every client to slow down)."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class Manifest:
+    """Append-only record of completed item keys.
+
+    Args:
+        path (str): JSON-lines file; created when missing. A torn last line is ignored.
+    """
+
+    def __init__(self, path=manifest_file):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['key'])
+                    except (ValueError, KeyError):
+                        continue
+        self.file = open(path, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, key, **info):
+        with self.lock:
+            if key in self.done:
+                return
+            self.file.write(json.dumps({'key': key, **info}, ensure_ascii=False) + '\n')
+            self.file.flush()
+            self.done.add(key)
+
+    def close(self):
+        self.file.close()
+
+
+class GenerationEngine:
+    """Rate-limited, retrying chat completions run concurrently over many items.
+
+    Args:
+        api_key (str): Bearer token for the API.
+        api_url (str): Chat completions endpoint.
+        model (str): Model name sent with every request.
+        concurrency (int): Worker threads, i.e. requests in flight.
+        requests_per_second (float): Token bucket rate.
+        burst (int): Token bucket capacity; defaults to `concurrency`.
+        max_retries (int): Retries per request after the first attempt.
+        backoff (float): First retry delay in seconds, doubled per retry up to max_backoff.
+        max_backoff (float): Longest delay between retries; also caps a server's Retry-After.
+        timeout (float): Seconds to wait for one response.
+        manifest_path (str): Completed-items manifest.
+    """
+
+    def __init__(self, api_key, api_url=default_api_url, model=default_model, concurrency=8,
+                 requests_per_second=4.0, burst=None, max_retries=6, backoff=1.0, max_backoff=60.0,
+                 timeout=120.0, manifest_path=manifest_file):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.model = model
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(requests_per_second, burst or concurrency)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.manifest = Manifest(manifest_path)
+        self._local = threading.local()
+
+    def _session(self):
+        # One pooled connection per worker thread
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update({"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"})
+        return session
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(self.max_backoff, float(retry_after))
+            except ValueError:
+                pass
+        # Full jitter keeps the workers that failed together from retrying together
+        return random.uniform(0.5, 1.0) * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def complete(self, messages, **params):
+        """Content of one chat completion for `messages`, retried with backoff.
+
+        Raises:
+            GenerationError: On a non-retryable status or once retries are exhausted.
+        """
+        payload = {"model": self.model, "messages": messages, **params}
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            response = None
+            try:
+                response = self._session().post(self.api_url, json=payload, timeout=self.timeout)
+                if response.status_code == 200:
+                    return response.json()['choices'][0]['message']['content'].strip()
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                if response.status_code not in retry_statuses:
+                    raise GenerationError(error)
+            except (requests.RequestException, ValueError, KeyError, IndexError) as e:
+                # Connection problems, timeouts and malformed bodies are worth another try
+                error = f"{type(e).__name__}: {e}"
+            if attempt == self.max_retries:
+                raise GenerationError(f"Giving up after {attempt + 1} attempts: {error}")
+            delay = self._retry_delay(attempt, response)
+            if response is not None and response.status_code == 429:
+                self.bucket.pause(delay)
+            time.sleep(delay)
+
+    def run(self, items, work):
+        """Call work(key, payload) for every (key, payload) item not in the manifest.
+
+        `work` runs on a pool thread and typically calls complete() and writes
+        its output; an item counts as done, and is recorded in the manifest,
+        when `work` returns without raising.
+
+        Returns:
+            GenerationResult: Counts of done and skipped items, the failed keys and the elapsed time.
+        """
+        start_time = time.time()
+        done, skipped, failed = 0, 0, []
+        seen = set()
+        in_flight = {}
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        def collect(finished):
+            nonlocal done
+            for future in finished:
+                key = in_flight.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(key)
+                    print(f"Failed: {key}: {e}")
+                    continue
+                self.manifest.add(key, time=round(time.time(), 3))
+                done += 1
+                if done % 100 == 0:
+                    rate = done / (time.time() - start_time)
+                    print(f"Generated {done} items ({rate:.2f} items/s), {len(failed)} failed")
+
+        try:
+            for key, payload in items:
+                if key in self.manifest or key in seen:
+                    skipped += 1
+                    continue
+                seen.add(key)
+                # Keep the queue short so an interrupt loses little and memory stays flat
+                if len(in_flight) >= 2 * self.concurrency:
+                    finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(finished)
+                in_flight[executor.submit(work, key, payload)] = key
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+        seconds = time.time() - start_time
+        print(f"Generated {done} items, skipped {skipped}, {len(failed)} failed. "
+              f"Total time taken: {seconds:.2f} seconds")
+        return GenerationResult(done, skipped, failed, seconds)
+
+    def close(self):
+        self.manifest.close()
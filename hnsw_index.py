@@ -0,0 +1,321 @@
+"""
+HNSW (hierarchical navigable small world) graph index over the embedding store.
+
+Nodes are EmbeddingStore rows and similarity is the same dot product the flat
+search uses. Level-0 links live in a memory-mapped int32 matrix so the graph
+does not have to be loaded to be served; the much smaller upper levels are
+kept in a dict and saved next to it.
+
+Layout of an index directory:
+
+    meta.json         M, ef_construction, ef_search, entry point, max level, node count,
+                      version of the files below
+    levels.V.bin      int8 top level of every node (-1 = not inserted), memmap
+    links0.V.bin      (capacity, 2 * M) int32 level-0 neighbours (-1 = empty), memmap
+    upper_keys.V.npy  (n, 2) int32 (node, level) of every upper-level link row
+    upper_links.V.npy (n, M) int32 upper-level neighbours
+
+A writer never changes the files meta.json points at: its first insert copies
+the level-0 files to the next version, and save() publishes that version by
+replacing meta.json, so readers always map a complete graph whose nodes are
+all below its count. Old versions are removed after the switch. Indexes
+written before versioning (no version in meta.json) use the unsuffixed names.
+"""
+import os
+import re
+import sys
+import shutil
+import json
+import time
+import heapq
+import numpy as np
+
+from embedding_store import EmbeddingStore, _write_json_atomic, store_folder
+from vector_search import hit_dtype, hits_from_rows
+
+hnsw_folder = 'hnsw_index'
+
+index_file_pattern = re.compile(r'(levels|links0|upper_keys|upper_links)(\.\d+)?\.(bin|npy)')
+
+
+def _file_name(name, version):
+    """`name` of index file version `version` (None = the unversioned layout)."""
+    base, ext = os.path.splitext(name)
+    return name if version is None else f'{base}.{version}{ext}'
+
+
+class HNSWIndex:
+    """HNSW graph over EmbeddingStore rows.
+
+    Args:
+        store (EmbeddingStore): Store whose rows are indexed.
+        index_dir (str): Directory holding the persisted graph.
+        M (int): Links per node on the upper levels (2 * M on level 0).
+        ef_construction (int): Candidate list size while inserting.
+        ef_search (int): Default candidate list size while searching.
+        mode (str): 'r+' to build or extend the index, 'r' to only search an existing one
+            (nothing is created or resized, and a missing index raises FileNotFoundError).
+    """
+
+    def __init__(self, store, index_dir=hnsw_folder, M=16, ef_construction=200, ef_search=64, seed=0, mode='r+'):
+        self.store = store
+        self.index_dir = index_dir
+        self.mode = mode
+        meta_path = self._path('meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                self.meta = json.load(f)
+        elif mode == 'r':
+            raise FileNotFoundError(f"No HNSW index found in {index_dir}.")
+        else:
+            os.makedirs(index_dir, exist_ok=True)
+            self.meta = {'M': M, 'ef_construction': ef_construction, 'ef_search': ef_search,
+                         'entry': -1, 'max_level': -1, 'count': 0, 'capacity': 0}
+        self.M = self.meta['M']
+        self.M0 = 2 * self.M
+        self.mL = 1.0 / np.log(self.M)
+        self.rng = np.random.default_rng(seed + self.meta['count'])
+        # True once this writer has copied the published files to a version of its own
+        self.writing = False
+        self._map_readonly()
+
+        self.upper = {}
+        if os.path.exists(self._path('upper_keys.npy')):
+            keys = np.load(self._path('upper_keys.npy'))
+            links = np.load(self._path('upper_links.npy'))
+            self.upper = {(int(node), int(level)): row for (node, level), row in zip(keys, links)}
+
+    def _path(self, name):
+        """Path of index file `name`, in the version meta.json (or this writer) uses."""
+        if name != 'meta.json':
+            name = _file_name(name, self.meta.get('version'))
+        return os.path.join(self.index_dir, name)
+
+    def _map(self, capacity):
+        """(Re)map this writer's level-0 files with room for `capacity` nodes."""
+        old_capacity = self.meta['capacity']
+        for name, width, itemsize in (('levels.bin', 1, 1), ('links0.bin', self.M0, 4)):
+            path = self._path(name)
+            with open(path, 'ab') as f:
+                f.truncate(capacity * width * itemsize)
+        self.levels = np.memmap(self._path('levels.bin'), dtype=np.int8, mode='r+', shape=(capacity,))
+        self.links0 = np.memmap(self._path('links0.bin'), dtype=np.int32, mode='r+', shape=(capacity, self.M0))
+        if capacity > old_capacity:
+            self.levels[old_capacity:] = -1
+            self.links0[old_capacity:] = -1
+        self.meta['capacity'] = capacity
+
+    def _start_version(self):
+        """Copy the published level-0 files to the next version, which only this writer changes."""
+        capacity = self.meta['capacity']
+        sources = [self._path(name) for name in ('levels.bin', 'links0.bin')]
+        self.meta['version'] = self.meta.get('version', 0) + 1
+        for source, name in zip(sources, ('levels.bin', 'links0.bin')):
+            if capacity:
+                shutil.copyfile(source, self._path(name))
+            else:
+                open(self._path(name), 'wb').close()
+        self._map(max(capacity, 1024))
+        self.writing = True
+
+    def _map_readonly(self):
+        """Map the level-0 files as saved, without touching them."""
+        capacity = self.meta['capacity']
+        if capacity:
+            self.levels = np.memmap(self._path('levels.bin'), dtype=np.int8, mode='r', shape=(capacity,))
+            self.links0 = np.memmap(self._path('links0.bin'), dtype=np.int32, mode='r', shape=(capacity, self.M0))
+        else:
+            self.levels = np.zeros(0, dtype=np.int8)
+            self.links0 = np.zeros((0, self.M0), dtype=np.int32)
+
+    def _vectors(self, nodes):
+        return np.asarray(self.store.embeddings[nodes], dtype=np.float32)
+
+    def _neighbors(self, node, level):
+        links = self.links0[node] if level == 0 else self.upper[(node, level)]
+        if self.mode == 'r':
+            # A published graph only links inserted nodes; this also guards older unversioned indexes
+            return links[(links >= 0) & (links < self.meta['count'])]
+        return links[links >= 0]
+
+    def _set_neighbors(self, node, level, neighbors):
+        row = np.full(self.M0 if level == 0 else self.M, -1, dtype=np.int32)
+        row[:len(neighbors)] = neighbors
+        if level == 0:
+            self.links0[node] = row
+        else:
+            self.upper[(node, level)] = row
+
+    def _search_layer(self, query, entry_points, ef, level):
+        """Best-first search of one level; returns [(distance, node)] ascending, distance = -dot."""
+        visited = set(entry_points)
+        distances = -(self._vectors(list(entry_points)) @ query)
+        candidates = [(float(d), node) for d, node in zip(distances, entry_points)]
+        heapq.heapify(candidates)
+        results = [(-d, node) for d, node in candidates]  # max-heap on distance
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbors = [n for n in self._neighbors(node, level).tolist() if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            # Score all unvisited neighbours with one product
+            neighbor_distances = -(self._vectors(neighbors) @ query)
+            for d, n in zip(neighbor_distances.tolist(), neighbors):
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, n) for d, n in results)
+
+    def _select_neighbors(self, candidates, M):
+        """Neighbour selection heuristic: prefer candidates closer to the node than to those already picked."""
+        nodes = [n for _, n in candidates]
+        vectors = self._vectors(nodes)
+        selected = []
+        for i, (distance, node) in enumerate(candidates):
+            if len(selected) >= M:
+                break
+            if selected and np.any(-(vectors[selected] @ vectors[i]) < distance):
+                continue
+            selected.append(i)
+        # Keep pruned connections so nodes still get M links
+        if len(selected) < M:
+            chosen = set(selected)
+            selected += [i for i in range(len(candidates)) if i not in chosen][:M - len(selected)]
+        return [nodes[i] for i in selected]
+
+    def add(self, node):
+        """Insert store row `node` into the graph."""
+        if self.mode == 'r':
+            raise ValueError(f"HNSW index in {self.index_dir} was opened read-only")
+        if not self.writing:
+            self._start_version()
+        if node >= self.meta['capacity']:
+            self._map(max(node + 1, 2 * self.meta['capacity']))
+        level = int(-np.log(1.0 - self.rng.random()) * self.mL)
+        self.levels[node] = level
+        for l in range(1, level + 1):
+            self._set_neighbors(node, l, [])
+        query = self._vectors([node])[0]
+
+        entry = self.meta['entry']
+        max_level = self.meta['max_level']
+        if entry < 0:
+            self.meta.update(entry=node, max_level=level, count=self.meta['count'] + 1)
+            return
+
+        entry_points = [entry]
+        for l in range(max_level, level, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, l)[0][1]]
+
+        for l in range(min(level, max_level), -1, -1):
+            found = self._search_layer(query, entry_points, self.meta['ef_construction'], l)
+            neighbors = self._select_neighbors(found, self.M)
+            self._set_neighbors(node, l, neighbors)
+            max_links = self.M0 if l == 0 else self.M
+            for neighbor in neighbors:
+                links = self._neighbors(neighbor, l)
+                if len(links) < max_links:
+                    self._set_neighbors(neighbor, l, np.append(links, node))
+                    continue
+                # Too many links: re-select them around the neighbour
+                candidates = np.append(links, node)
+                distances = -(self._vectors(candidates.tolist()) @ self._vectors([neighbor])[0])
+                order = np.argsort(distances)
+                self._set_neighbors(neighbor, l, self._select_neighbors(
+                    [(float(distances[i]), int(candidates[i])) for i in order], max_links))
+            entry_points = [n for _, n in found]
+
+        if level > max_level:
+            self.meta.update(entry=node, max_level=level)
+        self.meta['count'] += 1
+
+    def add_rows(self, save_every=10_000):
+        """Insert every store row not yet in the graph and persist the index."""
+        start_time = time.time()
+        start = self.meta['count']
+        for node in range(start, len(self.store)):
+            self.add(node)
+            if (node + 1 - start) % save_every == 0:
+                self.save()
+                print(f"Inserted {node + 1 - start} rows: {time.time() - start_time:.2f} seconds")
+        self.save()
+        print(f"HNSW index has {self.meta['count']} rows: {time.time() - start_time:.2f} seconds")
+        return self.meta['count'] - start
+
+    def save(self):
+        """Publish this writer's version by replacing meta.json; the next insert starts a new one."""
+        if not self.writing:
+            return
+        self.levels.flush()
+        self.links0.flush()
+        keys = np.array(list(self.upper.keys()), dtype=np.int32).reshape(-1, 2)
+        links = np.array(list(self.upper.values()), dtype=np.int32).reshape(-1, self.M)
+        for name, data in (('upper_keys.npy', keys), ('upper_links.npy', links)):
+            with open(self._path(name), 'wb') as f:
+                np.save(f, data)
+                f.flush()
+                os.fsync(f.fileno())
+        _write_json_atomic(self._path('meta.json'), self.meta)
+        self.writing = False
+        self._remove_stale_files()
+
+    def _remove_stale_files(self):
+        """Delete index files of versions meta.json no longer points at."""
+        current = {_file_name(name, self.meta.get('version'))
+                   for name in ('levels.bin', 'links0.bin', 'upper_keys.npy', 'upper_links.npy')}
+        for name in os.listdir(self.index_dir):
+            if index_file_pattern.fullmatch(name) and name not in current:
+                try:
+                    os.remove(os.path.join(self.index_dir, name))
+                except OSError:
+                    # Still mapped by a reader (Windows); removed after the next switch
+                    pass
+
+    def search(self, queries, k=10, ef_search=None):
+        """Approximate top-k search; returns hit_dtype records of shape (n_queries, <=k)."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        ef = max(ef_search or self.meta['ef_search'], k)
+        results = np.zeros((len(queries), k), dtype=hit_dtype)
+        results['score'] = -np.inf
+        results['row'] = -1
+        if self.meta['entry'] < 0:
+            return results
+        live = self.store.live
+        for q, query in enumerate(queries):
+            entry_points = [self.meta['entry']]
+            for l in range(self.meta['max_level'], 0, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, l)[0][1]]
+            found = self._search_layer(query, entry_points, ef, 0)
+            if live is not None:
+                found = [(d, n) for d, n in found if live[n]]
+            found = found[:k]
+            rows = np.array([n for _, n in found], dtype=np.int64)
+            results[q, :len(rows)] = hits_from_rows(rows, [-d for d, _ in found], self.store.chunks)
+        return results
+
+
+if __name__ == '__main__':
+    store = EmbeddingStore(store_folder)
+    index = HNSWIndex(store, hnsw_folder)
+    index.add_rows()
+    if len(sys.argv) > 1 and sys.argv[1] == 'recall':
+        from vector_search import search_store
+        rng = np.random.default_rng(0)
+        queries = np.asarray(store.embeddings[rng.choice(len(store), size=min(100, len(store)), replace=False)],
+                             dtype=np.float32)
+        exact = search_store(store, queries, 10)
+        for ef_search in (16, 32, 64, 128, 256):
+            start_time = time.time()
+            approx = index.search(queries, 10, ef_search)
+            latency = (time.time() - start_time) * 1000 / len(queries)
+            recall = sum(len(np.intersect1d(e['row'], a['row'])) for e, a in zip(exact, approx)) / exact.size
+            print(f"ef_search={ef_search:4d}: recall@10={recall:.3f}, {latency:.2f} ms/query")
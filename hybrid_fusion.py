@@ -0,0 +1,74 @@
+"""
+Fusion of dense and lexical candidate lists.
+
+Each list holds at most N (doc_id, chunk_index) candidates, best first, and
+fusion only touches those candidates, so its cost depends on N and not on
+the corpus size. Chunks are joined on a single int64 key.
+"""
+import numpy as np
+
+# Rank offset of reciprocal rank fusion (the usual value from the RRF paper)
+rrf_k = 60
+
+
+def chunk_keys(doc_ids, chunk_indices):
+    """Pack (doc_id, chunk_index) pairs into int64 keys."""
+    return (np.asarray(doc_ids, dtype=np.int64) << 32) | np.asarray(chunk_indices, dtype=np.int64)
+
+
+def split_keys(keys):
+    """Inverse of chunk_keys: returns (doc_ids, chunk_indices)."""
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> 32, keys & 0xFFFFFFFF
+
+
+def _normalize(scores):
+    """Min-max scale to [0, 1]; a constant list maps to 1."""
+    scores = np.asarray(scores, dtype=np.float32)
+    if not len(scores):
+        return scores
+    low, high = scores.min(), scores.max()
+    if high - low <= 0:
+        return np.ones_like(scores)
+    return (scores - low) / (high - low)
+
+
+def fuse(dense_keys, dense_scores, lexical_keys, lexical_scores, alpha=0.5, fusion="rrf"):
+    """Fuse two ranked candidate lists.
+
+    Args:
+        dense_keys, dense_scores: Dense candidates (chunk_keys), best first.
+        lexical_keys, lexical_scores: BM25 candidates (chunk_keys), best first.
+        alpha (float): Weight of the dense list; the lexical list gets 1 - alpha.
+        fusion (str): "rrf" (reciprocal rank fusion) or "linear" (min-max normalized scores).
+
+    Returns:
+        tuple: (keys, fused, dense, lexical) arrays over the union of the candidates,
+        sorted by fused score. `dense` / `lexical` are the raw scores, NaN where a
+        chunk was not a candidate of that list.
+    """
+    dense_keys = np.asarray(dense_keys, dtype=np.int64)
+    lexical_keys = np.asarray(lexical_keys, dtype=np.int64)
+    keys, inverse = np.unique(np.concatenate([dense_keys, lexical_keys]), return_inverse=True)
+    dense_at, lexical_at = inverse[:len(dense_keys)], inverse[len(dense_keys):]
+
+    if fusion == "rrf":
+        dense_part = 1.0 / (rrf_k + 1 + np.arange(len(dense_keys)))
+        lexical_part = 1.0 / (rrf_k + 1 + np.arange(len(lexical_keys)))
+    elif fusion == "linear":
+        dense_part = _normalize(dense_scores)
+        lexical_part = _normalize(lexical_scores)
+    else:
+        raise ValueError(f"Unknown fusion method: {fusion}")
+
+    fused = np.zeros(len(keys), dtype=np.float64)
+    np.add.at(fused, dense_at, alpha * dense_part)
+    np.add.at(fused, lexical_at, (1.0 - alpha) * lexical_part)
+
+    dense = np.full(len(keys), np.nan, dtype=np.float32)
+    dense[dense_at] = dense_scores
+    lexical = np.full(len(keys), np.nan, dtype=np.float32)
+    lexical[lexical_at] = lexical_scores
+
+    order = np.argsort(-fused, kind='stable')
+    return keys[order], fused[order].astype(np.float32), dense[order], lexical[order]
@@ -0,0 +1,398 @@
+"""
+Multi-process ingestion of the disease_symptoms folder.
+
+    feeder thread -> path_queue -> parser workers (read, regex parse, tokenize)
+                  -> parsed_queue -> embedding workers (own model copy, bounded torch threads)
+                  -> result_queue -> single writer (doc IDs, documents4/*.npy, mappings,
+                                                    BM25 index, chunk texts, cluster tree)
+
+Every queue is bounded, so at most a few batches of files are in flight and
+memory stays flat no matter how large the folder is. The writer commits in
+groups through a write-ahead log (ingest_wal.py), so a crash at any point
+leaves the stores, mappings and clusters consistent after the next start.
+"""
+import os
+import sys
+import dbm
+import queue
+import time
+import pickle
+import shelve
+import threading
+import multiprocessing as mp
+import numpy as np
+
+from symptom_parser import parse_symptoms_as_strings_with_indices
+from embedding_store import EmbeddingStoreWriter
+from bm25_index import BM25Index
+from chunk_text_store import ChunkTextWriter
+from cluster_assignment import ClusterTree
+from ingest_wal import IngestWAL, wal_file
+
+model_name = 'BAAI/bge-m3'
+documents_folder = 'documents4'
+doc_id_file_path = 'last_doc_id.pkl'
+key_to_value_file = 'key_to_value.db'  # pdf_file -> doc_id
+value_to_key_file = 'value_to_key.db'  # doc_id -> pdf_file
+
+# Sentinel put on a queue when its producers are done
+_DONE = None
+
+# Seconds the writer waits for a result before checking that the workers are still alive
+worker_check_interval = 5.0
+
+
+def parser_worker(path_queue, parsed_queue, tokenizer_name):
+    """Read and parse symptom files and tokenize their chunks (no padding).
+
+    Each parsed item also carries the embedded chunk strings and the raw
+    source text of every chunk, for the BM25 index and the chunk text store.
+    """
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    while True:
+        pdf_path = path_queue.get()
+        if pdf_path is _DONE:
+            break
+        try:
+            with open(pdf_path, "r", encoding="utf-8") as file:
+                text = file.read()
+            chunk_strings, chunk_indices = parse_symptoms_as_strings_with_indices(text)
+            chunk_texts = [text[start:end] for start, end in chunk_indices]
+            encodings = tokenizer(chunk_strings, truncation=True) if chunk_strings else {'input_ids': [], 'attention_mask': []}
+            parsed_queue.put((pdf_path, chunk_indices, (chunk_strings, chunk_texts), {
+                'input_ids': encodings['input_ids'],
+                'attention_mask': encodings['attention_mask'],
+            }))
+        except Exception as e:
+            print(f"Error parsing {pdf_path}: {e}\nSkipping document")
+
+
+def embedding_worker(parsed_queue, result_queue, torch_threads, files_per_batch, batch_size, max_batch_tokens):
+    """Embed parsed files with a private model copy, several files per batch."""
+    import torch
+    from batch_embedder import BatchEmbedder, load_encoder
+
+    torch.set_num_threads(torch_threads)
+    tokenizer, model = load_encoder(model_name)
+    embedder = BatchEmbedder(tokenizer, model, batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+
+    done = False
+    while not done:
+        # Block for the first file, then take whatever else is ready up to files_per_batch
+        items = []
+        item = parsed_queue.get()
+        while True:
+            if item is _DONE:
+                done = True
+                break
+            items.append(item)
+            if len(items) >= files_per_batch:
+                break
+            try:
+                item = parsed_queue.get_nowait()
+            except queue.Empty:
+                break
+        if not items:
+            continue
+
+        try:
+            encodings = {'input_ids': [], 'attention_mask': []}
+            for _, _, _, file_encodings in items:
+                encodings['input_ids'].extend(file_encodings['input_ids'])
+                encodings['attention_mask'].extend(file_encodings['attention_mask'])
+            embeddings = embedder.embed_tokenized(encodings)
+        except Exception as e:
+            print(f"Error embedding {[item[0] for item in items]}: {e}\nSkipping documents")
+            continue
+
+        offset = 0
+        for pdf_path, chunk_indices, texts, _ in items:
+            result_queue.put((pdf_path, chunk_indices, texts, embeddings[offset:offset + len(chunk_indices)]))
+            offset += len(chunk_indices)
+
+    result_queue.put(_DONE)
+
+
+def write_document_memmap(doc_id, chunk_indices, embeddings, folder=documents_folder):
+    """Write one document in the documents4/{doc_id}.npy layout used by save_document_to_binary."""
+    file_path = os.path.join(folder, f"{doc_id}.npy")
+    dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (embeddings.shape[1],))]
+    structured_array = np.memmap(file_path, dtype=dtype, mode='w+', shape=(len(chunk_indices),))
+    indices = np.asarray(chunk_indices, dtype=np.int32).reshape(-1, 2)
+    structured_array['start_id'] = indices[:, 0]
+    structured_array['end_id'] = indices[:, 1]
+    structured_array['embedding'] = embeddings
+    structured_array.flush()
+    del structured_array
+    return file_path
+
+
+class DocumentWriter:
+    """Single writer: assigns doc IDs and commits documents and mappings in arrival order.
+
+    With `store_dir` set, embeddings are appended to the consolidated
+    embedding store instead of one documents4/{doc_id}.npy file per document.
+    With `bm25_dir` set, the chunk strings are added to that BM25 index, and
+    with `text_dir` set the raw chunk texts are appended to that chunk text store.
+    With `cluster_dir` set (documents4 layout only), documents are also
+    inserted into that cluster tree.
+
+    Documents are committed in groups of `sync_every` through the ingest
+    write-ahead log: the group's data is made durable, one commit record is
+    fsynced, then mappings, clusters and last_doc_id are applied. Opening a
+    writer applies committed groups again and rolls back one that never
+    committed.
+    """
+
+    def __init__(self, folder=documents_folder, sync_every=32, store_dir=None, bm25_dir=None, text_dir=None,
+                 cluster_dir=None, wal_path=wal_file):
+        if store_dir and cluster_dir:
+            raise ValueError("The cluster tree reads documents4 files; it cannot be combined with store_dir")
+        self.folder = folder
+        self.sync_every = sync_every
+        self.store = EmbeddingStoreWriter(store_dir) if store_dir else None
+        self.bm25 = BM25Index(bm25_dir) if bm25_dir else None
+        self.texts = ChunkTextWriter(text_dir) if text_dir else None
+        self.tree = ClusterTree(cluster_dir, documents_dir=folder) if cluster_dir else None
+        if self.store is None:
+            os.makedirs(folder, exist_ok=True)
+        self.key_db = shelve.open(key_to_value_file, flag='c')
+        self.value_db = shelve.open(value_to_key_file, flag='c')
+        self.wal = IngestWAL(wal_path)
+        self.pending = []  # (doc_id, pdf_file, embeddings) of the open group
+        self.last_doc_id = self._load_last_doc_id()
+        self.written = 0
+        self.recover()
+
+    def _load_last_doc_id(self):
+        last_doc_id = 0
+        if os.path.exists(doc_id_file_path):
+            with open(doc_id_file_path, 'rb') as f:
+                last_doc_id = pickle.load(f)
+        # Never reuse an ID that already has a mapping
+        while str(last_doc_id + 1) in self.value_db:
+            last_doc_id += 1
+        return last_doc_id
+
+    def save_last_doc_id(self):
+        tmp_path = doc_id_file_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.last_doc_id, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, doc_id_file_path)
+
+    def recover(self):
+        """Roll back an uncommitted group and apply committed ones left in the log."""
+        committed, uncommitted = self.wal.groups()
+        if uncommitted is not None:
+            begin, docs = uncommitted
+            if self.store is not None and begin.get('store'):
+                self.store.rollback_to(begin['store'])
+            if self.texts is not None and begin.get('texts'):
+                self.texts.rollback_to(begin['texts'])
+            for doc in docs:
+                if self.bm25 is not None:
+                    self.bm25.delete_document(doc['doc_id'])
+                path = os.path.join(self.folder, f"{doc['doc_id']}.npy")
+                if self.store is None and os.path.exists(path):
+                    os.remove(path)
+            if self.bm25 is not None:
+                self.bm25.save()
+            print(f"Rolled back {len(docs)} uncommitted documents from {self.wal.path}")
+        for _, docs, commit in committed:
+            for doc in docs:
+                self._apply(doc['doc_id'], doc['pdf_file'])
+            self.last_doc_id = max(self.last_doc_id, commit['last_doc_id'])
+        if committed:
+            print(f"Applied {sum(len(docs) for _, docs, _ in committed)} committed documents from {self.wal.path}")
+        if committed or uncommitted is not None:
+            self._checkpoint()
+
+    def _apply(self, doc_id, pdf_file, embeddings=None):
+        """Reference a committed document (idempotent)."""
+        self.key_db[pdf_file] = doc_id
+        self.value_db[str(doc_id)] = pdf_file
+        if self.tree is not None:
+            if embeddings is None:
+                path = os.path.join(self.folder, f"{doc_id}.npy")
+                dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (self.tree.embedding_dim,))]
+                embeddings = np.memmap(path, dtype=dtype, mode='r')['embedding']
+            self.tree.add_document(doc_id, embeddings)
+
+    def _checkpoint(self):
+        self.key_db.sync()
+        self.value_db.sync()
+        self.save_last_doc_id()
+        self.wal.checkpoint()
+
+    def sync(self):
+        """Group commit of the documents written since the last sync."""
+        if not self.pending:
+            return
+        # The log, then the data, are durable before the commit record that makes them count
+        self.wal.flush()
+        if self.store is not None:
+            self.store.commit()
+        if self.texts is not None:
+            self.texts.commit()
+        if self.bm25 is not None:
+            self.bm25.save()
+        self.wal.commit(last_doc_id=self.last_doc_id)
+        for doc_id, pdf_file, embeddings in self.pending:
+            self._apply(doc_id, pdf_file, embeddings)
+        self.pending = []
+        self._checkpoint()
+
+    def write(self, pdf_path, chunk_indices, embeddings, chunk_strings=None, chunk_texts=None):
+        pdf_file = os.path.basename(pdf_path)
+        if not chunk_indices:
+            print(f"No symptoms found in {pdf_file}\nSkipping document")
+            return None
+        if pdf_file in self.key_db or any(pdf_file == pending[1] for pending in self.pending):
+            print(f"Skipping: {pdf_file}, already ingested")
+            return None
+        doc_id = self.last_doc_id + 1
+        if not self.wal.in_group:
+            self.wal.begin(store=self.store.meta if self.store is not None else None,
+                           texts=self.texts.meta if self.texts is not None else None)
+        self.wal.log(doc_id=doc_id, pdf_file=pdf_file)
+        if self.store is not None:
+            self.store.append_document(doc_id, chunk_indices, embeddings)
+        else:
+            write_document_memmap(doc_id, chunk_indices, embeddings, self.folder)
+        if self.bm25 is not None and chunk_strings is not None:
+            self.bm25.add_document(doc_id, chunk_strings)
+        if self.texts is not None and chunk_texts is not None:
+            self.texts.append_document(doc_id, chunk_texts)
+        self.pending.append((doc_id, pdf_file, embeddings if self.tree is not None else None))
+        self.last_doc_id = doc_id
+        self.written += 1
+        if len(self.pending) >= self.sync_every:
+            self.sync()
+        return doc_id
+
+    def close(self):
+        self.sync()
+        self.key_db.close()
+        self.value_db.close()
+        self.wal.close()
+        if self.store is not None:
+            self.store.close()
+        if self.texts is not None:
+            self.texts.close()
+
+
+def pending_files(pdf_folder):
+    """List the .txt files in `pdf_folder` that do not have a doc mapping yet."""
+    files = sorted(f for f in os.listdir(pdf_folder) if f.endswith(".txt"))
+    try:
+        with shelve.open(key_to_value_file, flag='r') as db:
+            return [f for f in files if f not in db]
+    except dbm.error:
+        # No mappings saved yet
+        return files
+
+
+def run_pipeline(pdf_folder, n_parsers=None, n_embedders=None, torch_threads=None,
+                 queue_size=64, files_per_batch=8, batch_size=16, max_batch_tokens=16384, store_dir=None,
+                 bm25_dir=None, text_dir=None, cluster_dir=None, sync_every=32):
+    """Ingest every unprocessed file in `pdf_folder` using all cores.
+
+    Args:
+        pdf_folder (str): Folder with the generated disease symptom .txt files.
+        n_parsers (int): Parser/tokenizer processes (default: a quarter of the cores).
+        n_embedders (int): Embedding processes, each holding its own model copy.
+        torch_threads (int): Torch intra-op threads per embedding process
+            (default: remaining cores split between the embedders).
+        queue_size (int): Capacity of each inter-stage queue, in files.
+        files_per_batch (int): Files whose chunks share one embedding engine call.
+        store_dir (str): Write to this consolidated embedding store instead of documents4.
+        bm25_dir (str): Also index the chunk strings in this BM25 index.
+        text_dir (str): Also store the raw chunk texts in this chunk text store.
+        cluster_dir (str): Also insert the documents into this cluster tree (documents4 layout only).
+        sync_every (int): Documents per group commit.
+    """
+    start_time = time.time()
+    cpu_count = os.cpu_count() or 1
+    if n_parsers is None:
+        n_parsers = max(1, cpu_count // 4)
+    if n_embedders is None:
+        n_embedders = 2 if cpu_count >= 8 else 1
+    if torch_threads is None:
+        torch_threads = max(1, (cpu_count - n_parsers) // n_embedders)
+
+    files = pending_files(pdf_folder)
+    print(f"{len(files)} files to ingest with {n_parsers} parsers, {n_embedders} embedders x {torch_threads} threads")
+
+    # spawn keeps torch/tokenizer state out of forked children
+    ctx = mp.get_context("spawn")
+    path_queue = ctx.Queue(maxsize=queue_size)
+    parsed_queue = ctx.Queue(maxsize=queue_size)
+    result_queue = ctx.Queue(maxsize=queue_size)
+
+    parsers = [ctx.Process(target=parser_worker, args=(path_queue, parsed_queue, model_name), daemon=True)
+               for _ in range(n_parsers)]
+    embedders = [ctx.Process(target=embedding_worker,
+                             args=(parsed_queue, result_queue, torch_threads, files_per_batch, batch_size, max_batch_tokens),
+                             daemon=True)
+                 for _ in range(n_embedders)]
+    for process in parsers + embedders:
+        process.start()
+
+    def feed():
+        for pdf_file in files:
+            path_queue.put(os.path.join(pdf_folder, pdf_file))
+        for _ in parsers:
+            path_queue.put(_DONE)
+        for process in parsers:
+            process.join()
+        # Parsers are finished, so everything they produced is ahead of these sentinels
+        for _ in embedders:
+            parsed_queue.put(_DONE)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    writer = DocumentWriter(sync_every=sync_every, store_dir=store_dir, bm25_dir=bm25_dir, text_dir=text_dir,
+                            cluster_dir=cluster_dir)
+    finished_embedders = 0
+    try:
+        while finished_embedders < len(embedders):
+            try:
+                item = result_queue.get(timeout=worker_check_interval)
+            except queue.Empty:
+                # A worker that crashed (e.g. out of memory loading the model) never sends _DONE
+                crashed = [process for process in parsers + embedders if process.exitcode not in (None, 0)]
+                if crashed:
+                    for process in parsers + embedders:
+                        process.terminate()
+                    raise RuntimeError(
+                        f"{len(crashed)} ingest worker(s) died (exit codes "
+                        f"{[process.exitcode for process in crashed]}); documents written so far are "
+                        f"committed, run the pipeline again to ingest the rest") from None
+                continue
+            if item is _DONE:
+                finished_embedders += 1
+                continue
+            pdf_path, chunk_indices, (chunk_strings, chunk_texts), embeddings = item
+            doc_id = writer.write(pdf_path, chunk_indices, embeddings, chunk_strings, chunk_texts)
+            if doc_id is not None:
+                print(f"Document {doc_id} saved for {pdf_path}")
+    finally:
+        writer.close()
+
+    feeder.join()
+    for process in embedders:
+        process.join()
+    print(f"Ingested {writer.written} documents. Total time taken: {time.time() - start_time:.2f} seconds")
+    return writer.written
+
+
+if __name__ == '__main__':
+    pdf_folder = "D:/pyfiles/HumanDiseaseOntology-main/HumanDiseaseOntology-main/disease_symptoms"
+    if len(sys.argv) > 1:
+        pdf_folder = sys.argv[1]
+    run_pipeline(pdf_folder)
@@ -0,0 +1,122 @@
+"""
+Write-ahead log for the ingest path.
+
+Documents are ingested in groups. For each group the writer
+
+    1. logs a `begin` record (sizes of the stores before the group) and one
+       `doc` record per document, without syncing,
+    2. writes the document data (documents4 files, embedding store, chunk
+       texts, BM25 delta), then flushes the log and makes the data durable,
+    3. appends a `commit` record and fsyncs the log once: the commit point,
+    4. applies the references to that data (doc mappings, cluster tree,
+       last_doc_id), and
+    5. checkpoints, which empties the log.
+
+On restart, groups that reached step 3 are applied again (every step-4
+operation is idempotent) and a trailing group without a commit record is
+rolled back. Two fsyncs of the log cover a whole group, so the cost of
+durability is paid once per group rather than once per file.
+
+Each line is `crc32 json`; a torn or corrupt line ends the log and is cut
+off when the log is read, so later groups are appended after valid records.
+"""
+import os
+import json
+import zlib
+
+wal_file = 'ingest_wal.log'
+
+
+def _fsync_dir(path):
+    if os.name == 'posix':
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class IngestWAL:
+    """Append-only group-commit log.
+
+    Args:
+        path (str): Log file; created when missing.
+    """
+
+    def __init__(self, path=wal_file):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.in_group = False
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        self.file.write(b'%08x %s\n' % (zlib.crc32(line), line))
+
+    def begin(self, **info):
+        """Start a group; `info` is returned to the rollback of an uncommitted group."""
+        self._append({'op': 'begin', **info})
+        self.in_group = True
+
+    def log(self, **record):
+        """Record one operation of the current group (buffered until commit)."""
+        self._append({'op': 'doc', **record})
+
+    def flush(self):
+        """Make the records so far durable, before the data they describe is committed."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def commit(self, **info):
+        """Append the commit record and make the whole group durable with one fsync."""
+        self._append({'op': 'commit', **info})
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.in_group = False
+
+    def checkpoint(self):
+        """Forget every applied group by emptying the log."""
+        self.file.close()
+        tmp_path = self.path + '.tmp'
+        open(tmp_path, 'wb').close()
+        os.replace(tmp_path, self.path)
+        _fsync_dir(self.path)
+        self.file = open(self.path, 'ab')
+
+    def groups(self):
+        """Parse the log into (committed, uncommitted), truncating it after the last valid record.
+
+        Returns:
+            tuple: committed is a list of (begin, docs, commit) groups to apply again;
+            uncommitted is the trailing (begin, docs) group to roll back, or None.
+        """
+        self.file.flush()
+        committed = []
+        begin, docs = None, []
+        valid_end = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                crc, _, payload = line.rstrip(b'\n').partition(b' ')
+                try:
+                    if not line.endswith(b'\n') or int(crc, 16) != zlib.crc32(payload):
+                        break
+                    record = json.loads(payload)
+                except ValueError:
+                    break
+                valid_end += len(line)
+                op = record.pop('op')
+                if op == 'begin':
+                    begin, docs = record, []
+                elif op == 'doc' and begin is not None:
+                    docs.append(record)
+                elif op == 'commit' and begin is not None:
+                    committed.append((begin, docs, record))
+                    begin, docs = None, []
+        if valid_end < os.path.getsize(self.path):
+            # Records appended after a torn line would never be read back
+            self.file.truncate(valid_end)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return committed, (begin, docs) if begin is not None else None
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,310 @@
+"""
+Inverted-file (IVF) index over the consolidated embedding store.
+
+k-means coarse centroids partition the store rows; each centroid owns a
+posting list of store row numbers. A query is scored only against the rows
+in its `nprobe` nearest lists, so its cost depends on nprobe * (rows / nlist)
+rather than on the corpus size.
+
+Layout of an index directory:
+
+    meta.json       nlist, rows already indexed, sizes of the base and delta postings,
+                    and the versions of the files below
+    centroids.V.npy (nlist, dim) float32 coarse centroids
+    offsets.V.npy   (nlist + 1,) int64 start of each list in postings.V.bin
+    postings.V.bin  int64 store rows grouped by list (compacted base)
+    delta.V.bin     (list_id, row) records appended since the last compaction
+
+Training and compaction write the files of a new version next to the old
+ones and switch to them by replacing meta.json, so a crash at any point
+leaves a consistent index; the old version is removed afterwards. Indexes
+written before versioning (no version in meta.json) use the unsuffixed names.
+"""
+import os
+import re
+import sys
+import json
+import time
+import numpy as np
+
+from embedding_store import EmbeddingStore, _write_json_atomic, store_folder
+from vector_search import hit_dtype, hits_from_rows, search_store, topk_from_scores
+
+ivf_folder = 'ivf_index'
+
+delta_dtype = np.dtype([('list_id', 'i4'), ('row', 'i8')])
+
+# Rows assigned to centroids per block while building, to keep memory bounded
+assign_block_rows = 65536
+
+
+def _file_names(meta):
+    """Names of the centroid, offset, postings and delta files `meta` points at."""
+    def suffix(version):
+        return '' if version is None else f'.{version}'
+    base, centroids = suffix(meta.get('version')), suffix(meta.get('centroids_version'))
+    return {
+        'centroids': f'centroids{centroids}.npy',
+        'offsets': f'offsets{base}.npy',
+        'postings': f'postings{base}.bin',
+        'delta': f'delta{base}.bin',
+    }
+
+
+def _remove_stale_files(index_dir, meta):
+    """Delete index files of versions `meta` no longer points at."""
+    current = set(_file_names(meta).values())
+    for name in os.listdir(index_dir):
+        if re.fullmatch(r'(centroids|offsets|postings|delta)(\.\d+)?\.(npy|bin)', name) and name not in current:
+            try:
+                os.remove(os.path.join(index_dir, name))
+            except OSError:
+                # Still mapped by a reader (Windows); removed after the next switch
+                pass
+
+
+def _save_synced(path, write):
+    with open(path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def default_nlist(n_rows):
+    """About 4 * sqrt(rows) lists, the usual IVF sizing."""
+    return int(max(1, min(n_rows, round(4 * np.sqrt(n_rows)))))
+
+
+def assign_to_centroids(vectors, centroids, centroid_norms=None):
+    """Return the index of the nearest centroid (L2) for every row of `vectors`."""
+    if centroid_norms is None:
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    # ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, and ||x||^2 does not change the argmin
+    return np.argmin(centroid_norms[None, :] - 2.0 * (vectors @ centroids.T), axis=1)
+
+
+class IVFIndex:
+    """Inverted-file index whose posting lists point at EmbeddingStore rows."""
+
+    def __init__(self, index_dir=ivf_folder):
+        self.index_dir = index_dir
+        self.load()
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def load(self):
+        with open(self._path('meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.files = _file_names(self.meta)
+        self.centroids = np.load(self._path(self.files['centroids']))
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.offsets = np.load(self._path(self.files['offsets']))
+        base_rows = self.meta['base_rows']
+        if base_rows:
+            self.postings = np.memmap(self._path(self.files['postings']), dtype=np.int64, mode='r',
+                                      shape=(base_rows,))
+        else:
+            self.postings = np.zeros(0, dtype=np.int64)
+        delta_rows = self.meta['delta_rows']
+        if delta_rows:
+            self.delta = np.fromfile(self._path(self.files['delta']), dtype=delta_dtype, count=delta_rows)
+        else:
+            self.delta = np.zeros(0, dtype=delta_dtype)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, store, index_dir=ivf_folder, nlist=None, sample_size=100_000, seed=0):
+        """Train coarse centroids on a sample of the store and index every live row."""
+        from sklearn.cluster import KMeans
+
+        start_time = time.time()
+        n_rows = len(store)
+        if n_rows == 0:
+            raise ValueError("Cannot train an IVF index on an empty embedding store.")
+        nlist = nlist or default_nlist(n_rows)
+
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n_rows, size=min(sample_size, n_rows), replace=False))
+        training = np.asarray(store.embeddings[sample], dtype=np.float32)
+        kmeans = KMeans(n_clusters=min(nlist, len(training)), n_init=1, random_state=seed)
+        kmeans.fit(training)
+        centroids = kmeans.cluster_centers_.astype(np.float32)
+        print(f"Trained {len(centroids)} centroids on {len(training)} rows: {time.time() - start_time:.2f} seconds")
+
+        os.makedirs(index_dir, exist_ok=True)
+        meta_path = os.path.join(index_dir, 'meta.json')
+        version = 1
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                version = json.load(f).get('version', 0) + 1
+        _save_synced(os.path.join(index_dir, f'centroids.{version}.npy'), lambda f: np.save(f, centroids))
+        list_ids = cls._assign_rows(store, centroids, 0, n_rows)
+        rows = np.arange(n_rows, dtype=np.int64)
+        if store.live is not None:
+            rows, list_ids = rows[store.live], list_ids[store.live]
+        cls._write_base(index_dir, list_ids, rows, len(centroids), version)
+        meta = {
+            'nlist': len(centroids),
+            'trained_rows': n_rows,
+            'rows_indexed': n_rows,
+            'base_rows': len(rows),
+            'delta_rows': 0,
+            'version': version,
+            'centroids_version': version,
+        }
+        _write_json_atomic(meta_path, meta)
+        _remove_stale_files(index_dir, meta)
+        print(f"Built IVF index over {len(rows)} rows: {time.time() - start_time:.2f} seconds")
+        return cls(index_dir)
+
+    @staticmethod
+    def _assign_rows(store, centroids, start, stop):
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        list_ids = np.empty(stop - start, dtype=np.int32)
+        for block_start in range(start, stop, assign_block_rows):
+            block_stop = min(stop, block_start + assign_block_rows)
+            list_ids[block_start - start:block_stop - start] = assign_to_centroids(
+                store.embeddings[block_start:block_stop], centroids, centroid_norms)
+        return list_ids
+
+    @staticmethod
+    def _write_base(index_dir, list_ids, rows, nlist, version):
+        # Files of a new version; nothing reads them until meta.json points at it
+        files = _file_names({'version': version})
+        # Group rows by list with a stable sort so each list stays in row order
+        order = np.argsort(list_ids, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(list_ids, minlength=nlist))
+        postings = rows[order].astype(np.int64)
+        _save_synced(os.path.join(index_dir, files['postings']), lambda f: f.write(postings.tobytes()))
+        _save_synced(os.path.join(index_dir, files['offsets']), lambda f: np.save(f, offsets))
+        _save_synced(os.path.join(index_dir, files['delta']), lambda f: None)
+
+    def add_rows(self, store, compact_ratio=0.1, retrain_growth=4.0):
+        """Index store rows appended since the last call.
+
+        New rows go to the delta postings; the delta is merged into the base
+        once it exceeds `compact_ratio` of it. When the store has grown by
+        `retrain_growth` since training, the centroids are retrained so list
+        sizes (and query latency) stay flat.
+        """
+        n_rows = len(store)
+        if n_rows > retrain_growth * self.meta['trained_rows']:
+            print(f"Store grew from {self.meta['trained_rows']} to {n_rows} rows, retraining centroids")
+            self.postings = None
+            IVFIndex.train(store, self.index_dir)
+            self.load()
+            return n_rows
+
+        start = self.meta['rows_indexed']
+        if n_rows <= start:
+            return 0
+        list_ids = self._assign_rows(store, self.centroids, start, n_rows)
+        records = np.zeros(n_rows - start, dtype=delta_dtype)
+        records['list_id'] = list_ids
+        records['row'] = np.arange(start, n_rows)
+        with open(self._path(self.files['delta']), 'ab') as f:
+            f.seek(self.meta['delta_rows'] * delta_dtype.itemsize)
+            f.truncate()
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.delta = np.concatenate([self.delta, records])
+        self.meta = dict(self.meta, rows_indexed=n_rows, delta_rows=len(self.delta))
+        _write_json_atomic(self._path('meta.json'), self.meta)
+
+        if len(self.delta) > compact_ratio * max(1, self.meta['base_rows']):
+            self.compact(store)
+        return n_rows - start
+
+    def compact(self, store=None):
+        """Merge the delta postings into the base postings (dropping superseded rows)."""
+        base_lists = np.repeat(np.arange(self.nlist, dtype=np.int32), np.diff(self.offsets))
+        list_ids = np.concatenate([base_lists, self.delta['list_id']])
+        rows = np.concatenate([np.asarray(self.postings), self.delta['row']])
+        if store is not None and store.live is not None:
+            keep = store.live[rows]
+            list_ids, rows = list_ids[keep], rows[keep]
+        version = self.meta.get('version', 0) + 1
+        self._write_base(self.index_dir, list_ids, rows, self.nlist, version)
+        self.meta = dict(self.meta, base_rows=len(rows), delta_rows=0, version=version,
+                         centroids_version=self.meta.get('centroids_version'))
+        _write_json_atomic(self._path('meta.json'), self.meta)
+        self.postings = None
+        self.load()
+        _remove_stale_files(self.index_dir, self.meta)
+
+    def probe(self, query, nprobe):
+        """Return the ids of the `nprobe` lists nearest to `query`."""
+        distances = self.centroid_norms - 2.0 * (self.centroids @ query)
+        nprobe = min(nprobe, self.nlist)
+        if nprobe == self.nlist:
+            return np.arange(self.nlist)
+        return np.argpartition(distances, nprobe - 1)[:nprobe]
+
+    def candidates(self, query, nprobe):
+        """Store rows in the probed lists (base and delta)."""
+        lists = self.probe(query, nprobe)
+        parts = [self.postings[self.offsets[i]:self.offsets[i + 1]] for i in lists]
+        if len(self.delta):
+            parts.append(self.delta['row'][np.isin(self.delta['list_id'], lists)])
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def search(self, store, queries, k=10, nprobe=8):
+        """Approximate top-k search; returns hit_dtype records of shape (n_queries, <=k)."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        results = np.zeros((len(queries), k), dtype=hit_dtype)
+        results['score'] = -np.inf
+        results['row'] = -1
+        for q, query in enumerate(queries):
+            rows = self.candidates(query, nprobe)
+            if store.live is not None:
+                rows = rows[store.live[rows]]
+            if not len(rows):
+                continue
+            rows = np.sort(rows)  # sequential reads from the memmap
+            scores = (np.asarray(store.embeddings[rows], dtype=np.float32) @ query)[None, :]
+            top, top_scores = topk_from_scores(scores, min(k, len(rows)))
+            found_rows = rows[top[0]]
+            results[q, :len(found_rows)] = hits_from_rows(found_rows, top_scores[0], store.chunks)
+        return results
+
+
+def recall_at_k(store, index, queries, k=10, nprobe=8):
+    """Fraction of the exact top-k rows that the IVF search also returns."""
+    exact = search_store(store, queries, k)
+    approx = index.search(store, queries, k, nprobe)
+    found = sum(len(np.intersect1d(e['row'], a['row'][a['row'] >= 0])) for e, a in zip(exact, approx))
+    return found / exact['row'].size if exact.size else 1.0
+
+
+def report_recall(store, index, k=10, n_queries=100, nprobes=(1, 2, 4, 8, 16, 32), seed=0):
+    """Print recall@k and mean latency against brute force, using store rows as queries."""
+    rng = np.random.default_rng(seed)
+    queries = np.asarray(store.embeddings[rng.choice(len(store), size=min(n_queries, len(store)), replace=False)],
+                         dtype=np.float32)
+    start_time = time.time()
+    search_store(store, queries, k)
+    print(f"brute force: {(time.time() - start_time) * 1000 / len(queries):.2f} ms/query")
+    for nprobe in nprobes:
+        start_time = time.time()
+        index.search(store, queries, k, nprobe)
+        latency = (time.time() - start_time) * 1000 / len(queries)
+        print(f"nprobe={nprobe:4d}: recall@{k}={recall_at_k(store, index, queries, k, nprobe):.3f}, {latency:.2f} ms/query")
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'update'
+    store = EmbeddingStore(store_folder)
+    if command == 'build' or not os.path.exists(os.path.join(ivf_folder, 'meta.json')):
+        index = IVFIndex.train(store, ivf_folder)
+    else:
+        index = IVFIndex(ivf_folder)
+        print(f"Indexed {index.add_rows(store)} new rows")
+    if command == 'recall':
+        report_recall(store, index)
@@ -0,0 +1,239 @@
+"""
+Long-lived lookup service for the shelve ID mappings.
+
+The lookup helpers in embed2.py, embed_diseases.py and somediseasesymptoms.py
+used to open a shelf on every call. MappingService opens each shelf once
+(read-only), keeps recently used entries in a bounded LRU and can be shared
+between threads, e.g. by the workers of a Flask app.
+
+Shelf keys are always strings, so lookups accept ints as well and convert them.
+When a compiled symptom dictionary exists (symptom_dictionary.py), the
+symptom and disease lookups are answered from it instead of the shelves;
+numbers are still returned as strings, like the shelves store them.
+Every lookup compares the shelf's files (and the dictionary's meta.json)
+with the inode, mtime and size seen when they were opened; when another
+process has rewritten them, the handle is reopened and that store's cached
+entries are dropped. Writers in the same process must call invalidate(store)
+before writing to a shelf, which drops its cached entries and closes the
+read handle (invalidate_documents() does it for both document shelves).
+"""
+import os
+import dbm
+import shelve
+import threading
+from collections import OrderedDict
+
+from symptom_dictionary import SymptomDictionary, dictionary_folder
+
+# Shelves written by somediseasesymptoms.py
+symptom_to_number_file = "symptom_to_number"
+number_to_symptom_file = "number_to_symptom"
+number_to_synonyms_file = "number_to_synonyms"
+disease_to_number_file = "disease_to_number"
+number_to_disease_file = "number_to_disease"
+symptom_to_disease_file = "symptom_to_disease"
+
+# Document mappings written at ingest
+key_to_value_file = 'key_to_value.db'  # pdf_file -> doc_id
+value_to_key_file = 'value_to_key.db'  # doc_id -> pdf_file
+
+# Files a shelf can be stored in, depending on the dbm backend
+shelf_suffixes = ('', '.db', '.dat', '.dir', '.pag')
+
+# Cached marker for keys that are not in the shelf
+_MISSING = object()
+# Marker for keys that are not in the cache
+_UNCACHED = object()
+
+
+def _files_stamp(paths):
+    """(inode, mtime, size) of each path, None for missing ones."""
+    stamp = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+            continue
+        stamp.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+    return tuple(stamp)
+
+
+class MappingService:
+    """Read-only, cached access to the mapping shelves.
+
+    Args:
+        cache_size (int): Entries kept in the LRU across all shelves.
+        dictionary_dir (str): Compiled symptom dictionary to prefer over the shelves.
+    """
+
+    def __init__(self, cache_size=65536, dictionary_dir=dictionary_folder):
+        self.cache_size = cache_size
+        self.dictionary_dir = dictionary_dir
+        self.dictionary = None
+        self.dictionary_stamp = None
+        self.cache = OrderedDict()
+        self.shelves = {}
+        self.stamps = {}
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _shelf(self, store):
+        """Open handle of `store`, or None when the shelf does not exist yet."""
+        shelf = self.shelves.get(store)
+        if shelf is None:
+            try:
+                shelf = shelve.open(store, flag='r')
+            except dbm.error:
+                return None
+            self.shelves[store] = shelf
+        return shelf
+
+    def _check_shelf(self, store):
+        """Drop the handle and cached entries of `store` if its files changed since they were read."""
+        stamp = _files_stamp(store + suffix for suffix in shelf_suffixes)
+        if self.stamps.get(store, stamp) != stamp:
+            self.invalidate(store)
+        self.stamps[store] = stamp
+
+    def _dictionary(self):
+        """The compiled symptom dictionary (reloaded after it is recompiled), or None when it has not been built."""
+        stamp = _files_stamp([os.path.join(self.dictionary_dir, 'meta.json')])
+        with self.lock:
+            if stamp[0] is None:
+                self.dictionary = None
+            elif self.dictionary is None or stamp != self.dictionary_stamp:
+                self.dictionary = SymptomDictionary(self.dictionary_dir)
+            self.dictionary_stamp = stamp
+            return self.dictionary
+
+    def get(self, store, key, default=None):
+        """Value of `key` in shelf `store`, or `default`."""
+        return self.get_many(store, [key], default)[0]
+
+    def get_many(self, store, keys, default=None):
+        """Values of several keys of one shelf, in order; `default` where missing."""
+        values = []
+        with self.lock:
+            self._check_shelf(store)
+            for key in keys:
+                key = str(key)
+                value = self.cache.get((store, key), _UNCACHED)
+                if value is not _UNCACHED:
+                    self.cache.move_to_end((store, key))
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    shelf = self._shelf(store)
+                    if shelf is None:
+                        values.append(default)
+                        continue
+                    value = shelf.get(key, _MISSING)
+                    self.cache[(store, key)] = value
+                    if len(self.cache) > self.cache_size:
+                        self.cache.popitem(last=False)
+                values.append(default if value is _MISSING else value)
+        return values
+
+    def contains(self, store, key):
+        return self.get(store, key, _MISSING) is not _MISSING
+
+    def invalidate(self, store=None):
+        """Forget cached entries and close the handle of `store` (every shelf when None)."""
+        with self.lock:
+            stores = list(self.shelves) if store is None else [store]
+            for name in stores:
+                shelf = self.shelves.pop(name, None)
+                if shelf is not None:
+                    shelf.close()
+            if store is None:
+                self.cache.clear()
+                self.stamps.clear()
+                self.dictionary = None
+            else:
+                for cache_key in [k for k in self.cache if k[0] == store]:
+                    del self.cache[cache_key]
+
+    def invalidate_documents(self):
+        """Invalidate both document mapping shelves, before this process writes them."""
+        self.invalidate(key_to_value_file)
+        self.invalidate(value_to_key_file)
+
+    def close(self):
+        self.invalidate()
+
+    # ---- domain lookups ------------------------------------------------
+
+    def symptom_number(self, symptom_name):
+        dictionary = self._dictionary()
+        if dictionary is not None:
+            symptom_id = dictionary.symptom_id(symptom_name)
+            return str(symptom_id) if symptom_id >= 0 else None
+        return self.get(symptom_to_number_file, symptom_name)
+
+    def symptom_name(self, symptom_number):
+        dictionary = self._dictionary()
+        if dictionary is not None:
+            return dictionary.symptom_name(_as_id(symptom_number))
+        return self.get(number_to_symptom_file, symptom_number)
+
+    def synonyms(self, symptom_number):
+        dictionary = self._dictionary()
+        if dictionary is not None:
+            return [str(s) for s in dictionary.synonyms(_as_id(symptom_number)).tolist()]
+        return self.get(number_to_synonyms_file, symptom_number, [])
+
+    def disease_number(self, disease_name):
+        dictionary = self._dictionary()
+        if dictionary is not None:
+            disease_id = dictionary.disease_id(disease_name)
+            return str(disease_id) if disease_id >= 0 else None
+        return self.get(disease_to_number_file, disease_name)
+
+    def disease_name(self, disease_number):
+        dictionary = self._dictionary()
+        if dictionary is not None:
+            return dictionary.disease_name(_as_id(disease_number))
+        return self.get(number_to_disease_file, disease_number)
+
+    def diseases_by_symptom(self, symptom_name):
+        """Names of the diseases linked to a symptom name."""
+        dictionary = self._dictionary()
+        if dictionary is not None:
+            return dictionary.diseases_by_symptom(symptom_name)
+        symptom_number = self.symptom_number(symptom_name)
+        if not symptom_number:
+            return []
+        disease_numbers = self.get(symptom_to_disease_file, symptom_number, [])
+        return self.get_many(number_to_disease_file, disease_numbers)
+
+    def doc_id(self, pdf_file):
+        return self.get(key_to_value_file, pdf_file)
+
+    def doc_file(self, doc_id):
+        return self.get(value_to_key_file, doc_id)
+
+    def doc_files(self, doc_ids):
+        return self.get_many(value_to_key_file, doc_ids)
+
+
+def _as_id(number):
+    """Integer ID of a shelf number ('12' or 12), or -1 if it is not one."""
+    try:
+        return int(number)
+    except (TypeError, ValueError):
+        return -1
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_mapping_service():
+    """The process-wide MappingService, created on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = MappingService()
+        return _service
@@ -0,0 +1,138 @@
+"""
+Lazily loaded tokenizer, model and BatchEmbedder.
+
+Importing embed2.py / embed_diseases.py used to load the ~2 GB bge-m3 model
+immediately, even for code that only needed the mapping helpers or the
+parsers. A ModelProvider loads nothing (not even torch) until the first
+embedding is requested, and it can be loaded and warmed up explicitly at
+server start instead so the first query does not pay for it.
+
+The model can come from a local directory (never looked up online), and the
+EMBEDDING_MODEL environment variable overrides the default name, e.g. to
+point an offline deployment at a copied snapshot. EMBEDDING_BACKEND picks a
+CPU inference backend from encoder_backends.py (torch by default).
+"""
+import os
+import time
+import threading
+
+from batch_embedder import load_encoder, load_tokenizer
+from encoder_backends import make_embedder, onnx_folder
+
+default_model_name = os.environ.get('EMBEDDING_MODEL', 'BAAI/bge-m3')
+default_backend = os.environ.get('EMBEDDING_BACKEND', 'torch')
+
+
+class ModelProvider:
+    """Loads the encoder on first use and embeds like a BatchEmbedder.
+
+    Args:
+        model_name (str): Hub name or local model directory.
+        device: torch device; CUDA when available if None.
+        local_files_only (bool): See batch_embedder.load_encoder.
+        use_safetensors (bool): See batch_embedder.load_encoder.
+        warmup (bool): Run a warm-up batch right after loading.
+        backend (str): Encoder backend, one of encoder_backends.backend_names.
+        batch_size, max_batch_tokens, embedding_dim: BatchEmbedder settings.
+    """
+
+    def __init__(self, model_name=default_model_name, device=None, local_files_only=None,
+                 use_safetensors=None, warmup=False, batch_size=16, max_batch_tokens=16384,
+                 embedding_dim=1024, backend=default_backend):
+        self.model_name = model_name
+        self.backend = backend
+        self.device = device
+        self.local_files_only = local_files_only
+        self.use_safetensors = use_safetensors
+        self.warmup_on_load = warmup
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.embedding_dim = embedding_dim
+        self.scale = 20.0
+        self.max_length = None
+        self.load_seconds = None
+        self.hooks = []
+        self._embedder = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._embedder is not None
+
+    def load(self):
+        """Load tokenizer and model (once) and return the BatchEmbedder."""
+        if self._embedder is not None:
+            return self._embedder
+        with self._lock:
+            if self._embedder is None:
+                start_time = time.time()
+                graph = 'model.int8.onnx' if self.backend == 'onnx-int8' else 'model.onnx'
+                if self.backend.startswith('onnx') and os.path.exists(os.path.join(onnx_folder, graph)):
+                    # The exported graph holds the weights; only the tokenizer is needed
+                    tokenizer, model = load_tokenizer(self.model_name, self.local_files_only), None
+                else:
+                    device = 'cpu' if self.backend != 'torch' else self.device
+                    tokenizer, model = load_encoder(self.model_name, device, self.local_files_only,
+                                                    self.use_safetensors)
+                embedder = make_embedder(self.backend, tokenizer, model, batch_size=self.batch_size,
+                                         max_batch_tokens=self.max_batch_tokens, max_length=self.max_length,
+                                         embedding_dim=self.embedding_dim, scale=self.scale)
+                self.load_seconds = time.time() - start_time
+                print(f"Loaded {self.model_name} ({self.backend} backend): {self.load_seconds:.2f} seconds")
+                if self.warmup_on_load:
+                    self._warmup(embedder)
+                for hook in self.hooks:
+                    hook(embedder)
+                self._embedder = embedder
+        return self._embedder
+
+    def _warmup(self, embedder, texts=("warm up",)):
+        start_time = time.time()
+        embedder.embed(list(texts))
+        print(f"Warmed up {self.model_name}: {time.time() - start_time:.2f} seconds")
+
+    def warmup(self, texts=("warm up",)):
+        """Load the model if needed and run one batch so kernels and allocations are ready."""
+        self._warmup(self.load(), texts)
+
+    def on_load(self, hook):
+        """Register hook(embedder), called once right after loading (runs now if already loaded)."""
+        self.hooks.append(hook)
+        if self._embedder is not None:
+            hook(self._embedder)
+
+    @property
+    def tokenizer(self):
+        return self.load().tokenizer
+
+    @property
+    def model(self):
+        return self.load().model
+
+    @property
+    def dtype(self):
+        # Known before loading: transformers loads float32 weights unless told otherwise
+        return {'torch': 'torch.float32', 'int8': 'qint8-dynamic',
+                'onnx': 'onnx-fp32', 'onnx-int8': 'onnx-int8'}[self.backend]
+
+    def embed(self, texts):
+        return self.load().embed(texts)
+
+    def embed_tokenized(self, encodings):
+        return self.load().embed_tokenized(encodings)
+
+    def embed_groups(self, groups):
+        return self.load().embed_groups(groups)
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+def get_model_provider():
+    """The process-wide ModelProvider (nothing is loaded until it is used)."""
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = ModelProvider()
+        return _provider
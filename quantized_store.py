@@ -0,0 +1,206 @@
+"""
+Compressed embedding codes with an exact float re-rank.
+
+Two encodings of the EmbeddingStore rows are supported:
+
+    int8  per-dimension scalar quantization, 1 byte per dim (4x smaller than float32)
+    pq    product quantization, 1 byte per sub-vector (m=128 on 1024 dims is 32x smaller)
+
+A query is scored against every code with an asymmetric distance (the query
+stays in float32), and only the best `rerank` candidates are re-scored
+exactly from the float embeddings in the store's memmap.
+
+Layout of a quantized store directory:
+
+    meta.json      kind, dim, rows encoded, m / ksub for pq
+    codes.bin      (rows, dim) int8 or (rows, m) uint8 codes
+    offset.npy / scale.npy    int8 parameters
+    codebooks.npy  (m, ksub, dim / m) float32 pq centroids
+"""
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from embedding_store import EmbeddingStore, _write_json_atomic, store_folder
+from vector_search import hit_dtype, hits_from_rows, topk_from_scores
+
+quantized_folder = 'quantized_store'
+
+# Rows encoded per block, to bound temporary float32 copies
+block_rows = 65536
+# Rows decoded per block while scanning; small enough for the float32 copy to stay in cache
+scan_block_rows = 1024
+
+
+class QuantizedStore:
+    """int8 or product-quantized codes for EmbeddingStore rows.
+
+    Args:
+        index_dir (str): Directory with the codes.
+        in_memory (bool): Read the codes into RAM instead of memory-mapping them.
+    """
+
+    def __init__(self, index_dir=quantized_folder, in_memory=False):
+        self.index_dir = index_dir
+        self.in_memory = in_memory
+        self.load()
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def load(self):
+        with open(self._path('meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.kind = self.meta['kind']
+        if self.kind == 'int8':
+            self.offset = np.load(self._path('offset.npy'))
+            self.scale = np.load(self._path('scale.npy'))
+            shape, dtype = (self.meta['rows'], self.meta['dim']), np.int8
+        else:
+            self.codebooks = np.load(self._path('codebooks.npy'))
+            shape, dtype = (self.meta['rows'], self.meta['m']), np.uint8
+        if not self.meta['rows']:
+            self.codes = np.zeros(shape, dtype=dtype)
+        elif self.in_memory:
+            self.codes = np.fromfile(self._path('codes.bin'), dtype=dtype, count=shape[0] * shape[1]).reshape(shape)
+        else:
+            self.codes = np.memmap(self._path('codes.bin'), dtype=dtype, mode='r', shape=shape)
+
+    @classmethod
+    def build(cls, store, index_dir=quantized_folder, kind='int8', m=128, ksub=256, sample_size=50_000, seed=0):
+        """Train the quantizer on a sample of the store and encode every row."""
+        start_time = time.time()
+        if kind not in ('int8', 'pq'):
+            raise ValueError(f"Unknown quantization kind: {kind}")
+        if kind == 'pq' and store.dim % m:
+            raise ValueError(f"Embedding dim {store.dim} is not divisible by m={m}.")
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(store), size=min(sample_size, len(store)), replace=False))
+        training = np.asarray(store.embeddings[sample], dtype=np.float32)
+
+        os.makedirs(index_dir, exist_ok=True)
+        meta = {'kind': kind, 'dim': store.dim, 'rows': 0}
+        if kind == 'int8':
+            low = training.min(axis=0)
+            high = training.max(axis=0)
+            scale = np.maximum(high - low, 1e-12) / 255.0
+            np.save(os.path.join(index_dir, 'offset.npy'), low.astype(np.float32))
+            np.save(os.path.join(index_dir, 'scale.npy'), scale.astype(np.float32))
+        else:
+            from sklearn.cluster import KMeans
+
+            dsub = store.dim // m
+            codebooks = np.zeros((m, min(ksub, len(training)), dsub), dtype=np.float32)
+            for j in range(m):
+                kmeans = KMeans(n_clusters=codebooks.shape[1], n_init=1, max_iter=25, random_state=seed)
+                kmeans.fit(training[:, j * dsub:(j + 1) * dsub])
+                codebooks[j] = kmeans.cluster_centers_
+            np.save(os.path.join(index_dir, 'codebooks.npy'), codebooks)
+            meta.update(m=m, ksub=codebooks.shape[1])
+        open(os.path.join(index_dir, 'codes.bin'), 'wb').close()
+        _write_json_atomic(os.path.join(index_dir, 'meta.json'), meta)
+        print(f"Trained {kind} quantizer on {len(training)} rows: {time.time() - start_time:.2f} seconds")
+
+        quantized = cls(index_dir)
+        quantized.add_rows(store)
+        return quantized
+
+    def encode(self, vectors):
+        """Encode float vectors into codes."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.kind == 'int8':
+            codes = np.rint((vectors - self.offset) / self.scale) - 128
+            return np.clip(codes, -128, 127).astype(np.int8)
+        m, _, dsub = self.codebooks.shape
+        codes = np.empty((len(vectors), m), dtype=np.uint8)
+        for j in range(m):
+            sub = vectors[:, j * dsub:(j + 1) * dsub]
+            centroids = self.codebooks[j]
+            distances = np.einsum('ij,ij->i', centroids, centroids)[None, :] - 2.0 * (sub @ centroids.T)
+            codes[:, j] = np.argmin(distances, axis=1)
+        return codes
+
+    def decode(self, codes):
+        """Approximate float vectors back from codes."""
+        if self.kind == 'int8':
+            return (codes.astype(np.float32) + 128) * self.scale + self.offset
+        m, _, dsub = self.codebooks.shape
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(m)], axis=1)
+
+    def add_rows(self, store):
+        """Encode store rows appended since the last call."""
+        start = self.meta['rows']
+        n_rows = len(store)
+        if n_rows <= start:
+            return 0
+        with open(self._path('codes.bin'), 'ab') as f:
+            f.truncate(start * self.codes.shape[1] * self.codes.itemsize)
+            for block_start in range(start, n_rows, block_rows):
+                f.write(self.encode(store.embeddings[block_start:min(n_rows, block_start + block_rows)]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        self.meta = dict(self.meta, rows=n_rows)
+        _write_json_atomic(self._path('meta.json'), self.meta)
+        self.load()
+        return n_rows - start
+
+    def approximate_scores(self, query):
+        """Asymmetric dot-product scores of one float query against every code."""
+        n_rows = len(self.codes)
+        scores = np.empty(n_rows, dtype=np.float32)
+        if self.kind == 'int8':
+            # q.x ~= q.((c + 128) * scale + offset) = c.(q * scale) + 128 * sum(q * scale) + q.offset
+            weights = query * self.scale
+            bias = 128.0 * weights.sum() + query @ self.offset
+            for start in range(0, n_rows, scan_block_rows):
+                block = self.codes[start:start + scan_block_rows]
+                scores[start:start + len(block)] = block.astype(np.float32) @ weights + bias
+            return scores
+        m, ksub, dsub = self.codebooks.shape
+        # Per sub-space lookup table of query . centroid, then sum the table entries picked by the codes
+        tables = np.einsum('jkd,jd->jk', self.codebooks, query.reshape(m, dsub)).astype(np.float32)
+        flat_tables = tables.ravel()
+        table_offsets = (np.arange(m) * ksub)[None, :]
+        for start in range(0, n_rows, scan_block_rows):
+            block = np.asarray(self.codes[start:start + scan_block_rows], dtype=np.intp)
+            scores[start:start + len(block)] = flat_tables[block + table_offsets].sum(axis=1)
+        return scores
+
+    def search(self, store, queries, k=10, rerank=100):
+        """Scan the codes, then re-rank the best `rerank` rows with exact float scores.
+
+        Returns hit_dtype records of shape (n_queries, <=k).
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        results = np.zeros((len(queries), k), dtype=hit_dtype)
+        results['score'] = -np.inf
+        results['row'] = -1
+        live = store.live
+        for q, query in enumerate(queries):
+            scores = self.approximate_scores(query)
+            if live is not None:
+                scores[~live[:len(scores)]] = -np.inf
+            candidates, candidate_scores = topk_from_scores(scores[None, :], min(max(rerank, k), len(scores)))
+            # With fewer live rows than candidates, masked rows fill the tail; drop them before the re-rank
+            rows = np.sort(candidates[0][candidate_scores[0] > -np.inf])
+            exact = (np.asarray(store.embeddings[rows], dtype=np.float32) @ query)[None, :]
+            top, top_scores = topk_from_scores(exact, min(k, len(rows)))
+            found_rows = rows[top[0]]
+            results[q, :len(found_rows)] = hits_from_rows(found_rows, top_scores[0], store.chunks)
+        return results
+
+
+if __name__ == '__main__':
+    kind = sys.argv[1] if len(sys.argv) > 1 else 'int8'
+    store = EmbeddingStore(store_folder)
+    index_dir = f"{quantized_folder}_{kind}"
+    if os.path.exists(os.path.join(index_dir, 'meta.json')):
+        quantized = QuantizedStore(index_dir)
+        print(f"Encoded {quantized.add_rows(store)} new rows")
+    else:
+        quantized = QuantizedStore.build(store, index_dir, kind)
+    size = os.path.getsize(os.path.join(index_dir, 'codes.bin'))
+    print(f"{quantized.meta['rows']} rows, codes {size / 2**20:.1f} MB "
+          f"({store.embeddings.nbytes / max(size, 1):.0f}x smaller than the float embeddings)")
@@ -0,0 +1,165 @@
+"""
+Cache of query embeddings in front of the encoder.
+
+Entries are keyed on the normalized query (lowercase, single spaces), so
+"Red " and "red" share one entry; the text embedded for an entry is the
+query as first seen, exactly as the user typed it. Keys also carry a model
+fingerprint, which changes whenever the model or the embedding settings
+change, so stale vectors are never served.
+
+Lookups go through a bounded in-memory LRU, then an optional sqlite table
+that survives restarts and is opened on the first lookup; the remaining
+misses are embedded in one batch and written to both tiers.
+"""
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+query_cache_file = 'query_embeddings.sqlite'
+
+
+def normalize_query(text):
+    return ' '.join(text.lower().split())
+
+
+def model_fingerprint(model_name, embedder):
+    """Short hash of everything that changes the vectors an embedder returns."""
+    parts = [model_name, embedder.embedding_dim, getattr(embedder, 'scale', None),
+             getattr(embedder, 'max_length', None), str(getattr(embedder, 'dtype', None))]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class QueryEmbeddingCache:
+    """Two-tier (memory, sqlite) cache of query embeddings.
+
+    Exposes embed() and embedding_dim like BatchEmbedder, so it can be passed
+    wherever an embedder is used for queries.
+
+    Args:
+        embedder (BatchEmbedder): Encoder used for misses.
+        fingerprint (str): Model fingerprint (see model_fingerprint()).
+        cache_size (int): Entries kept in the in-memory LRU.
+        db_path (str): sqlite file for the persistent tier, or None for memory only.
+    """
+
+    def __init__(self, embedder, fingerprint, cache_size=4096, db_path=None):
+        self.embedder = embedder
+        self.fingerprint = fingerprint
+        self.embedding_dim = embedder.embedding_dim
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db_path = db_path
+        self.db = None
+
+    def _connect(self):
+        """Open the sqlite tier on first use; None when there is none. Call with the lock held."""
+        if self.db is None and self.db_path is not None:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS query_embeddings ('
+                            'fingerprint TEXT, query TEXT, embedding BLOB, PRIMARY KEY (fingerprint, query))')
+            self.db.commit()
+        return self.db
+
+    def _remember(self, query, embedding):
+        self.cache[query] = embedding
+        self.cache.move_to_end(query)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _load(self, queries):
+        """{query: embedding} of the queries found in the sqlite tier."""
+        found = {}
+        for start in range(0, len(queries), 500):
+            batch = queries[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT query, embedding FROM query_embeddings WHERE fingerprint = ? "
+                f"AND query IN ({','.join('?' * len(batch))})", [self.fingerprint, *batch])
+            for query, blob in rows:
+                found[query] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def embed(self, texts):
+        """Embeddings of `texts` as a float32 (n, embedding_dim) array, in input order."""
+        queries = [normalize_query(text) for text in texts]
+        result = np.zeros((len(queries), self.embedding_dim), dtype=np.float32)
+        missing = {}
+        first_texts = {}
+        with self.lock:
+            for i, query in enumerate(queries):
+                embedding = self.cache.get(query)
+                if embedding is not None:
+                    self.cache.move_to_end(query)
+                    self.hits += 1
+                    result[i] = embedding
+                else:
+                    missing.setdefault(query, []).append(i)
+                    first_texts.setdefault(query, texts[i])
+            if missing and self._connect() is not None:
+                for query, embedding in self._load(list(missing)).items():
+                    self.disk_hits += len(missing[query])
+                    result[missing.pop(query)] = embedding
+                    self._remember(query, embedding)
+        if not missing:
+            return result
+
+        # Embed outside the lock so hits from other threads are not held up
+        new_queries = list(missing)
+        embeddings = self.embedder.embed([first_texts[query] for query in new_queries]).astype(np.float32)
+        with self.lock:
+            self.misses += sum(len(rows) for rows in missing.values())
+            for query, embedding in zip(new_queries, embeddings):
+                result[missing[query]] = embedding
+                self._remember(query, embedding)
+            if self.db is not None:
+                self.db.executemany('INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)',
+                                    [(self.fingerprint, q, e.tobytes()) for q, e in zip(new_queries, embeddings)])
+                self.db.commit()
+        return result
+
+    def get(self, text):
+        """Embedding of one query string."""
+        return self.embed([text])[0]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+                    'entries': len(self.cache)}
+
+    def clear(self):
+        """Drop every entry of this fingerprint from both tiers."""
+        with self.lock:
+            self.cache.clear()
+            if self._connect() is not None:
+                self.db.execute('DELETE FROM query_embeddings WHERE fingerprint = ?', (self.fingerprint,))
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            self.db_path = None
+
+
+if __name__ == '__main__':
+    from batch_embedder import BatchEmbedder, load_encoder
+
+    tokenizer, model = load_encoder()
+    embedder = BatchEmbedder(tokenizer, model)
+    cache = QueryEmbeddingCache(embedder, model_fingerprint('BAAI/bge-m3', embedder), db_path=query_cache_file)
+    for query in sys.argv[1:]:
+        start_time = time.time()
+        cache.get(query)
+        print(f"{query}: {(time.time() - start_time) * 1000:.2f} ms")
+    print(cache.stats())
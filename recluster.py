@@ -0,0 +1,289 @@
+"""
+Offline rebuild of the cluster tree from every chunk embedding in documents4/.
+
+    python recluster.py [memory_mb] [epochs]
+
+ClusterTree grows by splitting leaves as documents arrive, so its shape
+depends on the ingest order and leaves are anywhere from a few to
+max_chunks_per_cluster members. A rebuild starts over:
+
+    1. the chunk count comes from the document file sizes, and the number of
+       leaves is k = chunks / (leaf_fill * max_chunks_per_cluster),
+    2. MiniBatchKMeans is seeded on a uniform sample of the chunks and then
+       trained with partial_fit over fixed-size blocks streamed from the
+       document memmaps, for `epochs` passes,
+    3. every chunk goes to its nearest centroid that still has room, with
+       room capped at (1 + balance_slack) * chunks / k, so leaves come out
+       balanced and no chunk is dropped,
+    4. the leaves are bulk loaded into a new tree in clusters.rebuild/, and
+    5. the new directory is swapped in for clusters/; the old one is moved to
+       clusters.old/ first and deleted last, and a swap interrupted between
+       the two renames is finished on the next run.
+
+At most one block of embeddings (plus its distance matrix), the centroids
+and about 12 bytes per chunk are in memory at a time; the block size is
+derived from `memory_mb`. Run it while nothing is ingesting into the tree.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import numpy as np
+
+from cluster_assignment import ClusterTree, cluster_folder, documents_folder
+
+report_file = 'recluster_report.json'
+
+
+def document_sizes(documents_dir=documents_folder, embedding_dim=1024):
+    """Sorted (doc_id, n_chunks) pairs of the document memmaps, from their file sizes."""
+    record_size = 8 + 4 * embedding_dim
+    sizes = []
+    for name in os.listdir(documents_dir):
+        if name.endswith('.npy') and name[:-4].isdigit() and int(name[:-4]) != 0:
+            size = os.path.getsize(os.path.join(documents_dir, name))
+            if size % record_size == 0 and size:
+                sizes.append((int(name[:-4]), size // record_size))
+    return sorted(sizes)
+
+
+def iter_blocks(documents_dir, sizes, block_rows, embedding_dim=1024):
+    """Yield (doc_ids, chunk_indices, embeddings) blocks of up to block_rows chunks, in document order.
+
+    The yielded arrays are reused by the next block.
+    """
+    dtype = [('start_id', np.int32), ('end_id', np.int32), ('embedding', np.float32, (embedding_dim,))]
+    doc_ids = np.zeros(block_rows, dtype=np.int32)
+    chunk_indices = np.zeros(block_rows, dtype=np.int32)
+    embeddings = np.zeros((block_rows, embedding_dim), dtype=np.float32)
+    filled = 0
+    for doc_id, n_chunks in sizes:
+        document = np.memmap(os.path.join(documents_dir, f'{doc_id}.npy'), dtype=dtype, mode='r')
+        start = 0
+        while start < n_chunks:
+            take = min(n_chunks - start, block_rows - filled)
+            doc_ids[filled:filled + take] = doc_id
+            chunk_indices[filled:filled + take] = np.arange(start, start + take)
+            embeddings[filled:filled + take] = document['embedding'][start:start + take]
+            filled += take
+            start += take
+            if filled == block_rows:
+                yield doc_ids, chunk_indices, embeddings
+                filled = 0
+        del document
+    if filled:
+        yield doc_ids[:filled], chunk_indices[:filled], embeddings[:filled]
+
+
+def sample_rows(documents_dir, sizes, size, block_rows, embedding_dim=1024, seed=0):
+    """Embeddings of `size` chunks drawn uniformly without replacement, in one streaming pass."""
+    n_chunks = sum(n for _, n in sizes)
+    picked = np.sort(np.random.default_rng(seed).choice(n_chunks, size=min(size, n_chunks), replace=False))
+    sample = np.zeros((len(picked), embedding_dim), dtype=np.float32)
+    offset = taken = 0
+    for _, _, embeddings in iter_blocks(documents_dir, sizes, block_rows, embedding_dim):
+        stop = np.searchsorted(picked, offset + len(embeddings))
+        sample[taken:stop] = embeddings[picked[taken:stop] - offset]
+        taken = stop
+        offset += len(embeddings)
+    return sample
+
+
+def assign_balanced(distances, room, candidates=8):
+    """Nearest-centroid labels for a block that never exceed the remaining `room` of a centroid.
+
+    Rows try their `candidates` nearest centroids in order, the closest rows
+    first; rows that find them all full take the nearest centroid with room.
+    `room` is decremented in place.
+    """
+    n, k = distances.shape
+    labels = np.full(n, -1, dtype=np.int64)
+    candidates = min(candidates, k)
+    nearest = np.argpartition(distances, candidates - 1, axis=1)[:, :candidates] if candidates < k else \
+        np.tile(np.arange(k), (n, 1))
+    nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(distances, nearest, axis=1), axis=1), axis=1)
+    for rank in range(candidates):
+        rows = np.nonzero(labels < 0)[0]
+        if not len(rows):
+            break
+        wanted = nearest[rows, rank]
+        order = np.lexsort((distances[rows, wanted], wanted))
+        rows, wanted = rows[order], wanted[order]
+        # Position of each row within its centroid's group, closest first
+        group_starts = np.r_[0, np.nonzero(np.diff(wanted))[0] + 1]
+        within = np.arange(len(wanted)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(wanted)]))
+        accept = within < room[wanted]
+        labels[rows[accept]] = wanted[accept]
+        room -= np.bincount(wanted[accept], minlength=k)
+    for row in np.nonzero(labels < 0)[0]:
+        labels[row] = np.where(room > 0, distances[row], np.inf).argmin()
+        room[labels[row]] -= 1
+    return labels
+
+
+def size_report(sizes):
+    """Summary of a leaf size distribution."""
+    sizes = np.asarray(sizes)
+    edges = [0, 100, 250, 500, 750, 900, 1000, np.inf]
+    histogram = np.histogram(sizes, bins=edges)[0]
+    return {
+        'leaves': len(sizes),
+        'min': int(sizes.min()),
+        'p10': float(np.percentile(sizes, 10)),
+        'median': float(np.median(sizes)),
+        'p90': float(np.percentile(sizes, 90)),
+        'max': int(sizes.max()),
+        'mean': float(sizes.mean()),
+        'std': float(sizes.std()),
+        'histogram': {f'{int(lo)}-{hi if np.isinf(hi) else int(hi) - 1}': int(count)
+                      for lo, hi, count in zip(edges[:-1], edges[1:], histogram) if count},
+    }
+
+
+def swap_directories(new_dir, target_dir):
+    """Replace target_dir with new_dir: target moves to target.old, new moves in, old is deleted."""
+    old_dir = target_dir.rstrip('/\\') + '.old'
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.exists(target_dir):
+        os.rename(target_dir, old_dir)
+    os.rename(new_dir, target_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def recover_swap(target_dir):
+    """Finish or undo a swap interrupted between its renames; returns True if anything was done."""
+    old_dir = target_dir.rstrip('/\\') + '.old'
+    new_dir = target_dir.rstrip('/\\') + '.rebuild'
+    if os.path.exists(target_dir) or not os.path.exists(old_dir):
+        return False
+    # The old tree was moved aside; the rebuilt one is only used if it was completed
+    if os.path.exists(os.path.join(new_dir, report_file)):
+        os.rename(new_dir, target_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(old_dir, target_dir)
+    print(f"Recovered interrupted swap of {target_dir}")
+    return True
+
+
+def recluster(documents_dir=documents_folder, target_dir=cluster_folder, max_chunks_per_cluster=1000,
+              embedding_dim=1024, memory_mb=1024, epochs=3, leaf_fill=0.75, balance_slack=0.25,
+              branching=4, seed=0):
+    """Rebuild the cluster tree in target_dir from every document in documents_dir.
+
+    Args:
+        memory_mb (int): Budget for the embeddings, centroids and per-chunk arrays held at once.
+        epochs (int): Mini-batch passes over all chunks.
+        leaf_fill (float): Target leaf size as a fraction of max_chunks_per_cluster.
+        balance_slack (float): How far above the average size a leaf may grow.
+        branching (int): Children per parent when the leaves are linked into a tree.
+
+    Returns:
+        dict: The report, also written to target_dir/recluster_report.json.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    start_time = time.time()
+    timings = {}
+    recover_swap(target_dir)
+    sizes = document_sizes(documents_dir, embedding_dim)
+    n_chunks = sum(n for _, n in sizes)
+    if n_chunks == 0:
+        raise ValueError(f"No document embeddings found in {documents_dir}")
+    k = max(1, int(np.ceil(n_chunks / (leaf_fill * max_chunks_per_cluster))))
+    capacity = min(max_chunks_per_cluster, int(np.ceil(n_chunks / k * (1 + balance_slack))))
+
+    # Fixed: centroids (sklearn's float32 copy, our float32 copy, float64 sums) and 12 bytes per chunk
+    fixed = k * embedding_dim * (4 + 4 + 8) + n_chunks * 12
+    # Per block row: the float32 embedding, a float32 distance row and the sort scratch for candidates
+    per_row = embedding_dim * 4 + k * 4 * 2 + 256
+    block_rows = int((memory_mb * 2 ** 20 - fixed) // per_row)
+    if block_rows < k:
+        raise ValueError(f"memory_mb={memory_mb} leaves room for {max(block_rows, 0)} rows per block, "
+                         f"but {k} leaves need at least {k}; raise memory_mb or leaf_fill")
+    block_rows = min(block_rows, 65536, n_chunks)
+    print(f"Reclustering {n_chunks} chunks of {len(sizes)} documents into {k} leaves of at most "
+          f"{capacity} chunks, {block_rows} rows per block")
+
+    kmeans = MiniBatchKMeans(n_clusters=k, batch_size=block_rows, random_state=seed, n_init=1,
+                             reassignment_ratio=0.01)
+    kmeans.partial_fit(sample_rows(documents_dir, sizes, block_rows, block_rows, embedding_dim, seed))
+    timings['seed'] = time.time() - start_time
+    for epoch in range(epochs):
+        epoch_time = time.time()
+        for _, _, embeddings in iter_blocks(documents_dir, sizes, block_rows, embedding_dim):
+            kmeans.partial_fit(embeddings)
+        print(f"Epoch {epoch + 1}/{epochs}: {time.time() - epoch_time:.2f} seconds")
+    timings['train'] = time.time() - start_time - timings['seed']
+
+    assign_time = time.time()
+    centroids = kmeans.cluster_centers_.astype(np.float32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    room = np.full(k, capacity, dtype=np.int64)
+    labels = np.zeros(n_chunks, dtype=np.int32)
+    members = np.zeros(n_chunks, dtype=[('doc_id', 'i4'), ('chunk_index', 'i4')])
+    sums = np.zeros((k, embedding_dim), dtype=np.float64)
+    inertia = 0.0
+    offset = 0
+    for doc_ids, chunk_indices, embeddings in iter_blocks(documents_dir, sizes, block_rows, embedding_dim):
+        distances = centroid_norms[None, :] - 2.0 * (embeddings @ centroids.T)
+        block_labels = assign_balanced(distances, room)
+        rows = slice(offset, offset + len(block_labels))
+        labels[rows] = block_labels
+        members['doc_id'][rows] = doc_ids
+        members['chunk_index'][rows] = chunk_indices
+        by_label = np.argsort(block_labels, kind='stable')
+        used, starts = np.unique(block_labels[by_label], return_index=True)
+        sums[used] += np.add.reduceat(embeddings[by_label], starts, axis=0, dtype=np.float64)
+        inertia += float(distances[np.arange(len(block_labels)), block_labels].sum()
+                         + np.einsum('ij,ij->', embeddings, embeddings))
+        offset += len(block_labels)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(labels, minlength=k))]
+    filled = np.nonzero(bounds[1:] > bounds[:-1])[0]
+    leaves = [members[order[bounds[i]:bounds[i + 1]]] for i in filled]
+    del labels, members, order
+    timings['assign'] = time.time() - assign_time
+
+    write_time = time.time()
+    new_dir = target_dir.rstrip('/\\') + '.rebuild'
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+    tree = ClusterTree(new_dir, max_chunks_per_cluster, embedding_dim, documents_dir, branching)
+    tree.bulk_load(leaves, sums[filled])
+    report = {
+        'chunks': n_chunks,
+        'documents': len(sizes),
+        'leaf_capacity': capacity,
+        'depth': tree.depth(),
+        'nodes': len(tree.ids),
+        'mean_squared_distance': inertia / n_chunks,
+        'block_rows': block_rows,
+        'memory_mb': memory_mb,
+        'epochs': epochs,
+        'sizes': size_report([len(leaf) for leaf in leaves]),
+    }
+    timings['write'] = time.time() - write_time
+    report['seconds'] = {name: round(seconds, 2) for name, seconds in timings.items()}
+    # Written last: a rebuild directory with a report is complete
+    with open(os.path.join(new_dir, report_file), 'w') as f:
+        json.dump(report, f, indent=2)
+    swap_directories(new_dir, target_dir)
+    report['seconds']['total'] = round(time.time() - start_time, 2)
+
+    sizes_summary = report['sizes']
+    print(f"Leaf sizes: min {sizes_summary['min']}, median {sizes_summary['median']:.0f}, "
+          f"p90 {sizes_summary['p90']:.0f}, max {sizes_summary['max']}, std {sizes_summary['std']:.1f}")
+    print(f"Leaf size histogram: {sizes_summary['histogram']}")
+    print(f"Rebuilt {target_dir}: {len(leaves)} leaves, depth {report['depth']}. "
+          f"Total time taken: {report['seconds']['total']:.2f} seconds")
+    return report
+
+
+if __name__ == '__main__':
+    memory_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    epochs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    recluster(memory_mb=memory_mb, epochs=epochs)
@@ -1,165 +1,80 @@
 import os
-import re
 import shelve
-import pickle
+
+from mapping_service import get_mapping_service
+from diagnosis_engine import get_diagnosis_engine
+from fuzzy_symptom_index import find_symptoms
+from symptom_dictionary import compile_from_shelves
+from symptom_graph_writer import SymptomGraphWriter
+from symptom_parser import symptom_synonym_pattern
 
 # Define the folder containing the files
 folder_path = "./somepath"  # Replace this with the actual folder path
 
 # Regex patterns for extracting multiple symptoms and their details
-symptom_pattern = re.compile(
-    r"<start_symptom_name>(.*?)</start_symptom_name>.*?<start_synonyms>(.*?)</start_synonyms>",
-    re.DOTALL,
-)
-
-
-# Define pickle file for storing counters
-counter_file = "counters.pickle"
+symptom_pattern = symptom_synonym_pattern
 
-# Load counters from pickle file if it exists
-def load_counters():
-    if os.path.exists(counter_file):
-        with open(counter_file, "rb") as f:
-            return pickle.load(f)
-    else:
-        # Return initial counters if pickle file does not exist
-        return {
-            "symptom_counter": 1,
-            "disease_counter": 1
-        }
+def ingest_folder(folder_path, batch_size=500):
+    """Map every disease file in `folder_path` and its symptoms, committing in batches."""
+    with SymptomGraphWriter(batch_size=batch_size) as writer:
+        print("Opened")
 
-# Save counters to pickle file
-def save_counters(counters):
-    with open(counter_file, "wb") as f:
-        pickle.dump(counters, f)
+        # Iterate through files in the folder
+        for file_name in os.listdir(folder_path):
+            file_path = os.path.join(folder_path, file_name)
+            print(file_path)
 
-# Load counters
-counters = load_counters()
-symptom_counter = counters["symptom_counter"]
-disease_counter = counters["disease_counter"]
+            # Ensure it's a file (not a directory)
+            if os.path.isfile(file_path):
+                # Extract disease name from the file name (remove extension if present)
+                disease_name = os.path.splitext(file_name)[0].strip()
+                if writer.has_disease(disease_name):
+                    print("Exists")
+                    continue
 
-# Open shelves to store the dictionaries
-with shelve.open("symptom_to_number", writeback=True) as symptom_to_number_db, \
-     shelve.open("number_to_symptom", writeback=True) as number_to_symptom_db, \
-     shelve.open("number_to_synonyms", writeback=True) as number_to_synonyms_db, \
-     shelve.open("disease_to_number", writeback=True) as disease_to_number_db, \
-     shelve.open("number_to_disease", writeback=True) as number_to_disease_db, \
-     shelve.open("symptom_to_disease", writeback=True) as symptom_to_disease_db:
-    print("Opened")
-
-    # Iterate through files in the folder
-    for file_name in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, file_name)
-        print(file_path)
-
-        # Ensure it's a file (not a directory)
-        if os.path.isfile(file_path):
-            # Extract disease name from the file name (remove extension if present)
-            disease_name = os.path.splitext(file_name)[0].strip()
-
-            # Map the disease name to a unique number if not already mapped
-            if disease_name not in disease_to_number_db:
-                disease_to_number_db[disease_name] = str(disease_counter)
-                number_to_disease_db[str(disease_counter)] = disease_name
-                disease_counter += 1
-                # Save counters after adding a new disease
-                save_counters({"symptom_counter": symptom_counter, "disease_counter": disease_counter})
-            else:
-                print("Exists")
-                continue
-            # Retrieve the current disease number
-            disease_number = disease_to_number_db[disease_name]
-
-            with open(file_path, "r", encoding="utf-8") as file:
-                content = file.read()
+                with open(file_path, "r", encoding="utf-8") as file:
+                    content = file.read()
 
                 # Find all symptoms and their synonyms in the content
-                matches = symptom_pattern.findall(content)
-                for symptom_name, synonyms in matches:
-                    symptom_name = symptom_name.strip().lower()
-                    synonyms_list = [synonym.strip().lower() for synonym in synonyms.split(",")]
-
-                    # Map the symptom name to a unique number if not already mapped
-                    if symptom_name not in symptom_to_number_db:
-                        symptom_to_number_db[symptom_name] = str(symptom_counter)
-                        number_to_symptom_db[str(symptom_counter)] = symptom_name
-                        symptom_counter += 1
-                        # Save counters after adding a new symptom
-                        save_counters({"symptom_counter": symptom_counter, "disease_counter": disease_counter})
-
-                    # Retrieve the current symptom number
-                    symptom_number = str(symptom_to_number_db[symptom_name])
-
-                    # Map the symptom to the current disease
-                    symptom_diseases = symptom_to_disease_db.get(symptom_number, set())
-                    symptom_diseases.add(disease_number)
-                    symptom_to_disease_db[symptom_number] = symptom_diseases
-
-                    # Update synonyms for the symptom
-                    synonym_numbers = number_to_synonyms_db.get(symptom_number, [])
-                    for synonym in synonyms_list:
-                        # Map synonym to a unique number if not already mapped
-                        if synonym not in symptom_to_number_db:
-                            symptom_to_number_db[synonym] = str(symptom_counter)
-                            number_to_symptom_db[str(symptom_counter)] = synonym
-                            synonym_numbers.append(str(symptom_counter))
-                            symptom_counter += 1
-                            # Save counters after adding a new synonym
-                            save_counters({"symptom_counter": symptom_counter, "disease_counter": disease_counter})
-                        else:
-                            synonym_numbers.append(symptom_to_number_db[synonym])
-
-                        # Retrieve the current synonym number
-                        synonym_number = symptom_to_number_db[synonym]
-
-                        # Map the synonym to the current disease
-                        synonym_diseases = symptom_to_disease_db.get(synonym_number, set())
-                        synonym_diseases.add(disease_number)
-                        symptom_to_disease_db[synonym_number] = synonym_diseases
-
-                    # Remove duplicates from synonym numbers and update the shelf
-                    number_to_synonyms_db[symptom_number] = list(set(synonym_numbers))
+                writer.add_disease(disease_name, symptom_pattern.findall(content))
 
     print("All mappings have been successfully stored in the shelves.")
+    return writer.committed_files
+
+# Incremental: only new disease files are added. For a full, reproducible
+# rebuild on every core run symptom_graph_builder.py instead.
+ingest_folder(folder_path)
 
-    # Save counters one last time after processing all files
-    save_counters({"symptom_counter": symptom_counter, "disease_counter": disease_counter})
+# Compile the read-only dictionary the lookups below are served from
+compile_from_shelves()
 
 # Function to retrieve symptom number by name
 def get_symptom_number(symptom_name):
-    with shelve.open("symptom_to_number") as symptom_to_number_db:
-        return symptom_to_number_db.get(symptom_name, None)
+    return get_mapping_service().symptom_number(symptom_name)
 
 # Function to retrieve symptom name by number
 def get_symptom_name_by_number(symptom_number):
-    with shelve.open("number_to_symptom") as number_to_symptom_db:
-        return number_to_symptom_db.get(symptom_number, None)
+    return get_mapping_service().symptom_name(symptom_number)
 
 # Function to retrieve synonyms by symptom number
 def get_synonyms_by_number(symptom_number):
-    with shelve.open("number_to_synonyms") as number_to_synonyms_db:
-        return number_to_synonyms_db.get(symptom_number, [])
+    return get_mapping_service().synonyms(symptom_number)
 
 # Function to retrieve disease number by name
 def get_disease_number(disease_name):
-    with shelve.open("disease_to_number") as disease_to_number_db:
-        return disease_to_number_db.get(disease_name, None)
+    return get_mapping_service().disease_number(disease_name)
 
 # Function to retrieve disease name by number
 def get_disease_name_by_number(disease_number):
-    with shelve.open("number_to_disease") as number_to_disease_db:
-        return number_to_disease_db.get(disease_number, None)
+    return get_mapping_service().disease_name(disease_number)
 
 # Function to retrieve symptom-to-disease mappings
 def get_diseases_by_symptom(symptom_name):
-    with shelve.open("symptom_to_number") as symptom_to_number_db, \
-         shelve.open("symptom_to_disease") as symptom_to_disease_db, \
-         shelve.open("number_to_disease") as number_to_disease_db:
-        symptom_number = symptom_to_number_db.get(symptom_name, None)
-        if symptom_number:
-            disease_numbers = symptom_to_disease_db.get(symptom_number, [])
-            return [number_to_disease_db.get(disease_number, None) for disease_number in disease_numbers]
-        return []
+    return get_mapping_service().diseases_by_symptom(symptom_name)
+
+# Function to rank diseases for several symptoms (synonyms resolved, BM25 weighted)
+def diagnose_symptoms(symptom_names, k=10):
+    return get_diagnosis_engine().diagnose(symptom_names, k)
 
 
 # File names for bidirectional mapping
@@ -168,29 +83,17 @@ value_to_key_file = 'value_to_key.db'  # doc_id -> pdf_file
 
 def load_doc_mapping_by_key(pdf_file):
     """Load a single document mapping using the pdf_file (key)."""
-    try:
-        with shelve.open(key_to_value_file, flag='r') as db:
-            # Return the doc_id for the given pdf_file, or None if not found
-            return db.get(pdf_file, None)
-    except (FileNotFoundError, KeyError) as e:
-        # If the file doesn't exist or the key is not found, handle it gracefully
-        print(f"Error loading mapping for '{pdf_file}' by key: {e}")
-        return None
+    return get_mapping_service().doc_id(pdf_file)
 
 def load_doc_mapping_by_value(doc_id):
     """Load a single document mapping using the doc_id (value)."""
-    try:
-        with shelve.open(value_to_key_file, flag='r') as db:
-            # Return the pdf_file for the given doc_id, or None if not found
-            return db.get(doc_id, None)
-    except (FileNotFoundError, KeyError) as e:
-        # If the file doesn't exist or the key is not found, handle it gracefully
-        print(f"Error loading mapping for doc_id '{doc_id}' by value: {e}")
-        return None
+    return get_mapping_service().doc_file(doc_id)
 
 def delete_doc_mapping_by_key(pdf_file):
     """Delete a specific document mapping using the pdf_file (key)."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Key to value (pdf_file -> doc_id)
         with shelve.open(key_to_value_file, flag='c') as key_db:
             if pdf_file in key_db:
@@ -218,6 +121,8 @@ def delete_doc_mapping_by_key(pdf_file):
 def delete_doc_mapping_by_value(doc_id):
     """Delete a specific document mapping using the doc_id (value)."""
     try:
+        # Drop the mapping service's read handles so the shelves can be opened for writing
+        get_mapping_service().invalidate_documents()
         # Value to key (doc_id -> pdf_file)
         with shelve.open(value_to_key_file, flag='c') as value_db:
             if doc_id in value_db:
@@ -244,25 +149,19 @@ def delete_doc_mapping_by_value(doc_id):
 
 def check_key_exists(pdf_file):
     """Check if a pdf_file exists in the key-to-value mapping (key file)."""
-    try:
-        with shelve.open(key_to_value_file, flag='r') as db:
-            return pdf_file in db  # Return True if the key exists, else False
-    except (FileNotFoundError, KeyError) as e:
-        print(f"Error checking existence of '{pdf_file}': {e}")
-        return False
+    return get_mapping_service().contains(key_to_value_file, pdf_file)
 
 def check_value_exists(doc_id):
     """Check if a doc_id exists in the value-to-key mapping (value file)."""
-    try:
-        with shelve.open(value_to_key_file, flag='r') as db:
-            return str(doc_id) in db  # Return True if the value exists, else False
-    except (FileNotFoundError, KeyError) as e:
-        print(f"Error checking existence of doc_id '{doc_id}': {e}")
-        return False
+    return get_mapping_service().contains(value_to_key_file, doc_id)
 
 print("Some stuff")
 # Example usage
 symptom_name = "Joint Pain"
+# Lookups below are exact; resolve the typed name to its dictionary entry first
+matches = find_symptoms(symptom_name, 1)
+if matches:
+    symptom_name = matches[0].name
 disease_name = "arthritis"
 disease_text = "autosomal dominant nocturnal frontal lobe epilepsy 1.txt"
 print(f"Loading doc {disease_name}, {load_doc_mapping_by_key(disease_text)}")
@@ -283,7 +182,6 @@ else:
     print(f"No diseases found for symptom '{symptom_name}'.")
 
 
-symptom_name = "Joint Pain"
 symptom_number = get_symptom_number(symptom_name)
 if symptom_number:
     print(f"Symptom Number for {symptom_name}: {symptom_number}")
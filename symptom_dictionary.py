@@ -0,0 +1,228 @@
+"""
+Compiled, read-only symptom/disease dictionary replacing the six mapping shelves.
+
+IDs are the integers behind the shelves' string numbers. Names live in a
+string table indexed by ID with a second, name-sorted order for binary
+search; symptom -> diseases, symptom -> synonyms and disease -> symptoms are
+CSR arrays (offsets + flat IDs). Every file is a plain array that is
+memory-mapped on open, so loading takes milliseconds and lookups never unpickle.
+
+Layout of a dictionary directory:
+
+    meta.json                       symptom / disease counts
+    {kind}_names.bin                UTF-8 names of kind symptom / disease, concatenated by ID
+    {kind}_offsets.npy              (max_id + 2) byte offsets into {kind}_names.bin
+    {kind}_sorted.npy               IDs ordered by name bytes, for binary search
+    symptom_diseases_{offsets,ids}.npy   CSR symptom -> diseases
+    synonyms_{offsets,ids}.npy           CSR symptom -> synonym symptoms
+    disease_symptoms_{offsets,ids}.npy   CSR disease -> symptoms (reverse of the first)
+"""
+import os
+import sys
+import mmap
+import json
+import time
+import shutil
+import shelve
+import numpy as np
+
+dictionary_folder = 'symptom_dictionary'
+
+
+class StringTable:
+    """ID -> name table with binary-searchable name -> ID lookups.
+
+    `blob` is any bytes-like object (an mmap.mmap at serve time); slicing it
+    is much cheaper than slicing a numpy memmap in the binary search loop.
+    """
+
+    def __init__(self, blob, offsets, order):
+        self.blob = blob
+        self.offsets = offsets
+        self.order = order
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _bytes(self, id):
+        return self.blob[self.offsets[id]:self.offsets[id + 1]]
+
+    def name(self, id):
+        """Name of `id`, or None for unknown IDs."""
+        if not 0 <= id < len(self) or self.offsets[id] == self.offsets[id + 1]:
+            return None
+        return self._bytes(id).decode('utf-8')
+
+    def find(self, name):
+        """ID of `name`, or -1."""
+        target = name.encode('utf-8')
+        low, high = 0, len(self.order)
+        while low < high:
+            mid = (low + high) // 2
+            value = self._bytes(self.order[mid])
+            if value < target:
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(self.order) and self._bytes(self.order[low]) == target:
+            return int(self.order[low])
+        return -1
+
+
+def _csr(pairs, n_rows):
+    """(offsets, ids) of a CSR matrix with `n_rows` rows from (row, id) pairs, ids sorted per row."""
+    pairs = np.unique(np.asarray(pairs, dtype=np.int64).reshape(-1, 2), axis=0)
+    offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(pairs[:, 0], minlength=n_rows))
+    return offsets, pairs[:, 1].astype(np.int32)
+
+
+def _string_table_arrays(names, size):
+    """(blob, offsets, sorted order) for an {id: name} dict; missing IDs get empty names."""
+    encoded = [b''] * size
+    for id, name in names.items():
+        encoded[id] = name.encode('utf-8')
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    order = np.array(sorted(names, key=lambda id: encoded[id]), dtype=np.int32)
+    return b''.join(encoded), offsets, order
+
+
+def compile_dictionary(symptom_names, disease_names, symptom_diseases, synonyms, dict_dir=dictionary_folder):
+    """Write a dictionary directory from plain mappings.
+
+    Args:
+        symptom_names (dict): {symptom_id: name}.
+        disease_names (dict): {disease_id: name}.
+        symptom_diseases (dict): {symptom_id: iterable of disease_ids}.
+        synonyms (dict): {symptom_id: iterable of synonym symptom_ids}.
+        dict_dir (str): Output directory; replaced as a whole once complete.
+    """
+    start_time = time.time()
+    n_symptoms = max(symptom_names, default=0) + 1
+    n_diseases = max(disease_names, default=0) + 1
+
+    tmp_dir = dict_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for kind, names, size in (('symptom', symptom_names, n_symptoms), ('disease', disease_names, n_diseases)):
+        blob, offsets, order = _string_table_arrays(names, size)
+        with open(os.path.join(tmp_dir, f'{kind}_names.bin'), 'wb') as f:
+            f.write(blob)
+        np.save(os.path.join(tmp_dir, f'{kind}_offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, f'{kind}_sorted.npy'), order)
+
+    pairs = [(s, d) for s, diseases in symptom_diseases.items() for d in diseases]
+    for name, csr_pairs, n_rows in (
+            ('symptom_diseases', pairs, n_symptoms),
+            ('synonyms', [(s, t) for s, ids in synonyms.items() for t in ids], n_symptoms),
+            ('disease_symptoms', [(d, s) for s, d in pairs], n_diseases)):
+        offsets, ids = _csr(csr_pairs, n_rows)
+        np.save(os.path.join(tmp_dir, f'{name}_offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, f'{name}_ids.npy'), ids)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump({'symptoms': len(symptom_names), 'diseases': len(disease_names)}, f)
+
+    # Swap the finished directory in; readers holding the old maps keep working
+    old_dir = dict_dir + '.old'
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(dict_dir):
+        os.rename(dict_dir, old_dir)
+    os.rename(tmp_dir, dict_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    print(f"Compiled {len(symptom_names)} symptoms and {len(disease_names)} diseases: "
+          f"{time.time() - start_time:.2f} seconds")
+
+
+def compile_from_shelves(dict_dir=dictionary_folder, shelf_dir='.'):
+    """Compile the six somediseasesymptoms.py shelves into a dictionary directory."""
+    def shelf(name):
+        return shelve.open(os.path.join(shelf_dir, name), flag='r')
+
+    with shelf('number_to_symptom') as db:
+        symptom_names = {int(number): name for number, name in db.items()}
+    with shelf('number_to_disease') as db:
+        disease_names = {int(number): name for number, name in db.items()}
+    with shelf('symptom_to_disease') as db:
+        symptom_diseases = {int(number): [int(d) for d in diseases] for number, diseases in db.items()}
+    with shelf('number_to_synonyms') as db:
+        synonyms = {int(number): [int(s) for s in ids] for number, ids in db.items()}
+    compile_dictionary(symptom_names, disease_names, symptom_diseases, synonyms, dict_dir)
+
+
+class SymptomDictionary:
+    """Read-only view of a compiled dictionary, backed by memory maps."""
+
+    def __init__(self, dict_dir=dictionary_folder):
+        self.dict_dir = dict_dir
+        with open(self._path('meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.symptoms = self._string_table('symptom')
+        self.diseases = self._string_table('disease')
+        self.symptom_diseases = self._csr('symptom_diseases')
+        self.synonym_links = self._csr('synonyms')
+        self.disease_symptoms = self._csr('disease_symptoms')
+
+    def _path(self, name):
+        return os.path.join(self.dict_dir, name)
+
+    def _load(self, name):
+        # Plain ndarray views of the map skip np.memmap's per-index overhead
+        return np.load(self._path(name), mmap_mode='r').view(np.ndarray)
+
+    def _string_table(self, kind):
+        path = self._path(f'{kind}_names.bin')
+        blob = b''
+        if os.path.getsize(path):
+            with open(path, 'rb') as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return StringTable(blob, self._load(f'{kind}_offsets.npy'), self._load(f'{kind}_sorted.npy'))
+
+    def _csr(self, name):
+        return self._load(f'{name}_offsets.npy'), self._load(f'{name}_ids.npy')
+
+    @staticmethod
+    def _row(csr, id):
+        offsets, ids = csr
+        if not 0 <= id < len(offsets) - 1:
+            return ids[:0]
+        return ids[offsets[id]:offsets[id + 1]]
+
+    def symptom_id(self, name):
+        return self.symptoms.find(name)
+
+    def symptom_name(self, symptom_id):
+        return self.symptoms.name(symptom_id)
+
+    def disease_id(self, name):
+        return self.diseases.find(name)
+
+    def disease_name(self, disease_id):
+        return self.diseases.name(disease_id)
+
+    def synonyms(self, symptom_id):
+        """Synonym symptom IDs of a symptom (array view)."""
+        return self._row(self.synonym_links, symptom_id)
+
+    def diseases_of(self, symptom_id):
+        """Disease IDs linked to a symptom (array view, ascending)."""
+        return self._row(self.symptom_diseases, symptom_id)
+
+    def symptoms_of(self, disease_id):
+        """Symptom IDs linked to a disease (array view, ascending)."""
+        return self._row(self.disease_symptoms, disease_id)
+
+    def diseases_by_symptom(self, symptom_name):
+        """Names of the diseases linked to a symptom name."""
+        symptom_id = self.symptom_id(symptom_name)
+        if symptom_id < 0:
+            return []
+        return [self.disease_name(int(d)) for d in self.diseases_of(symptom_id)]
+
+
+if __name__ == '__main__':
+    dict_dir = sys.argv[1] if len(sys.argv) > 1 else dictionary_folder
+    compile_from_shelves(dict_dir)
+    start_time = time.time()
+    dictionary = SymptomDictionary(dict_dir)
+    print(f"Loaded {dictionary.meta}: {(time.time() - start_time) * 1000:.2f} ms")
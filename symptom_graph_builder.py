@@ -0,0 +1,132 @@
+"""
+Full, parallel rebuild of the symptom/disease mappings.
+
+    parser processes: file -> (disease, [(symptom, [synonyms])])
+    merge (main process): number diseases and symptoms in name order
+    bulk write: fresh shelves, counters.pickle and the compiled dictionary
+
+IDs depend only on the set of names, never on file order or on which worker
+finished first, so rebuilding the same folder always gives the same numbers.
+"""
+import os
+import sys
+import time
+import shutil
+import shelve
+import multiprocessing as mp
+
+from symptom_parser import symptom_synonym_pattern
+from symptom_graph_writer import shelf_names, counter_file, journal_file, _write_pickle_atomic
+from symptom_dictionary import compile_dictionary, dictionary_folder
+
+
+def parse_disease_file(file_path):
+    """Return (disease_name, [(symptom_name, [synonyms])]) for one disease file."""
+    disease_name = os.path.splitext(os.path.basename(file_path))[0].strip()
+    with open(file_path, "r", encoding="utf-8") as file:
+        content = file.read()
+    symptoms = []
+    for symptom_name, synonyms in symptom_synonym_pattern.findall(content):
+        symptoms.append((symptom_name.strip().lower(),
+                         [synonym.strip().lower() for synonym in synonyms.split(",")]))
+    return disease_name, symptoms
+
+
+def merge_records(records):
+    """Number diseases and symptoms by sorted name and link them.
+
+    Args:
+        records (list): parse_disease_file results; a disease seen twice keeps its first record
+            in file name order.
+
+    Returns:
+        tuple: ({disease: id}, {symptom: id}, {symptom_id: set(disease_ids)},
+        {symptom_id: set(synonym_ids)}), IDs starting at 1 like the incremental writer.
+    """
+    diseases = {}
+    for disease_name, symptoms in records:
+        diseases.setdefault(disease_name, symptoms)
+    disease_ids = {name: i for i, name in enumerate(sorted(diseases), start=1)}
+    symptom_names = {name for symptoms in diseases.values() for symptom, synonyms in symptoms
+                     for name in [symptom, *synonyms]}
+    symptom_ids = {name: i for i, name in enumerate(sorted(symptom_names), start=1)}
+
+    symptom_diseases = {}
+    synonyms = {}
+    for disease_name, symptoms in diseases.items():
+        disease_id = disease_ids[disease_name]
+        for symptom, symptom_synonyms in symptoms:
+            symptom_id = symptom_ids[symptom]
+            synonym_ids = [symptom_ids[s] for s in symptom_synonyms]
+            for linked in [symptom_id, *synonym_ids]:
+                symptom_diseases.setdefault(linked, set()).add(disease_id)
+            synonyms.setdefault(symptom_id, set()).update(synonym_ids)
+    return disease_ids, symptom_ids, symptom_diseases, synonyms
+
+
+def _shelf_files(directory, name):
+    """Files backing shelf `name` (the dbm backend decides the extensions)."""
+    return [f for f in os.listdir(directory) if f == name or f.startswith(name + '.')]
+
+
+def write_shelves(disease_ids, symptom_ids, symptom_diseases, synonyms, shelf_dir='.'):
+    """Write fresh mapping shelves in bulk and swap them in place of the old ones."""
+    tmp_dir = os.path.join(shelf_dir, 'symptom_shelves.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    contents = {
+        "symptom_to_number": {name: str(i) for name, i in symptom_ids.items()},
+        "number_to_symptom": {str(i): name for name, i in symptom_ids.items()},
+        "number_to_synonyms": {str(s): [str(i) for i in sorted(ids)] for s, ids in synonyms.items()},
+        "disease_to_number": {name: str(i) for name, i in disease_ids.items()},
+        "number_to_disease": {str(i): name for name, i in disease_ids.items()},
+        "symptom_to_disease": {str(s): {str(d) for d in ids} for s, ids in symptom_diseases.items()},
+    }
+    for name in shelf_names:
+        with shelve.open(os.path.join(tmp_dir, name), flag='n') as db:
+            db.update(contents[name])
+
+    for name in shelf_names:
+        new_files = _shelf_files(tmp_dir, name)
+        stale_files = set(_shelf_files(shelf_dir, name)) - set(new_files)
+        # Each file replaces the live one directly, so the shelf is never missing
+        for f in new_files:
+            os.replace(os.path.join(tmp_dir, f), os.path.join(shelf_dir, f))
+        # Files the new backend does not use (e.g. after a dbm module change)
+        for f in stale_files:
+            os.remove(os.path.join(shelf_dir, f))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    # A journal from the incremental writer would replay stale numbers over the rebuild
+    if os.path.exists(os.path.join(shelf_dir, journal_file)):
+        os.remove(os.path.join(shelf_dir, journal_file))
+    _write_pickle_atomic(os.path.join(shelf_dir, counter_file),
+                         {"symptom_counter": len(symptom_ids) + 1, "disease_counter": len(disease_ids) + 1})
+
+
+def rebuild_symptom_graph(folder_path, shelf_dir='.', processes=None, chunksize=32, dict_dir=dictionary_folder):
+    """Parse every file in `folder_path` on all cores and rebuild the mappings from scratch."""
+    start_time = time.time()
+    files = sorted(os.path.join(folder_path, f) for f in os.listdir(folder_path)
+                   if os.path.isfile(os.path.join(folder_path, f)))
+    processes = processes or os.cpu_count() or 1
+    if processes > 1:
+        # spawn keeps the workers free of the parent's open shelves
+        with mp.get_context("spawn").Pool(processes) as pool:
+            records = pool.map(parse_disease_file, files, chunksize)
+    else:
+        records = [parse_disease_file(f) for f in files]
+    print(f"Parsed {len(files)} files with {processes} processes: {time.time() - start_time:.2f} seconds")
+
+    disease_ids, symptom_ids, symptom_diseases, synonyms = merge_records(records)
+    write_shelves(disease_ids, symptom_ids, symptom_diseases, synonyms, shelf_dir)
+    compile_dictionary({i: name for name, i in symptom_ids.items()}, {i: name for name, i in disease_ids.items()},
+                       symptom_diseases, synonyms, os.path.join(shelf_dir, dict_dir))
+    print(f"Rebuilt {len(disease_ids)} diseases and {len(symptom_ids)} symptoms: "
+          f"{time.time() - start_time:.2f} seconds")
+    return disease_ids, symptom_ids
+
+
+if __name__ == '__main__':
+    folder_path = sys.argv[1] if len(sys.argv) > 1 else "./somepath"
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rebuild_symptom_graph(folder_path, processes=processes)
@@ -0,0 +1,177 @@
+"""
+Batched, crash-safe writer for the symptom/disease mapping shelves.
+
+Inserts are buffered in memory and committed every `batch_size` disease
+files. A commit first writes the batch's final values and the counters to a
+redo journal (fsync + atomic rename, the commit point), then applies them to
+the shelves and counters.pickle and deletes the journal. A writer opened
+after a crash replays a leftover journal, so shelves and counters always
+reflect whole batches; files of an uncommitted batch are simply ingested
+again because their diseases are not mapped yet.
+
+The shelves are opened without writeback, so memory is bounded by one batch.
+"""
+import os
+import pickle
+import shelve
+
+counter_file = "counters.pickle"
+journal_file = "symptom_graph_journal.pickle"
+
+shelf_names = ("symptom_to_number", "number_to_symptom", "number_to_synonyms",
+               "disease_to_number", "number_to_disease", "symptom_to_disease")
+
+
+def _write_pickle_atomic(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class SymptomGraphWriter:
+    """Buffers symptom graph inserts and commits them in batches.
+
+    Args:
+        shelf_dir (str): Directory holding the shelves, counters and journal.
+        batch_size (int): Disease files per commit.
+    """
+
+    def __init__(self, shelf_dir='.', batch_size=500):
+        self.shelf_dir = shelf_dir
+        self.batch_size = batch_size
+        self.shelves = {name: shelve.open(self._path(name), flag='c') for name in shelf_names}
+        self.recover()
+        self.counters = self._load_counters()
+        self.pending = {name: {} for name in shelf_names}
+        self.pending_files = 0
+        self.committed_files = 0
+
+    def _path(self, name):
+        return os.path.join(self.shelf_dir, name)
+
+    def _load_counters(self):
+        if os.path.exists(self._path(counter_file)):
+            with open(self._path(counter_file), "rb") as f:
+                return pickle.load(f)
+        return {"symptom_counter": 1, "disease_counter": 1}
+
+    def _apply(self, writes, counters):
+        for name, entries in writes.items():
+            shelf = self.shelves[name]
+            for key, value in entries.items():
+                shelf[key] = value
+            shelf.sync()
+        _write_pickle_atomic(self._path(counter_file), counters)
+
+    def recover(self):
+        """Replay a journal left by a crashed commit; returns True if one was found."""
+        path = self._path(journal_file)
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            journal = pickle.load(f)
+        self._apply(journal['writes'], journal['counters'])
+        os.remove(path)
+        print(f"Recovered a committed batch of {journal['files']} files from {journal_file}")
+        return True
+
+    # ---- buffered reads and writes --------------------------------------
+
+    def _get(self, name, key, default=None):
+        pending = self.pending[name]
+        if key in pending:
+            return pending[key]
+        return self.shelves[name].get(key, default)
+
+    def _set(self, name, key, value):
+        self.pending[name][key] = value
+
+    def has_disease(self, disease_name):
+        return self._get("disease_to_number", disease_name) is not None
+
+    def _symptom_number(self, symptom_name):
+        """Number of a symptom name, assigning the next one if it is new."""
+        number = self._get("symptom_to_number", symptom_name)
+        if number is None:
+            number = str(self.counters["symptom_counter"])
+            self._set("symptom_to_number", symptom_name, number)
+            self._set("number_to_symptom", number, symptom_name)
+            self.counters["symptom_counter"] += 1
+        return number
+
+    def _link(self, symptom_number, disease_number):
+        diseases = set(self._get("symptom_to_disease", symptom_number, set()))
+        diseases.add(disease_number)
+        self._set("symptom_to_disease", symptom_number, diseases)
+
+    def add_disease(self, disease_name, symptoms):
+        """Map one disease and its symptoms.
+
+        Args:
+            disease_name (str): Disease name (the file name without extension).
+            symptoms (list): (symptom_name, comma separated synonyms) pairs.
+
+        Returns:
+            str: The new disease number, or None if the disease is already mapped.
+        """
+        if self.has_disease(disease_name):
+            return None
+        disease_number = str(self.counters["disease_counter"])
+        self._set("disease_to_number", disease_name, disease_number)
+        self._set("number_to_disease", disease_number, disease_name)
+        self.counters["disease_counter"] += 1
+
+        for symptom_name, synonyms in symptoms:
+            symptom_name = symptom_name.strip().lower()
+            synonyms_list = [synonym.strip().lower() for synonym in synonyms.split(",")]
+            symptom_number = self._symptom_number(symptom_name)
+            self._link(symptom_number, disease_number)
+
+            synonym_numbers = list(self._get("number_to_synonyms", symptom_number, []))
+            for synonym in synonyms_list:
+                synonym_number = self._symptom_number(synonym)
+                synonym_numbers.append(synonym_number)
+                self._link(synonym_number, disease_number)
+            self._set("number_to_synonyms", symptom_number, list(set(synonym_numbers)))
+
+        self.pending_files += 1
+        if self.pending_files >= self.batch_size:
+            self.commit()
+        return disease_number
+
+    def commit(self):
+        """Atomically apply the buffered batch to the shelves and counters."""
+        if not self.pending_files:
+            return
+        writes = {name: entries for name, entries in self.pending.items() if entries}
+        counters = dict(self.counters)
+        _write_pickle_atomic(self._path(journal_file),
+                             {'writes': writes, 'counters': counters, 'files': self.pending_files})
+        self._apply(writes, counters)
+        os.remove(self._path(journal_file))
+        self.committed_files += self.pending_files
+        self.pending = {name: {} for name in shelf_names}
+        self.pending_files = 0
+
+    def rollback(self):
+        """Discard the buffered batch."""
+        self.pending = {name: {} for name in shelf_names}
+        self.pending_files = 0
+        self.counters = self._load_counters()
+
+    def close(self):
+        self.commit()
+        for shelf in self.shelves.values():
+            shelf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Keep the whole batches already committed; the partial one is redone on the next run
+            self.rollback()
+        self.close()
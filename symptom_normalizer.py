@@ -0,0 +1,114 @@
+"""
+Maps free-text symptom phrases to canonical symptom IDs by embedding similarity.
+
+Every symptom and synonym name of the compiled dictionary is embedded once
+with the chunk encoder and stored as one matrix whose row i is symptom ID i
+(rows of unused IDs are zero and masked out). Vectors are L2-normalized, so
+a batch of phrases is embedded together and matched with a single matrix
+product and an argpartition top-k.
+
+Layout of a normalizer directory:
+
+    meta.json     symptom count, embedding dim, model name
+    vectors.npy   (max_id + 1, dim) float32 unit vectors aligned to symptom IDs
+    live.npy      (max_id + 1,) bool, True for IDs that have a name
+"""
+import os
+import sys
+import json
+import time
+import shutil
+from typing import NamedTuple
+import numpy as np
+
+from symptom_dictionary import SymptomDictionary, dictionary_folder
+from vector_search import search_matrix
+
+normalizer_folder = 'symptom_vectors'
+
+
+class SymptomMatch(NamedTuple):
+    symptom_id: int
+    name: str
+    score: float
+
+
+def _unit_rows(embeddings):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (embeddings / norms).astype(np.float32)
+
+
+class SymptomNormalizer:
+    """Nearest canonical symptoms for free-text phrases.
+
+    Args:
+        index_dir (str): Directory written by build().
+        embedder (BatchEmbedder): Encoder for the query phrases; must be the one used by build().
+        dictionary (SymptomDictionary): Dictionary the IDs refer to; loaded from dict_dir when None.
+    """
+
+    def __init__(self, index_dir=normalizer_folder, embedder=None, dictionary=None, dict_dir=dictionary_folder):
+        self.index_dir = index_dir
+        self.embedder = embedder
+        self.dictionary = dictionary or SymptomDictionary(dict_dir)
+        with open(self._path('meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(self._path('vectors.npy'), mmap_mode='r')
+        self.live = np.load(self._path('live.npy'))
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    @classmethod
+    def build(cls, embedder, dictionary, index_dir=normalizer_folder, model_name='BAAI/bge-m3'):
+        """Embed every symptom name of a SymptomDictionary in shared batches."""
+        start_time = time.time()
+        n_symptoms = len(dictionary.symptoms)
+        ids = [i for i in range(n_symptoms) if dictionary.symptom_name(i)]
+        embeddings = embedder.embed([dictionary.symptom_name(i) for i in ids])
+        vectors = np.zeros((n_symptoms, embedder.embedding_dim), dtype=np.float32)
+        vectors[ids] = _unit_rows(embeddings)
+        live = np.zeros(n_symptoms, dtype=bool)
+        live[ids] = True
+
+        tmp_dir = index_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'vectors.npy'), vectors)
+        np.save(os.path.join(tmp_dir, 'live.npy'), live)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'symptoms': len(ids), 'dim': embedder.embedding_dim, 'model': model_name}, f)
+        shutil.rmtree(index_dir, ignore_errors=True)
+        os.rename(tmp_dir, index_dir)
+        print(f"Embedded {len(ids)} symptom names: {time.time() - start_time:.2f} seconds")
+        return cls(index_dir, embedder, dictionary)
+
+    def match_embeddings(self, embeddings, k=3, min_score=None):
+        """SymptomMatch lists (best first) for already embedded phrases."""
+        if not len(embeddings) or not self.meta['symptoms']:
+            return [[] for _ in range(len(embeddings))]
+        rows, scores = search_matrix(self.vectors, _unit_rows(np.atleast_2d(embeddings)), k, self.live)
+        results = []
+        for row_ids, row_scores in zip(rows.tolist(), scores.tolist()):
+            results.append([SymptomMatch(symptom_id, self.dictionary.symptom_name(symptom_id), score)
+                            for symptom_id, score in zip(row_ids, row_scores)
+                            if min_score is None or score >= min_score])
+        return results
+
+    def normalize(self, phrases, k=3, min_score=None):
+        """Embed `phrases` in one batch and return their k nearest symptoms each."""
+        phrases = list(phrases)
+        if not phrases:
+            return []
+        return self.match_embeddings(self.embedder.embed(phrases), k, min_score)
+
+
+if __name__ == '__main__':
+    from batch_embedder import BatchEmbedder, load_encoder
+
+    tokenizer, model = load_encoder()
+    embedder = BatchEmbedder(tokenizer, model, batch_size=64)
+    normalizer = SymptomNormalizer.build(embedder, SymptomDictionary(dictionary_folder), normalizer_folder)
+    for phrase, matches in zip(sys.argv[1:], normalizer.normalize(sys.argv[1:])):
+        print(phrase, matches)
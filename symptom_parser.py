@@ -0,0 +1,47 @@
+import re
+
+# Regular expression pattern to extract symptom details from the generated disease files
+symptom_pattern = re.compile(
+    r"<start_symptom_name>(.*?)</start_symptom_name>\s*"
+    r"<start_description>(.*?)</start_description>\s*"
+    r"<start_synonyms>(.*?)</start_synonyms>\s*"
+    r"<start_monologues>(.*?)</start_monologues>",
+    re.DOTALL
+)
+
+# Symptom names and synonyms only, used to build the symptom/disease mappings
+symptom_synonym_pattern = re.compile(
+    r"<start_symptom_name>(.*?)</start_symptom_name>.*?<start_synonyms>(.*?)</start_synonyms>",
+    re.DOTALL,
+)
+
+def parse_symptoms_as_strings_with_indices(response: str) -> tuple:
+    """
+    Parses symptoms from a response, including their start and end character indices in the string.
+
+    Args:
+        response (str): The input string containing symptom data formatted with tags.
+
+    Returns:
+        tuple: (chunks, chunk_indices) where
+              - chunks: The formatted strings containing symptom details.
+              - chunk_indices: (start_index, end_index) character indices of each symptom in the string.
+    """
+    chunks = []
+    chunk_indices = []
+
+    # Find all matches in the input response with their indices
+    for match in symptom_pattern.finditer(response):
+        chunk_indices.append((match.start(), match.end()))
+        chunks.append(f"<symptom>Name: {match.group(1).strip()}, "
+                      f"Description: {match.group(2).strip()}, "
+                      f"Synonyms: {match.group(3).strip()}, "
+                      f"Monologues: {match.group(4).strip()}</symptom>")
+
+    return chunks, chunk_indices
+
+def read_symptom_chunks(pdf_file):
+    """Read a symptom file and return its chunk strings and character indices."""
+    with open(pdf_file, "r", encoding="utf-8") as file:
+        text = file.read()
+    return parse_symptoms_as_strings_with_indices(text)
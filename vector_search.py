@@ -0,0 +1,90 @@
+"""
+Brute-force top-k search over a contiguous embedding matrix.
+
+All rows are scored with one matrix product per block, the top k are picked
+with argpartition and only those k are sorted. Results are structured NumPy
+arrays rather than lists of dicts.
+"""
+import numpy as np
+
+from embedding_store import chunk_dtype
+
+# One search hit: row in the matrix plus the chunk identifiers stored with it
+hit_dtype = np.dtype([('row', 'i8'), ('doc_id', 'i4'), ('chunk_index', 'i4'),
+                      ('start_id', 'i4'), ('end_id', 'i4'), ('score', 'f4')])
+
+# Rows scored per matrix product; bounds the float32 copy made for float16 matrices
+block_rows = 65536
+
+
+def score_matrix(matrix, queries):
+    """Return the (n_queries, n_rows) dot-product scores of `queries` against `matrix`."""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    n_rows = len(matrix)
+    scores = np.empty((len(queries), n_rows), dtype=np.float32)
+    for start in range(0, n_rows, block_rows):
+        block = matrix[start:start + block_rows]
+        if block.dtype != np.float32:
+            block = block.astype(np.float32)
+        scores[:, start:start + len(block)] = queries @ block.T
+    return scores
+
+
+def topk_from_scores(scores, k=None):
+    """Return (rows, scores) of the k best entries per query row, best first.
+
+    `k=None` ranks every row.
+    """
+    n_rows = scores.shape[1]
+    if k is not None and k <= 0:
+        empty = np.zeros((len(scores), 0), dtype=np.int64)
+        return empty, np.zeros((len(scores), 0), dtype=scores.dtype)
+    if k is None or k >= n_rows:
+        rows = np.argsort(-scores, axis=1, kind='stable')
+    else:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        part_scores = np.take_along_axis(scores, part, axis=1)
+        rows = np.take_along_axis(part, np.argsort(-part_scores, axis=1, kind='stable'), axis=1)
+    return rows, np.take_along_axis(scores, rows, axis=1)
+
+
+def search_matrix(matrix, queries, k=10, live=None):
+    """Score `queries` against every row of `matrix` and return the top-k (rows, scores).
+
+    Args:
+        matrix (np.ndarray): (n_rows, dim) embeddings, float32 or float16 (memmaps are fine).
+        queries (np.ndarray): (dim,) or (n_queries, dim) query embeddings.
+        k (int): Results per query, or None to rank every row.
+        live (np.ndarray): Optional boolean mask; rows set to False are never returned.
+    """
+    scores = score_matrix(matrix, queries)
+    if live is not None:
+        scores[:, ~live] = -np.inf
+        k = min(k, int(np.count_nonzero(live))) if k is not None else int(np.count_nonzero(live))
+    return topk_from_scores(scores, k)
+
+
+def hits_from_rows(rows, scores, chunks):
+    """hit_dtype records, shaped like `rows`, for rows of the row-aligned chunk table `chunks`."""
+    rows = np.asarray(rows, dtype=np.int64)
+    hits = np.zeros(rows.shape, dtype=hit_dtype)
+    hits['row'] = rows
+    found = chunks[rows.ravel()].reshape(rows.shape)
+    for field in chunk_dtype.names:
+        hits[field] = found[field]
+    hits['score'] = scores
+    return hits
+
+
+def search_chunks(matrix, chunks, queries, k=10, live=None):
+    """Top-k search returning hit_dtype records, shape (n_queries, k).
+
+    `chunks` is the row-aligned chunk table (embedding_store.chunk_dtype).
+    """
+    rows, scores = search_matrix(matrix, queries, k, live)
+    return hits_from_rows(rows, scores, chunks)
+
+
+def search_store(store, queries, k=10):
+    """Top-k search over every live row of an EmbeddingStore."""
+    return search_chunks(store.embeddings, store.chunks, queries, k, store.live)